@@ -20,4 +20,300 @@ window.dash_clientside.clientside = {
 
     },
 
-}
\ No newline at end of file
+    upload_handle: function (n_clicks) {
+
+        // Hand the dataset handle of the last finished upload to Dash
+        if (!window.xanthosvis_upload) {
+            return window.dash_clientside.no_update
+        }
+
+        return window.xanthosvis_upload
+
+    },
+
+    grid_click: function (n_clicks) {
+
+        // Hand the grid cell clicked on the grid image to Dash, in the same form as the graph's click data
+        if (!window.xanthosvis_grid_click) {
+            return window.dash_clientside.no_update
+        }
+
+        return window.xanthosvis_grid_click
+
+    },
+
+    marker_size: function (relayout_data, grid_on) {
+
+        // Resize the grid cell markers with the map zoom in the browser, without a round trip to the server
+        var graph_div = document.querySelector("#choro_graph .js-plotly-plot");
+        if (!grid_on || !graph_div || !relayout_data || relayout_data["mapbox.zoom"] === undefined) {
+            return window.dash_clientside.no_update
+        }
+
+        // Only the grid cell markers are resized, not the colorbar trace drawn with the grid image
+        var traces = [];
+        graph_div.data.forEach(function (trace, i) {
+            if (trace.type === "scattermapbox" && trace.hoverinfo !== "skip") {
+                traces.push(i);
+            }
+        });
+
+        var size = relayout_data["mapbox.zoom"] * 4;
+        if (traces.length > 0) {
+            Plotly.restyle(graph_div, {"marker.size": size}, traces);
+        }
+
+        return size
+
+    },
+
+    geometry_level: function (relayout_data) {
+
+        // Draw the areas with the geometry simplified for the map zoom, finer outlines as the user zooms in
+        var graph_div = document.querySelector("#choro_graph .js-plotly-plot");
+        if (!graph_div || !relayout_data || relayout_data["mapbox.zoom"] === undefined) {
+            return window.dash_clientside.no_update
+        }
+
+        var trace = graph_div.data[0];
+        if (!trace || trace.type !== "choroplethmapbox" || !trace.meta || !trace.meta.geometry_levels) {
+            return window.dash_clientside.no_update
+        }
+
+        // Levels are ordered by their minimum zoom, the finest one the map is zoomed in to is drawn
+        var levels = trace.meta.geometry_levels;
+        var url = levels[0][1];
+        levels.forEach(function (level) {
+            if (relayout_data["mapbox.zoom"] >= level[0]) {
+                url = level[1];
+            }
+        });
+
+        if (trace.geojson !== url) {
+            Plotly.restyle(graph_div, {"geojson": [url]}, [0]);
+        }
+
+        return url
+
+    },
+
+    select_areas: function (selected_data, grid_on) {
+
+        // Filter the area choropleth to the selected areas in the browser, the figure already holds every area
+        var graph_div = document.querySelector("#choro_graph .js-plotly-plot");
+        if (grid_on || !graph_div || !selected_data || selected_data.points.length === 0) {
+            return window.dash_clientside.no_update
+        }
+
+        var trace = graph_div.data[0];
+        if (!trace || trace.type !== "choroplethmapbox" || !trace.meta || !trace.meta.bounds) {
+            return window.dash_clientside.no_update
+        }
+
+        // Positions of the selected areas in the trace, in trace order
+        var selected = {};
+        selected_data.points.forEach(function (point) {
+            if (point.curveNumber === 0) {
+                selected[point.pointNumber] = true;
+            }
+        });
+        var keep = Object.keys(selected).map(Number).sort(function (a, b) {
+            return a - b
+        });
+        var pick = function (values) {
+            return keep.map(function (i) {
+                return values[i]
+            })
+        };
+
+        // Center on the grid cells of the selected areas, the same as a selection drawn by the server
+        var bounds = pick(trace.meta.bounds).filter(function (b) {
+            return b
+        });
+        var center = {
+            "lon": (Math.min.apply(null, bounds.map(function (b) { return b[0] })) +
+                Math.max.apply(null, bounds.map(function (b) { return b[1] }))) / 2,
+            "lat": (Math.min.apply(null, bounds.map(function (b) { return b[2] })) +
+                Math.max.apply(null, bounds.map(function (b) { return b[3] }))) / 2
+        };
+
+        var meta = Object.assign({}, trace.meta, {"bounds": pick(trace.meta.bounds)});
+        Plotly.restyle(graph_div, {
+            "locations": [pick(trace.locations)], "z": [pick(trace.z)], "customdata": [pick(trace.customdata)],
+            "text": [pick(trace.text)], "geojson": [trace.meta.select_geojson], "meta": [meta],
+            "selectedpoints": [null]
+        }, [0]);
+        if (bounds.length > 0) {
+            Plotly.relayout(graph_div, {"mapbox.center": center, "mapbox.zoom": trace.meta.select_zoom});
+        }
+
+        return keep.length
+
+    },
+
+}
+
+// Minimum time between grid cell lookups while the mouse moves over the grid image
+var XANTHOSVIS_HOVER_INTERVAL = 150;
+
+// Look up the grid cell under a point on the map, the grid image has no points for plotly to report
+function xanthosvis_lookup_cell(lng_lat, callback) {
+
+    var lookup_request = new XMLHttpRequest();
+    lookup_request.open("GET", "grid-cell?lon=" + lng_lat.lng + "&lat=" + lng_lat.lat);
+    lookup_request.onload = function () {
+        callback(lookup_request.status === 200 ? JSON.parse(lookup_request.responseText) : null);
+    };
+    lookup_request.send();
+}
+
+// Check if the figure in a graph is drawing grid cells as an image
+function xanthosvis_has_grid_image(graph_div) {
+
+    var layers = (graph_div.layout && graph_div.layout.mapbox && graph_div.layout.mapbox.layers) || [];
+    return layers.some(function (layer) {
+        return layer.name === "grid_image"
+    });
+}
+
+// Handle hover and click on the grid image through the map itself
+function xanthosvis_bind_grid_image(graph_div) {
+
+    var subplot = graph_div._fullLayout && graph_div._fullLayout.mapbox && graph_div._fullLayout.mapbox._subplot;
+    var map = subplot && subplot.map;
+    if (!map || map.xanthosvis_bound) {
+        return
+    }
+    map.xanthosvis_bound = true;
+
+    var tooltip = document.createElement("div");
+    tooltip.className = "grid-tooltip";
+    tooltip.style.cssText = "position: absolute; display: none; pointer-events: none; padding: 4px 8px; " +
+        "background: rgba(255, 255, 255, 0.9); border: 1px solid #ccc; font-size: 12px; z-index: 10;";
+    map.getContainer().appendChild(tooltip);
+
+    var last_hover = 0;
+    map.on("mousemove", function (event) {
+        var now = Date.now();
+        if (!xanthosvis_has_grid_image(graph_div) || now - last_hover < XANTHOSVIS_HOVER_INTERVAL) {
+            return
+        }
+        last_hover = now;
+
+        xanthosvis_lookup_cell(event.lngLat, function (cell) {
+            if (!cell) {
+                tooltip.style.display = "none";
+                return
+            }
+            tooltip.innerHTML = "<b>" + (cell.basin_name || "") + "</b><br>" + (cell.country_name || "") +
+                "<br>Grid Cell: " + cell.customdata[3];
+            tooltip.style.left = (event.point.x + 15) + "px";
+            tooltip.style.top = (event.point.y + 15) + "px";
+            tooltip.style.display = "block";
+        });
+    });
+
+    map.on("mouseout", function () {
+        tooltip.style.display = "none";
+    });
+
+    map.on("click", function (event) {
+        if (!xanthosvis_has_grid_image(graph_div)) {
+            return
+        }
+
+        xanthosvis_lookup_cell(event.lngLat, function (cell) {
+            if (cell) {
+                window.xanthosvis_grid_click = {"points": [{"customdata": cell.customdata}]};
+                document.getElementById("grid_click_trigger").click();
+            }
+        });
+    });
+}
+
+// Bind the grid image handlers whenever the choropleth graph is drawn
+document.addEventListener("DOMContentLoaded", function () {
+
+    new MutationObserver(function () {
+        var graph_div = document.querySelector("#choro_graph .js-plotly-plot");
+        if (graph_div && !graph_div.xanthosvis_bound) {
+            graph_div.xanthosvis_bound = true;
+            graph_div.on("plotly_afterplot", function () {
+                xanthosvis_bind_grid_image(graph_div);
+            });
+        }
+    }).observe(document.body, {childList: true, subtree: true});
+});
+
+// Post a file to the upload endpoint so it is written to disk on the server, then let Dash know it is available
+function xanthosvis_post_upload(file, upload_div) {
+
+    var form = new FormData();
+    form.append("file", file);
+
+    var upload_request = new XMLHttpRequest();
+    upload_request.open("POST", "upload");
+
+    // Show the loading spinner while the file is uploading
+    upload_div.setAttribute("data-dash-is-loading", "true");
+
+    upload_request.onload = function () {
+        upload_div.removeAttribute("data-dash-is-loading");
+        var response = JSON.parse(upload_request.responseText);
+
+        if (upload_request.status !== 200) {
+            alert(response.error);
+            return
+        }
+
+        window.xanthosvis_upload = response;
+        document.getElementById("upload_trigger").click();
+    };
+
+    upload_request.onerror = function () {
+        upload_div.removeAttribute("data-dash-is-loading");
+        alert("The file could not be uploaded. Please try again.");
+    };
+
+    upload_request.send(form);
+}
+
+// Open a file chooser when the upload area is clicked
+document.addEventListener("click", function (event) {
+
+    var upload_div = event.target.closest && event.target.closest("#upload-data");
+    if (!upload_div) {
+        return
+    }
+
+    var file_input = document.createElement("input");
+    file_input.type = "file";
+    file_input.accept = ".csv,.zip";
+    file_input.onchange = function () {
+        if (file_input.files.length > 0) {
+            xanthosvis_post_upload(file_input.files[0], upload_div);
+        }
+    };
+    file_input.click();
+});
+
+// Allow files to be dragged and dropped on the upload area
+document.addEventListener("dragover", function (event) {
+
+    if (event.target.closest && event.target.closest("#upload-data")) {
+        event.preventDefault();
+    }
+});
+
+document.addEventListener("drop", function (event) {
+
+    var upload_div = event.target.closest && event.target.closest("#upload-data");
+    if (!upload_div) {
+        return
+    }
+
+    event.preventDefault();
+    if (event.dataTransfer.files.length > 0) {
+        xanthosvis_post_upload(event.dataTransfer.files[0], upload_div);
+    }
+});
@@ -0,0 +1,990 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+import xanthosvis.range_query as xrq
+import xanthosvis.util_functions as xvu
+
+# File extensions accepted by the upload endpoint
+ALLOWED_EXTENSIONS = ('.csv', '.zip')
+
+# Files making up a stored dataset
+META_FILE = 'meta.json'
+VALUES_FILE = 'values.npy'
+IDS_FILE = 'ids.npy'
+ROW_INDEX_FILE = 'row_index.npy'
+CUBE_FILE = 'cube_{}.npy'
+RANGE_FILE = 'range_{}_{}.npy'
+MONTH_RANGE_SOURCE = '{}_month{:02d}'
+REFS_DIR = 'refs'
+
+# Size of the chunks uploaded files are read and hashed in
+CHUNK_SIZE = 1024 * 1024
+
+# Number of time columns processed at a time when building area cubes or copying the values matrix
+COLUMN_BLOCK_SIZE = 256
+
+# Number of grid cell rows a statistic is computed for at a time when its progress is reported
+STATISTIC_BLOCK_ROWS = 4096
+
+# Datasets are keyed by the sha256 digest of the uploaded file
+KEY_PATTERN = re.compile('[0-9a-f]{64}')
+
+# Each upload is written to its own file, named by the dataset key and a random upload id
+UPLOAD_PATTERN = re.compile('[0-9a-f]{32}')
+
+# Shared memory filesystem, files here are held in memory once and shared by every process that maps them
+SHARED_MEMORY_DIR = '/dev/shm'
+
+
+def shared_store_dir(name, fallback):
+    """Get a directory for a store shared by all worker processes on the host, in shared memory where the host has it.
+    Workers memory map the same files read only, so a dataset is held in memory once however many workers there are.
+
+    :param name:                    Name of the store's directory
+    :type name:                     str
+
+    :param fallback:                Directory to use when there is no shared memory filesystem
+    :type fallback:                 str
+
+    :return:                        str; store directory
+
+    """
+
+    if os.path.isdir(SHARED_MEMORY_DIR) and os.access(SHARED_MEMORY_DIR, os.W_OK):
+        return os.path.join(SHARED_MEMORY_DIR, name)
+
+    return fallback
+
+
+def save_upload(file_storage, upload_dir):
+    """Write a file posted to the upload endpoint to disk and return a handle for it.  The file is streamed to disk
+    in chunks so the raw upload is never held in browser or server memory as a whole, and is keyed by the hash of
+    its contents so uploads of the same file resolve to the same dataset.  Each upload has its own file, sessions
+    uploading the same file at once don't write or remove each other's copy.
+
+    :param file_storage:            Uploaded file object from the flask request
+    :type file_storage:             werkzeug.datastructures.FileStorage
+
+    :param upload_dir:              Directory to write uploaded files to
+    :type upload_dir:               str
+
+    :return:                        dict; dataset handle {'id': content hash, 'upload': upload id,
+                                    'filename': [file name]}
+
+    """
+
+    # Only keep the base name of the file, browsers may send a full path
+    name = os.path.basename(file_storage.filename)
+    if not name.lower().endswith(ALLOWED_EXTENSIONS):
+        msg = f"The file type of '{name}' is not supported.  Please upload a .csv or zipped .csv file."
+        raise ValueError(msg)
+
+    os.makedirs(upload_dir, exist_ok=True)
+
+    # Hash the file while writing it to a temporary file, the digest becomes the dataset reference
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=upload_dir, delete=False) as out:
+        for chunk in iter(lambda: file_storage.stream.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            out.write(chunk)
+
+    handle = {'id': digest.hexdigest(), 'upload': uuid.uuid4().hex, 'filename': [name]}
+    os.replace(out.name, get_upload_path(upload_dir, handle))
+
+    return handle
+
+
+def get_upload_path(upload_dir, handle):
+    """Get the location on disk of an uploaded file from its dataset handle
+
+    :param upload_dir:              Directory uploaded files are written to
+    :type upload_dir:               str
+
+    :param handle:                  Dataset handle returned by the upload endpoint
+    :type handle:                   dict
+
+    :return:                        str; full path to the uploaded file
+
+    """
+
+    # Handles come from the browser, only accept content hashes, upload ids and upload extensions so they can't
+    # point outside of the upload directory
+    extension = os.path.splitext(handle['filename'][0])[1].lower()
+    if (not KEY_PATTERN.fullmatch(handle['id']) or not UPLOAD_PATTERN.fullmatch(handle.get('upload', ''))
+            or extension not in ALLOWED_EXTENSIONS):
+        msg = f"The upload handle '{handle['id']}' is not valid."
+        raise ValueError(msg)
+
+    return os.path.join(upload_dir, f"{handle['id']}.{handle['upload']}{extension}")
+
+
+def remove_upload(upload_dir, handle):
+    """Remove an uploaded file from disk once it has been ingested
+
+    :param upload_dir:              Directory uploaded files are written to
+    :type upload_dir:               str
+
+    :param handle:                  Dataset handle returned by the upload endpoint
+    :type handle:                   dict
+
+    """
+
+    file_path = get_upload_path(upload_dir, handle)
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+
+class Dataset:
+    """A prepared Xanthos dataset opened from the dataset store.  The grid cell by time step matrix is memory mapped
+    so only the time columns that are used are read from disk.
+
+    :param dataset_dir:             Directory the dataset was written to by the store
+    :type dataset_dir:              str
+
+    :param meta:                    Metadata read from the dataset's sidecar file
+    :type meta:                     dict
+
+    """
+
+    def __init__(self, dataset_dir, meta):
+        self.dataset_dir = dataset_dir
+        self.meta = meta
+        self.columns = meta['columns']
+
+        # Grid cell x time matrix, stored in column (Fortran) order so each time step is contiguous on disk
+        self.values = np.load(os.path.join(dataset_dir, VALUES_FILE), mmap_mode='r')
+        self.ids = np.load(os.path.join(dataset_dir, IDS_FILE))
+
+        # Dense grid id to row index so a grid cell's row is found without scanning the ids
+        self.row_index = np.load(os.path.join(dataset_dir, ROW_INDEX_FILE), mmap_mode='r')
+
+        self._column_index = {column: i for i, column in enumerate(self.columns)}
+
+        # Calendar month of each time column, 0 for files with yearly time steps
+        self.months = np.array([int(c[4:6]) if len(c) == 6 else 0 for c in self.columns])
+
+    def column_positions(self, columns):
+        """Get the positions of time columns in the values matrix
+
+        :param columns:                 List of time columns
+        :type columns:                  list
+
+        :return:                        array; column positions
+
+        """
+
+        return np.array([self._column_index[c] for c in columns], dtype=np.intp)
+
+    def time_index(self, yr_list, months=None):
+        """Get the positions of the chosen years in the values matrix, filtered to the chosen months
+
+        :param yr_list:                 List of time columns in the chosen year range
+        :type yr_list:                  list
+
+        :param months:                  List of months to keep, e.g. ['01', '02'], all months if empty or None
+        :type months:                   list
+
+        :return:                        array; column positions
+
+        """
+
+        positions = self.column_positions(yr_list)
+        if months:
+            positions = positions[np.isin(self.months[positions], [int(m) for m in months])]
+
+        return positions
+
+    def read_columns(self, columns):
+        """Read time columns from the memory mapped values matrix
+
+        :param columns:                 List of time columns to read
+        :type columns:                  list
+
+        :return:                        array; grid cell x time values for the chosen columns
+
+        """
+
+        return self.read_positions(self.column_positions(columns))
+
+    def read_positions(self, positions):
+        """Read time columns by position from the memory mapped values matrix
+
+        :param positions:               Column positions to read
+        :type positions:                array
+
+        :return:                        array; grid cell x time values for the chosen columns
+
+        """
+
+        # Contiguous ranges are read as a slice to avoid gathering column by column
+        if len(positions) > 0 and positions[-1] - positions[0] == len(positions) - 1:
+            return np.asarray(self.values[:, positions[0]:positions[-1] + 1])
+
+        return self.values[:, positions]
+
+    def row_of(self, cell_id):
+        """Get the row of a grid cell in the values matrix from the dense grid id index written with the dataset
+
+        :param cell_id:                 Grid cell id
+        :type cell_id:                  int
+
+        :return:                        int; row of the grid cell
+
+        """
+
+        return xvu.lookup_id(self.row_index, cell_id)
+
+    def read_attribute(self, name):
+        """Read a per grid cell attribute column (basin id, country name, etc.) written with the dataset
+
+        :param name:                    Name of the attribute
+        :type name:                     str
+
+        :return:                        array; attribute value for each grid cell
+
+        """
+
+        values = np.load(os.path.join(self.dataset_dir, name + '.npy'))
+        labels = self.meta['labels'].get(name)
+
+        # Text attributes are stored as integer codes into a list of labels
+        if labels is not None:
+            labels = np.array(labels + [np.nan], dtype=object)
+            values = labels[values]
+
+        return values
+
+    def read_cube(self, area_key, positions, area_ids=None):
+        """Read time columns by position from an area x time cube materialized when the dataset was stored
+
+        :param area_key:                Field the cube is aggregated by (basin_id or country_name)
+        :type area_key:                 str
+
+        :param positions:               Column positions to read
+        :type positions:                array
+
+        :param area_ids:                Optional list of areas to read, all areas if None
+        :type area_ids:                 list
+
+        :return:                        Labels of areas, area x time sums, and total area of each area
+
+        """
+
+        cube = np.load(os.path.join(self.dataset_dir, CUBE_FILE.format(area_key)), mmap_mode='r')
+        labels = np.array(self.meta['cubes'][area_key]['labels'])
+        area = np.array(self.meta['cubes'][area_key]['area'])
+
+        if area_ids is not None:
+            rows = np.flatnonzero(np.isin(labels, area_ids))
+            return labels[rows], cube[rows][:, positions], area[rows]
+
+        return labels, cube[:, positions], area
+
+    def read_range_index(self, source):
+        """Open a range index written for the grid cell matrix or an area cube
+
+        :param source:                  'values' for the grid cell matrix, or the area field of a cube, followed by
+                                        the month for the index of a calendar month, e.g. 'basin_id_month01'
+        :type source:                   str
+
+        :return:                        dict; memory mapped arrays of the index, or None if the dataset has none
+                                        for the source
+
+        """
+
+        if source not in self.meta.get('ranges', []):
+            return None
+
+        return {name: np.load(os.path.join(self.dataset_dir, RANGE_FILE.format(source, name)), mmap_mode='r')
+                for name in xrq.RANGE_ARRAYS}
+
+    def read_statistic(self, positions, statistic, rows=None, progress=None):
+        """Compute a statistic over time columns of each grid cell.  Year ranges, with or without a months filter, are
+        answered from the range indexes written with the dataset instead of reading every column in the range.
+
+        :param positions:               Column positions
+        :type positions:                array
+
+        :param statistic:               statistic name from user input
+        :type statistic:                str
+
+        :param rows:                    Optional mask or positions of the grid cell rows to compute, all if None
+        :type rows:                     array
+
+        :param progress:                Optional function called with the fraction of rows computed so far, when the
+                                        statistic is computed from the values
+        :type progress:                 function
+
+        :return:                        array; statistic for each grid cell
+
+        """
+
+        result = self._query_ranges(self.values, 'values', positions, statistic, rows)
+        if result is not None:
+            return result
+
+        values = self.read_positions(positions)
+        if rows is not None:
+            values = values[rows]
+
+        if progress is None:
+            return xvu.compute_statistic(values, statistic)
+
+        # Each row's statistic is independent, compute a block of rows at a time to report progress
+        result = np.empty(len(values))
+        for start in range(0, len(values), STATISTIC_BLOCK_ROWS):
+            stop = min(start + STATISTIC_BLOCK_ROWS, len(values))
+            result[start:stop] = xvu.compute_statistic(values[start:stop], statistic)
+            progress(stop / len(values))
+
+        return result
+
+    def statistic_reads(self, positions, statistic, rows=None):
+        """Estimate how many values read_statistic reads to compute a statistic, to tell quick requests from long ones
+
+        :param positions:               Column positions
+        :type positions:                array
+
+        :param statistic:               statistic name from user input
+        :type statistic:                str
+
+        :param rows:                    Optional mask or positions of the grid cell rows to compute, all if None
+        :type rows:                     array
+
+        :return:                        int; number of values read
+
+        """
+
+        n_rows = len(self.ids) if rows is None else len(np.arange(len(self.ids))[rows])
+
+        # Range queries read at most a block of columns at each end of the range
+        if statistic in xrq.RANGE_STATISTICS:
+            return n_rows * min(len(positions), 2 * self.meta.get('range_block_size', xrq.RANGE_BLOCK_SIZE))
+
+        return n_rows * len(positions)
+
+    def read_cube_statistic(self, area_key, positions, statistic, area_ids=None):
+        """Compute a statistic over time columns of the area x time cube materialized when the dataset was stored.
+        Year ranges, with or without a months filter, are answered from the cube's range indexes.
+
+        :param area_key:                Field the cube is aggregated by (basin_id or country_name)
+        :type area_key:                 str
+
+        :param positions:               Column positions
+        :type positions:                array
+
+        :param statistic:               statistic name from user input
+        :type statistic:                str
+
+        :param area_ids:                Optional list of areas to compute, all areas if None
+        :type area_ids:                 list
+
+        :return:                        Labels of areas, statistic of each area, and total area of each area
+
+        """
+
+        cube = np.load(os.path.join(self.dataset_dir, CUBE_FILE.format(area_key)), mmap_mode='r')
+        labels = np.array(self.meta['cubes'][area_key]['labels'])
+        area = np.array(self.meta['cubes'][area_key]['area'])
+        rows = None if area_ids is None else np.flatnonzero(np.isin(labels, area_ids))
+
+        result = self._query_ranges(cube, area_key, positions, statistic, rows)
+        if result is None:
+            result = xvu.compute_statistic(cube[:, positions] if rows is None else cube[rows][:, positions], statistic)
+
+        if rows is not None:
+            return labels[rows], result, area[rows]
+
+        return labels, result, area
+
+    def _query_ranges(self, values, source, positions, statistic, rows):
+        """Answer a statistic over time columns from range indexes, None if the columns aren't a year range or a
+        year range filtered to some calendar months, or the dataset has no index for them"""
+
+        if statistic not in xrq.RANGE_STATISTICS or len(positions) == 0:
+            return None
+
+        # A contiguous year range is one query of the index of every time column
+        if xrq.is_range(positions):
+            range_index = self.read_range_index(source)
+            if range_index is None:
+                return None
+            return xrq.query_range(range_index, values, positions[0], positions[-1] + 1, statistic, rows,
+                                   self.meta['range_block_size'])
+
+        # A year range filtered to some months is a query of each chosen month's index, combined
+        months = np.unique(self.months[positions])
+        span = np.arange(positions[0], positions[-1] + 1)
+        if months[0] == 0 or not np.array_equal(positions, span[np.isin(self.months[span], months)]):
+            return None
+
+        totals = []
+        for month in months:
+            range_index = self.read_range_index(MONTH_RANGE_SOURCE.format(source, month))
+            if range_index is None:
+                return None
+            columns = np.flatnonzero(self.months == month)
+            start, stop = np.searchsorted(columns, positions[0]), np.searchsorted(columns, positions[-1], 'right')
+            totals.append(xrq.range_totals(range_index, values, start, stop, statistic, rows,
+                                           self.meta['month_block_size'], columns))
+
+        return xrq.finish_statistic(xrq.combine_totals(totals), statistic)
+
+    def to_frame(self, columns):
+        """Build a data frame holding only the chosen time columns along with the grid cell attributes
+
+        :param columns:                 List of time columns to include
+        :type columns:                  list
+
+        :return:                        dataframe; prepared data for the chosen time columns
+
+        """
+
+        df = pd.DataFrame(self.read_columns(columns), columns=columns)
+        df.insert(0, 'id', self.ids)
+        for name in self.meta['attributes']:
+            df[name] = self.read_attribute(name)
+
+        return df
+
+
+class DatasetStore:
+    """Disk based store of prepared Xanthos datasets.  Each dataset is written as a typed numpy array file of grid cell
+    by time step values with a small JSON metadata sidecar, replacing pickled data frames in the filesystem cache.
+
+    Datasets are keyed by the hash of the uploaded file so a file that has already been ingested is shared between
+    sessions.  Each session using a dataset holds a reference to it, and a dataset is only removed once no session
+    references it.  References expire if a session has not used the dataset within the lease timeout.  Given a memory
+    budget, unreferenced datasets are instead kept and evicted least recently used first once the store outgrows it.
+
+    :param root_dir:                Directory to write datasets to
+    :type root_dir:                 str
+
+    :param lease_timeout:           Seconds a session's reference to a dataset lasts without being used
+    :type lease_timeout:            int
+
+    :param max_bytes:               Size the stored datasets are kept under by evicting the least recently used
+                                    unreferenced datasets.  Unreferenced datasets are kept until space is needed.
+                                    If None, datasets are removed as soon as no session references them.
+    :type max_bytes:                int
+
+    :param overflow_dir:            Optional directory on disk to write datasets to when the root directory's
+                                    filesystem hasn't the free space for them, e.g. a shared memory filesystem.
+                                    Writing a memory mapped file past the free space of tmpfs kills the process.
+    :type overflow_dir:             str
+
+    """
+
+    def __init__(self, root_dir, lease_timeout=6000, max_bytes=None, overflow_dir=None):
+        self.root_dir = root_dir
+        self.lease_timeout = lease_timeout
+        self.max_bytes = max_bytes
+        self.overflow_dir = overflow_dir
+        for store_dir in self._store_dirs():
+            os.makedirs(store_dir, exist_ok=True)
+
+    def get_path(self, key):
+        """Get the directory a dataset is stored in
+
+        :param key:                     Dataset key
+        :type key:                      str
+
+        :return:                        str; dataset directory
+
+        """
+
+        # Keys come from the browser, only accept content hashes so they can't point outside of the store
+        if not KEY_PATTERN.fullmatch(key):
+            msg = f"The dataset key '{key}' is not valid."
+            raise ValueError(msg)
+
+        # Datasets that overflowed to disk are found there, new datasets go in the root directory
+        for store_dir in self._store_dirs()[1:]:
+            if os.path.exists(os.path.join(store_dir, key)):
+                return os.path.join(store_dir, key)
+
+        return os.path.join(self.root_dir, key)
+
+    def has(self, key):
+        """Check if a dataset is in the store
+
+        :param key:                     Dataset key
+        :type key:                      str
+
+        :return:                        bool; True if the dataset is stored
+
+        """
+
+        return os.path.exists(os.path.join(self.get_path(key), META_FILE))
+
+    @contextlib.contextmanager
+    def ingest_lock(self, key):
+        """Hold a dataset's ingest lock, shared by every worker process on the host.  Sessions that upload the same
+        file at once take it in turn, so the first ingests the file and the others find the stored dataset once it is
+        released instead of ingesting it again.
+
+        :param key:                     Dataset key
+        :type key:                      str
+
+        """
+
+        # The lock file is named like the dataset, so the key is checked the same way
+        lock_path = os.path.join(self.root_dir, f".{os.path.basename(self.get_path(key))}.lock")
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                # A session waiting on the removed file rechecks the store before ingesting, so it still finds the
+                # dataset stored here
+                try:
+                    os.remove(lock_path)
+                except FileNotFoundError:
+                    pass
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def put(self, key, df, columns, session_id=None, aggregations=None):
+        """Write a prepared dataset to the store
+
+        :param key:                     Dataset key
+        :type key:                      str
+
+        :param df:                      Prepared data with grid cell id, time columns and grid cell attributes
+        :type df:                       dataframe
+
+        :param columns:                 List of time columns in the data
+        :type columns:                  list
+
+        :param session_id:              Id of the session storing the dataset, which is given the first reference
+        :type session_id:               str
+
+        :param aggregations:            Area aggregations built by build_area_aggregation, keyed by area field.  An
+                                        area x time cube is materialized for each.
+        :type aggregations:             dict
+
+        """
+
+        self.put_chunks(key, [df], len(df), columns, session_id, aggregations)
+
+    def put_chunks(self, key, chunks, n_rows, columns, session_id=None, aggregations=None):
+        """Write a prepared dataset to the store from chunks of rows.  Each chunk's time columns are written straight
+        into the memory mapped values matrix, so only one chunk of the data is held in memory at a time.
+
+        :param key:                     Dataset key
+        :type key:                      str
+
+        :param chunks:                  Prepared data in chunks of rows, each with grid cell id, time columns and
+                                        grid cell attributes
+        :type chunks:                   iterable
+
+        :param n_rows:                  Expected number of rows in all chunks.  The values matrix is allocated for
+                                        this many, grown if the chunks hold more and trimmed if they hold fewer.
+        :type n_rows:                   int
+
+        :param columns:                 List of time columns in the data
+        :type columns:                  list
+
+        :param session_id:              Id of the session storing the dataset, which is given the first reference
+        :type session_id:               str
+
+        :param aggregations:            Area aggregations built by build_area_aggregation, keyed by area field.  An
+                                        area x time cube is materialized for each.
+        :type aggregations:             dict
+
+        """
+
+        # Datasets the root directory hasn't the free space for are written to the overflow directory
+        store_dir = self.root_dir
+        if self.overflow_dir is not None and free_bytes(self.root_dir) < required_bytes(n_rows, len(columns)):
+            store_dir = self.overflow_dir
+
+        # Write to a temporary directory first so a partially written dataset is never read
+        tmp_dir = tempfile.mkdtemp(prefix='.' + key, dir=store_dir)
+        try:
+            values_path = os.path.join(tmp_dir, VALUES_FILE)
+
+            capacity = max(n_rows, 1)
+            values = np.lib.format.open_memmap(values_path, mode='w+', dtype=np.float64,
+                                               shape=(capacity, len(columns)), fortran_order=True)
+
+            # Only the grid cell attributes of each chunk are kept in memory, the matrix doubles in size when the
+            # chunks hold more rows than expected
+            row = 0
+            frames = []
+            for chunk in chunks:
+                if row + len(chunk) > capacity:
+                    capacity = max(2 * capacity, row + len(chunk))
+                    values = _resize_values(values_path, values, row, capacity)
+                values[row:row + len(chunk)] = chunk[columns].to_numpy(dtype=np.float64)
+                row += len(chunk)
+                frames.append(chunk.drop(columns=columns))
+            df = pd.concat(frames, ignore_index=True)
+
+            # Rows skipped by the parser or a grown matrix leave it longer than the data, trim it to the data
+            if row < capacity:
+                values = _resize_values(values_path, values, row, row)
+            values.flush()
+
+            ids = df['id'].to_numpy()
+            np.save(os.path.join(tmp_dir, IDS_FILE), ids)
+            np.save(os.path.join(tmp_dir, ROW_INDEX_FILE), xvu.build_id_index(ids))
+
+            # Range indexes of the grid cell matrix so year range statistics don't read every year in the range
+            months = np.array([int(c[4:6]) if len(c) == 6 else 0 for c in columns])
+            ranges = _save_range_indexes(tmp_dir, 'values', values, months)
+
+            # Sum grid cells to area x time cubes once so area level views never read the grid cell matrix
+            cubes = dict()
+            for area_key, area_aggregation in (aggregations or {}).items():
+                blocks = [xvu.aggregate_by_area(values[:, i:i + COLUMN_BLOCK_SIZE], ids, area_aggregation)
+                          for i in range(0, len(columns), COLUMN_BLOCK_SIZE)]
+                labels, _, area = blocks[0]
+                cube = np.hstack([b[1] for b in blocks])
+                np.save(os.path.join(tmp_dir, CUBE_FILE.format(area_key)), cube)
+                cubes[area_key] = {'labels': labels.tolist(), 'area': area.tolist()}
+                ranges += _save_range_indexes(tmp_dir, area_key, cube, months)
+            del values
+
+            # Write each grid cell attribute, text attributes are written as codes with their labels in the metadata
+            attributes = [c for c in df.columns if c != 'id' and c not in columns]
+            labels = dict()
+            for name in attributes:
+                if not pd.api.types.is_numeric_dtype(df[name]):
+                    codes, uniques = pd.factorize(df[name])
+                    np.save(os.path.join(tmp_dir, name + '.npy'), codes)
+                    labels[name] = uniques.tolist()
+                else:
+                    np.save(os.path.join(tmp_dir, name + '.npy'), df[name].to_numpy())
+
+            # Size of the dataset's arrays, for the store's memory budget
+            n_bytes = sum(entry.stat().st_size for entry in os.scandir(tmp_dir) if entry.is_file())
+
+            meta = {'columns': list(columns), 'attributes': attributes, 'labels': labels, 'cubes': cubes,
+                    'ranges': ranges, 'range_block_size': xrq.RANGE_BLOCK_SIZE,
+                    'month_block_size': xrq.MONTH_BLOCK_SIZE, 'shape': [len(df), len(columns)],
+                    'n_bytes': n_bytes}
+            with open(os.path.join(tmp_dir, META_FILE), 'w') as out:
+                json.dump(meta, out)
+            # Reference the dataset before it is visible so it can't be collected before the session acquires it
+            os.makedirs(os.path.join(tmp_dir, REFS_DIR))
+            if session_id is not None:
+                open(os.path.join(tmp_dir, REFS_DIR, session_id), 'w').close()
+        except BaseException:
+            # Don't leave a partly written dataset behind, in shared memory it holds on to memory until removed
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        # Datasets are content addressed, if another session or worker stored the same file first keep that copy and
+        # reference it instead
+        dataset_dir = self.get_path(key)
+        if not os.path.exists(dataset_dir):
+            dataset_dir = os.path.join(store_dir, key)
+        try:
+            os.replace(tmp_dir, dataset_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if session_id is not None:
+                self.acquire(key, session_id)
+
+        self.evict(keep=key)
+
+    def get(self, key):
+        """Open a dataset from the store
+
+        :param key:                     Dataset key
+        :type key:                      str
+
+        :return:                        Dataset; or None if the dataset is not in the store
+
+        """
+
+        if not self.has(key):
+            return None
+
+        dataset_dir = self.get_path(key)
+        with open(os.path.join(dataset_dir, META_FILE)) as get:
+            meta = json.load(get)
+
+        # The metadata file's modification time records when the dataset was last used, for eviction
+        try:
+            os.utime(os.path.join(dataset_dir, META_FILE))
+        except OSError:
+            pass
+
+        return Dataset(dataset_dir, meta)
+
+    def size(self, key):
+        """Get the size of a stored dataset's files
+
+        :param key:                     Dataset key
+        :type key:                      str
+
+        :return:                        int; size in bytes
+
+        """
+
+        dataset_dir = self.get_path(key)
+        with open(os.path.join(dataset_dir, META_FILE)) as get:
+            meta = json.load(get)
+
+        if 'n_bytes' in meta:
+            return meta['n_bytes']
+
+        return sum(entry.stat().st_size for entry in os.scandir(dataset_dir) if entry.is_file())
+
+    def remove(self, key):
+        """Remove a dataset from the store
+
+        :param key:                     Dataset key
+        :type key:                      str
+
+        """
+
+        shutil.rmtree(self.get_path(key), ignore_errors=True)
+
+    def acquire(self, key, session_id):
+        """Add or renew a session's reference to a dataset
+
+        :param key:                     Dataset key
+        :type key:                      str
+
+        :param session_id:              Id of the session using the dataset
+        :type session_id:               str
+
+        """
+
+        ref_dir = os.path.join(self.get_path(key), REFS_DIR)
+        if os.path.isdir(ref_dir):
+            with open(os.path.join(ref_dir, session_id), 'a'):
+                os.utime(os.path.join(ref_dir, session_id))
+
+    def release(self, key, session_id):
+        """Remove a session's reference to a dataset, removing the dataset if no other session references it
+
+        :param key:                     Dataset key
+        :type key:                      str
+
+        :param session_id:              Id of the session that no longer uses the dataset
+        :type session_id:               str
+
+        """
+
+        ref_file = os.path.join(self.get_path(key), REFS_DIR, session_id)
+        if os.path.exists(ref_file):
+            os.remove(ref_file)
+
+        # With a memory budget unreferenced datasets are kept until space is needed, in case they are used again
+        if self.max_bytes is None and self.has(key) and self.ref_count(key) == 0:
+            self.remove(key)
+
+    def ref_count(self, key):
+        """Count the sessions holding an unexpired reference to a dataset
+
+        :param key:                     Dataset key
+        :type key:                      str
+
+        :return:                        int; number of sessions using the dataset
+
+        """
+
+        ref_dir = os.path.join(self.get_path(key), REFS_DIR)
+        if not os.path.isdir(ref_dir):
+            return 0
+
+        expired = time.time() - self.lease_timeout
+        count = 0
+        for entry in os.scandir(ref_dir):
+            if entry.stat().st_mtime >= expired:
+                count += 1
+
+        return count
+
+    def collect(self):
+        """Remove datasets that no session holds an unexpired reference to, or with a memory budget only as many of
+        them as needed to fit in the budget"""
+
+        self._remove_stale_tmp()
+
+        if self.max_bytes is not None:
+            self.evict()
+            return
+
+        for entry in self._entries():
+            if KEY_PATTERN.fullmatch(entry.name) and self.has(entry.name) and self.ref_count(entry.name) == 0:
+                self.remove(entry.name)
+
+    def _store_dirs(self):
+        """Get the directories datasets are written to, the root directory first"""
+
+        if self.overflow_dir is None or self.overflow_dir == self.root_dir:
+            return [self.root_dir]
+
+        return [self.root_dir, self.overflow_dir]
+
+    def _entries(self):
+        """List the entries of every directory datasets are written to"""
+
+        return [entry for store_dir in self._store_dirs() for entry in os.scandir(store_dir)]
+
+    def _remove_stale_tmp(self):
+        """Remove temporary dataset directories and ingest lock files not written to for longer than the lease timeout,
+        left behind when a worker stopped while storing a dataset.  Those of datasets being stored are recent and
+        kept."""
+
+        expired = time.time() - self.lease_timeout
+        for entry in self._entries():
+            if entry.name.startswith('.') and KEY_PATTERN.match(entry.name[1:]):
+                try:
+                    if entry.stat().st_mtime >= expired:
+                        continue
+                    if entry.is_dir():
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                    else:
+                        os.remove(entry.path)
+                except OSError:
+                    continue
+
+    def evict(self, keep=None):
+        """Remove the least recently used datasets until the store fits in its memory budget.  Datasets a session holds
+        an unexpired reference to are pinned and never evicted, so the store can stay over budget while they are in use.
+
+        :param keep:                    Key of a dataset to never evict, e.g. one that was just stored
+        :type keep:                     str
+
+        """
+
+        if self.max_bytes is None:
+            return
+
+        datasets = []
+        for entry in self._entries():
+            if KEY_PATTERN.fullmatch(entry.name) and self.has(entry.name):
+                try:
+                    last_used = os.stat(os.path.join(entry.path, META_FILE)).st_mtime
+                    datasets.append((last_used, entry.name, self.size(entry.name)))
+                except OSError:
+                    # Removed by another worker since it was listed
+                    continue
+
+        n_bytes = sum(size for _, _, size in datasets)
+        for _, key, size in sorted(datasets):
+            if n_bytes <= self.max_bytes:
+                break
+            if key != keep and self.ref_count(key) == 0:
+                self.remove(key)
+                n_bytes -= size
+
+
+def free_bytes(path):
+    """Get the space free for unprivileged users on the filesystem of a directory, or of its nearest existing parent
+
+    :param path:                    Directory
+    :type path:                     str
+
+    :return:                        int; free bytes
+
+    """
+
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    stat = os.statvfs(path)
+
+    return stat.f_bavail * stat.f_frsize
+
+
+def required_bytes(n_rows, n_columns):
+    """Estimate the space needed to store a dataset: its values matrix and the copy made when it is trimmed or
+    grown, which outweighs the range indexes and area cubes written after it
+
+    :param n_rows:                  Expected number of grid cell rows
+    :type n_rows:                   int
+
+    :param n_columns:               Number of time columns
+    :type n_columns:                int
+
+    :return:                        int; bytes
+
+    """
+
+    return 2 * n_rows * n_columns * np.dtype(np.float64).itemsize
+
+
+def _resize_values(values_path, values, n_rows, capacity):
+    """Copy the first rows of a memory mapped values matrix to a matrix with room for more or fewer rows, replacing
+    its file
+
+    :param values_path:             File of the values matrix
+    :type values_path:              str
+
+    :param values:                  Values matrix opened from the file
+    :type values:                   array
+
+    :param n_rows:                  Number of rows written to the matrix, which are copied
+    :type n_rows:                   int
+
+    :param capacity:                Number of rows of the new matrix
+    :type capacity:                 int
+
+    :return:                        array; new memory mapped values matrix
+
+    """
+
+    n_columns = values.shape[1]
+    resized = np.lib.format.open_memmap(values_path + '.tmp', mode='w+', dtype=np.float64,
+                                        shape=(capacity, n_columns), fortran_order=True)
+    for i in range(0, n_columns, COLUMN_BLOCK_SIZE):
+        resized[:n_rows, i:i + COLUMN_BLOCK_SIZE] = values[:n_rows, i:i + COLUMN_BLOCK_SIZE]
+    os.replace(values_path + '.tmp', values_path)
+
+    return resized
+
+
+def _save_range_indexes(dataset_dir, source, values, months):
+    """Build and write the range indexes of the grid cell matrix or an area cube: one of every time column and, for
+    monthly files, one of each calendar month's columns so month filtered year ranges are answered by combining at
+    most 12 queries.  The month indexes keep only the block min and max to bound their size.
+
+    :param dataset_dir:             Directory the dataset is written to
+    :type dataset_dir:              str
+
+    :param source:                  'values' for the grid cell matrix, or the area field of a cube
+    :type source:                   str
+
+    :param values:                  Rows x time values
+    :type values:                   array
+
+    :param months:                  Calendar month of each time column, 0 for files with yearly time steps
+    :type months:                   array
+
+    :return:                        list; names of the indexes written, for Dataset.read_range_index
+
+    """
+
+    def save(name, range_index):
+        for array_name, array in range_index.items():
+            np.save(os.path.join(dataset_dir, RANGE_FILE.format(name, array_name)), array)
+
+    range_index = xrq.build_range_index(values)
+    save(source, range_index)
+    sources = [source]
+
+    # Month indexes take sums about the same shift so their totals combine
+    for month in np.unique(months[months > 0]):
+        name = MONTH_RANGE_SOURCE.format(source, month)
+        save(name, xrq.build_range_index(values, xrq.MONTH_BLOCK_SIZE, np.flatnonzero(months == month),
+                                         range_index['shift'], max_levels=1))
+        sources.append(name)
+
+    return sources
@@ -0,0 +1,234 @@
+import numpy as np
+
+# Simplification levels as (minimum map zoom, tolerance in degrees).  A tolerance of 0 keeps the full resolution.
+# At zoom 0 a pixel spans about 0.7 degrees, halving with each zoom level.
+GEOMETRY_LEVELS = [(0, 0.2), (2, 0.05), (5, 0.0)]
+
+
+def level_for_zoom(zoom, levels=GEOMETRY_LEVELS):
+    """Get the simplification level to draw at a map zoom
+
+    :param zoom:                    Map zoom
+    :type zoom:                     float
+
+    :param levels:                  Simplification levels as (minimum zoom, tolerance)
+    :type levels:                   list
+
+    :return:                        int; index of the level
+
+    """
+
+    return max(i for i, (min_zoom, tolerance) in enumerate(levels) if zoom >= min_zoom or i == 0)
+
+
+def build_geometry_levels(features, properties=None, levels=GEOMETRY_LEVELS):
+    """Build a simplified copy of geojson spatial data for each simplification level
+
+    :param features:                geojson spatial data
+    :type features:                 dict
+
+    :param properties:              Feature properties to keep, e.g. the field figures match locations on, all if None
+    :type properties:               list
+
+    :param levels:                  Simplification levels as (minimum zoom, tolerance)
+    :type levels:                   list
+
+    :return:                        list of geojson spatial data, one per level
+
+    """
+
+    # Drop properties the figures don't use, they can be most of the payload of simplified geometry
+    if properties is not None:
+        features = dict(features, features=[dict(f, properties={k: f['properties'].get(k) for k in properties})
+                                            for f in features['features']])
+
+    return [simplify_features(features, tolerance) for min_zoom, tolerance in levels]
+
+
+def simplify_features(features, tolerance):
+    """Simplify the polygons of geojson spatial data while preserving topology.  Rings are split into arcs at the
+    vertices where neighboring polygons meet, and each arc is simplified once, so borders shared by two areas are
+    simplified the same way on both sides and no gaps or overlaps open up between them.
+
+    :param features:                geojson spatial data
+    :type features:                 dict
+
+    :param tolerance:               Douglas-Peucker tolerance in degrees, 0 to keep full resolution
+    :type tolerance:                float
+
+    :return:                        geojson spatial data with simplified polygons
+
+    """
+
+    if tolerance <= 0:
+        return features
+
+    rings = [ring for polygon in _iter_polygons(features) for ring in polygon]
+    junctions = _find_junctions(rings)
+
+    # Arcs are cached by their canonical direction so both sides of a border get the same simplified arc
+    arc_cache = dict()
+
+    # Coordinates are rounded to a tenth of the tolerance, shared vertices round the same way on both sides
+    precision = max(0, int(np.ceil(-np.log10(tolerance / 10))))
+
+    def simplify_ring(ring):
+        simplified = _simplify_ring(ring, junctions, tolerance, arc_cache)
+        # Keep tiny rings that would collapse at full resolution so small islands don't disappear
+        if len(simplified) < 4:
+            simplified = ring
+        return [[round(x, precision), round(y, precision)] for x, y in simplified]
+
+    simplified_features = []
+    for feature in features['features']:
+        geometry = feature.get('geometry')
+        if geometry is not None and geometry['type'] == 'Polygon':
+            coordinates = [simplify_ring(ring) for ring in geometry['coordinates']]
+        elif geometry is not None and geometry['type'] == 'MultiPolygon':
+            coordinates = [[simplify_ring(ring) for ring in polygon] for polygon in geometry['coordinates']]
+        else:
+            simplified_features.append(feature)
+            continue
+        simplified_features.append(dict(feature, geometry=dict(geometry, coordinates=coordinates)))
+
+    return dict(features, features=simplified_features)
+
+
+def _iter_polygons(features):
+    """Yield each polygon (list of rings) of geojson spatial data"""
+
+    for feature in features['features']:
+        geometry = feature.get('geometry')
+        if geometry is None:
+            continue
+        if geometry['type'] == 'Polygon':
+            yield geometry['coordinates']
+        elif geometry['type'] == 'MultiPolygon':
+            yield from geometry['coordinates']
+
+
+def _find_junctions(rings):
+    """Find the vertices where rings meet.  A vertex is a junction when it has more than two distinct neighbors over
+    all the rings it is part of, i.e. where a shared border starts, ends or branches."""
+
+    neighbors = dict()
+    for ring in rings:
+        points = [tuple(p) for p in ring[:-1]]
+        for i, point in enumerate(points):
+            neighbors.setdefault(point, set()).update((points[i - 1], points[(i + 1) % len(points)]))
+
+    return {point for point, adjacent in neighbors.items() if len(adjacent) > 2}
+
+
+def _simplify_ring(ring, junctions, tolerance, arc_cache):
+    """Simplify a closed ring arc by arc between its junctions"""
+
+    points = [tuple(p) for p in ring[:-1]]
+    if len(points) < 3:
+        return ring
+
+    # Rings that touch no other ring start at their smallest vertex so a ring repeated in another polygon (such as
+    # an enclave) is split the same way both times
+    cuts = [i for i, point in enumerate(points) if point in junctions]
+    if not cuts:
+        cuts = [points.index(min(points))]
+
+    # Rotate the ring to start at a junction and split it into arcs from junction to junction
+    points = points[cuts[0]:] + points[:cuts[0]]
+    cuts = [c - cuts[0] for c in cuts] + [len(points)]
+    points.append(points[0])
+
+    simplified = [points[0]]
+    for start, end in zip(cuts[:-1], cuts[1:]):
+        simplified.extend(_simplify_arc(points[start:end + 1], tolerance, arc_cache)[1:])
+
+    return [list(p) for p in simplified]
+
+
+def _simplify_arc(arc, tolerance, arc_cache):
+    """Simplify an arc in its canonical direction, caching the result"""
+
+    reverse = arc[::-1]
+    forward = tuple(arc) <= tuple(reverse)
+    key = tuple(arc) if forward else tuple(reverse)
+
+    if key not in arc_cache:
+        points = np.array(key, dtype=np.float64)
+        arc_cache[key] = [key[i] for i in np.flatnonzero(douglas_peucker(points, tolerance))]
+
+    return arc_cache[key] if forward else arc_cache[key][::-1]
+
+
+def points_in_polygon(lon, lat, polygon):
+    """Check which points are inside a polygon, e.g. a lasso selection, by counting the polygon edges a ray from each
+    point crosses
+
+    :param lon:                     Longitude of the points
+    :type lon:                      array
+
+    :param lat:                     Latitude of the points
+    :type lat:                      array
+
+    :param polygon:                 Polygon vertices as [lon, lat] pairs
+    :type polygon:                  list
+
+    :return:                        array; mask of the points inside the polygon
+
+    """
+
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    inside = np.zeros(lon.shape, dtype=bool)
+
+    vertices = np.asarray(polygon, dtype=np.float64)
+    for (x1, y1), (x2, y2) in zip(vertices, np.roll(vertices, -1, axis=0)):
+        # Edges that straddle the point's latitude and cross the ray east of the point
+        straddles = (y1 > lat) != (y2 > lat)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            crossing = x1 + (lat - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= straddles & (lon < crossing)
+
+    return inside
+
+
+def douglas_peucker(points, tolerance):
+    """Find the vertices of a line kept by the Douglas-Peucker algorithm.  The end points are always kept.
+
+    :param points:                  Vertices of the line
+    :type points:                   array
+
+    :param tolerance:               Maximum distance of a dropped vertex from the simplified line
+    :type tolerance:                float
+
+    :return:                        array; mask of the vertices kept
+
+    """
+
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+
+    # Iterative instead of recursive so long lines don't hit the recursion limit
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+
+        inner = points[start + 1:end]
+        direction = points[end] - points[start]
+        length = np.hypot(direction[0], direction[1])
+
+        # Distance from the segment's line, or from the start point when the segment is closed
+        offset = inner - points[start]
+        if length == 0:
+            distance = np.hypot(offset[:, 0], offset[:, 1])
+        else:
+            distance = np.abs(direction[0] * offset[:, 1] - direction[1] * offset[:, 0]) / length
+
+        i = int(np.argmax(distance))
+        if distance[i] > tolerance:
+            split = start + 1 + i
+            keep[split] = True
+            stack.extend([(start, split), (split, end)])
+
+    return keep
@@ -0,0 +1,245 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+import traceback
+
+# States of a job, in the order a job goes through them
+JOB_STATES = ('queued', 'running', 'done', 'error')
+
+# Files of a job in the queue's directory
+STATUS_FILE = '{}.json'
+RESULT_FILE = '{}.result'
+
+
+class JobQueue:
+    """Run long computations in a pool of local processes instead of the request thread, so requests a worker answers
+    while a job runs aren't held up by it.  Each job has an id the browser polls with, its status and progress are
+    written to a file in the queue's directory and its result next to it, so any worker on the host can answer a poll
+    and identical jobs submitted by several workers run once.
+
+    The pool is started on the first submit in each process, so under gunicorn --preload it belongs to the worker that
+    submits to it rather than the master.
+
+    :param root_dir:                Directory job status and results are written to
+    :type root_dir:                 str
+
+    :param max_workers:             Number of processes in each worker's pool
+    :type max_workers:              int
+
+    :param job_timeout:             Seconds a job's result is kept after it was last updated
+    :type job_timeout:              int
+
+    :param stale_timeout:           Seconds without a status update after which a queued or running job is reported
+                                    as failed, e.g. when the worker running it was restarted
+    :type stale_timeout:            int
+
+    """
+
+    def __init__(self, root_dir, max_workers=2, job_timeout=6000, stale_timeout=900):
+
+        self.root_dir = root_dir
+        self.max_workers = max_workers
+        self.job_timeout = job_timeout
+        self.stale_timeout = stale_timeout
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+
+        os.makedirs(root_dir, exist_ok=True)
+
+    @staticmethod
+    def job_id(*args):
+        """Build a job id from the inputs of a computation, the same inputs give the same id
+
+        :param args:                    JSON serializable inputs
+        :type args:                     list
+
+        :return:                        str; job id
+
+        """
+
+        return hashlib.sha1(json.dumps(args, sort_keys=True, default=str).encode()).hexdigest()
+
+    def submit(self, job_id, fn, *args):
+        """Run a function in the pool unless a job with the same id is queued, running or done.  The function is
+        called as fn(*args, progress=progress), where progress(fraction, message) reports how far along it is, and
+        runs in another process: it and its arguments must be picklable, and it must return a picklable result.
+
+        :param job_id:                  Job id, from job_id
+        :type job_id:                   str
+
+        :param fn:                      Module level function to run
+        :type fn:                       function
+
+        :param args:                    Arguments of the function
+        :type args:                     list
+
+        :return:                        str; job id
+
+        """
+
+        # The status file is created exclusively, only the first worker to submit a job runs it
+        status_path = self._path(STATUS_FILE, job_id)
+        try:
+            fd = os.open(status_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            status = self.status(job_id)
+            if status is None or status['state'] != 'error':
+                return job_id
+            self.remove(job_id)
+            return self.submit(job_id, fn, *args)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(_status('queued', 0, ''), f)
+
+        try:
+            self._get_executor().submit(_run, self.root_dir, job_id, fn, args)
+        except concurrent.futures.BrokenExecutor:
+            # A process of the pool died, start a new pool
+            with self._lock:
+                self._executor = None
+            self._get_executor().submit(_run, self.root_dir, job_id, fn, args)
+
+        return job_id
+
+    def status(self, job_id):
+        """Get the status of a job
+
+        :param job_id:                  Job id
+        :type job_id:                   str
+
+        :return:                        dict; state (one of JOB_STATES), progress from 0 to 1 and a message, the
+                                        error for failed jobs, or None if there is no such job
+
+        """
+
+        status_path = self._path(STATUS_FILE, job_id)
+        try:
+            with open(status_path) as f:
+                status = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            # The status is being written by the worker that claimed the job
+            return _status('queued', 0, '')
+
+        if status['state'] in ('queued', 'running') and time.time() - status['updated'] > self.stale_timeout:
+            return _status('error', status['progress'], 'The job stopped before it finished.')
+
+        return status
+
+    def result(self, job_id):
+        """Get the result of a finished job
+
+        :param job_id:                  Job id
+        :type job_id:                   str
+
+        :return:                        Value returned by the job's function, None if the job isn't done
+
+        """
+
+        try:
+            with open(self._path(RESULT_FILE, job_id), 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+
+    def remove(self, job_id):
+        """Remove a job's status and result
+
+        :param job_id:                  Job id
+        :type job_id:                   str
+
+        """
+
+        for name in (RESULT_FILE, STATUS_FILE):
+            try:
+                os.remove(self._path(name, job_id))
+            except FileNotFoundError:
+                pass
+
+    def collect(self):
+        """Remove the status and results of jobs not updated for longer than the job timeout, and files left by jobs
+        that stopped while writing them
+
+        :return:                        int; number of jobs removed
+
+        """
+
+        removed = 0
+        expired = time.time() - self.job_timeout
+        for name in os.listdir(self.root_dir):
+            try:
+                if os.path.getmtime(os.path.join(self.root_dir, name)) < expired:
+                    os.remove(os.path.join(self.root_dir, name))
+                    removed += name.endswith('.json')
+            except FileNotFoundError:
+                pass
+
+        return removed
+
+    def shutdown(self):
+        """Stop this process's pool, waiting for its running jobs"""
+
+        with self._lock:
+            if self._executor is not None and self._executor_pid == os.getpid():
+                self._executor.shutdown()
+            self._executor = None
+
+    def _get_executor(self):
+        """Get this process's pool, starting it if it isn't started.  A pool inherited from a parent process by fork
+        can't be used and is replaced."""
+
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers)
+                self._executor_pid = os.getpid()
+
+            return self._executor
+
+    def _path(self, name, job_id):
+        """Get the path of a file of a job"""
+
+        return os.path.join(self.root_dir, name.format(job_id))
+
+
+def _status(state, progress, message):
+    """Build a job status"""
+
+    return {'state': state, 'progress': progress, 'message': message, 'updated': time.time()}
+
+
+def _write_status(root_dir, job_id, state, progress, message):
+    """Replace a job's status file, readers see the old or the new status"""
+
+    status_path = os.path.join(root_dir, STATUS_FILE.format(job_id))
+    tmp_path = f"{status_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(_status(state, progress, message), f)
+    os.replace(tmp_path, status_path)
+
+
+def _run(root_dir, job_id, fn, args):
+    """Run a job in a process of the pool, recording its progress, result or error"""
+
+    def progress(fraction, message=''):
+        _write_status(root_dir, job_id, 'running', fraction, message)
+
+    progress(0)
+    try:
+        result = fn(*args, progress=progress)
+    except Exception as e:
+        traceback.print_exc()
+        _write_status(root_dir, job_id, 'error', 0, str(e))
+        return
+
+    # The result is in place before the job is marked done
+    result_path = os.path.join(root_dir, RESULT_FILE.format(job_id))
+    tmp_path = f"{result_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, result_path)
+    _write_status(root_dir, job_id, 'done', 1, '')
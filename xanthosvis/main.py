@@ -1,18 +1,23 @@
 # -*- coding: utf-8 -*-
-import json
+import gc
 import os
+import threading
 import uuid
 
 import dash
 import dash_core_components as dcc
 import dash_daq as daq
 import dash_html_components as html
-import pandas as pd
-import seaborn as sns
-from dash.dependencies import Input, Output, State
+from dash.dependencies import ClientsideFunction, Input, Output, State
 from dash.exceptions import PreventUpdate
+from flask import Response, abort, jsonify, request
 from flask_caching import Cache
 
+import xanthosvis.dataset_store as xds
+import xanthosvis.job_queue as xjq
+import xanthosvis.raster as xvr
+import xanthosvis.reference_bundle as xrb
+import xanthosvis.reference_index as xri
 import xanthosvis.util_functions as xvu
 
 # ----- Define init options and system configuration
@@ -22,14 +27,40 @@ app = dash.Dash(__name__, external_stylesheets=['assets/base.css', 'assets/custo
                 meta_tags=[{"name": "viewport", "content": "width=device-width"}], suppress_callback_exceptions=True,
                 compress=False)
 
-# Set up disk based cache with 100 min timeout
+# Set up disk based cache with 100 min timeout, shared by all workers and pruned once it holds too many entries
 cache = Cache(app.server, config={
     'CACHE_TYPE': 'filesystem',
     'CACHE_DIR': 'cache-directory',
-    "CACHE_DEFAULT_TIMEOUT": 6000
+    "CACHE_DEFAULT_TIMEOUT": 6000,
+    'CACHE_THRESHOLD': 500
 })
 server = app.server
 root_dir = 'include/'
+
+# Uploaded files are streamed to disk here by the upload endpoint until they are ingested
+upload_dir = 'upload-directory'
+
+# Prepared datasets are stored here as memory mapped arrays, keyed by the hash of the uploaded file.  The store is in
+# shared memory where the host has it, so every worker maps the same copy of a dataset, datasets it hasn't the free
+# space for are written to disk instead.  A session's reference to a dataset lasts for 100 minutes without use, and
+# datasets no session references are evicted least recently used first once the store grows past its budget: the
+# XANTHOSVIS_DATASET_BUDGET environment variable in bytes if it is set, otherwise half the space free in the store's
+# filesystem when the app starts
+dataset_dir = xds.shared_store_dir('xanthosvis-datasets', 'dataset-directory')
+dataset_budget = int(os.environ.get('XANTHOSVIS_DATASET_BUDGET') or xds.free_bytes(dataset_dir) // 2)
+dataset_store = xds.DatasetStore(dataset_dir, lease_timeout=6000, max_bytes=dataset_budget,
+                                 overflow_dir='dataset-directory')
+
+# Rendered map tiles of the grid view, and the grid cell values they are colored from, kept up to a size limit
+tile_cache = xvr.ByteLRUCache(64 * 1024 * 1024)
+tile_grid_cache = xvr.ByteLRUCache(32 * 1024 * 1024)
+
+# Grid views whose statistic reads more values than this, e.g. the median of every grid cell over many years, are
+# computed as jobs in a pool of local processes while the browser polls for the figure, so the worker stays free to
+# answer other requests.  Job status and results are kept on disk, so a poll can be answered by any worker
+job_min_values = 20000000
+job_queue = xjq.JobQueue('job-directory', max_workers=2, job_timeout=6000)
+
 config = {'displaylogo': False, 'toImageButtonOptions': {
     'format': 'svg',  # one of png, svg, jpeg, webp
     'filename': 'custom_image',
@@ -38,13 +69,10 @@ config = {'displaylogo': False, 'toImageButtonOptions': {
     'scale': 1  # Multiply title/legend/axis/canvas sizes by this factor
 }}
 
-# Clear cache on load, don't want old files lingering
-cache.clear()
 # Access Token for Mapbox
 mapbox_token = open("include/mapbox-token").read()
 
 # Misc Options
-sns.set()
 group_colors = {"control": "light blue", "reference": "red"}
 colors = {
     'background': '#111111',
@@ -56,20 +84,42 @@ colors = {
 
 # ----- Reference Files & Global Vars
 
-# reference file to be included in the package data for mapping cells to basins
-gridcell_ref_file = os.path.join(root_dir, 'reference', 'xanthos_0p5deg_landcell_reference.csv')
+# Reference data and the indexes built from it, loaded by load_reference.  Under gunicorn --preload it is loaded once
+# in the master process by create_app and shared copy-on-write by the workers, otherwise on the first request.
+reference_bundle = None
+geojson_urls = None
+ref_index = None
+reference_lock = threading.Lock()
+
+
+def load_reference():
+    """Load the reference data and build the indexes the callbacks use, if they aren't loaded yet"""
+
+    global reference_bundle, geojson_urls, ref_index
+
+    # Requests after the data is loaded don't take the lock.  The job pool is forked by a request once the data is
+    # loaded, so a job process never waits on a lock held by another thread of the worker when it was forked
+    if ref_index is not None:
+        return
+
+    with reference_lock:
+        if ref_index is not None:
+            return
 
-# read in reference file to dataframe
-df_ref = pd.read_csv(gridcell_ref_file)
+        # Reference files are compiled once into a bundle of typed arrays and served geometry, rebuilt when they
+        # change.  Each boundary set is simplified to several levels that figures pick from by zoom, and served from
+        # cacheable URLs that figures reference instead of embedding the geometry in every response
+        reference_dir = os.path.join(root_dir, 'reference')
+        reference_bundle = xrb.load_bundle(reference_dir, os.path.join(reference_dir, 'bundle'))
 
-# reference geojson file for basins
-basin_json = os.path.join(root_dir, 'reference', 'gcam_basins.geojson')
-basin_features = xvu.process_geojson(basin_json)
+        # URLs of each simplification level of the basin and country geometry
+        geojson_urls = {'basins': reference_bundle.geojson_urls('basins'),
+                        'countries': reference_bundle.geojson_urls('countries')}
+
+        # Read only index of grid cell, basin and country membership, names, area totals and extents that callbacks
+        # look reference data up in, set last as it marks the data as loaded
+        ref_index = xri.ReferenceIndex(reference_bundle.read_df_ref())
 
-# World reference file for viewing by country
-world_json = os.path.join(root_dir, 'reference', 'world.geojson')
-with open(world_json, encoding='utf-8-sig', errors='ignore') as get:
-    country_features = json.load(get)
 
 # Available Runoff Statistic for the Choropleth Map
 acceptable_statistics = [{'label': 'Mean', 'value': 'mean'}, {'label': 'Median', 'value': 'median'},
@@ -86,6 +136,21 @@ app.layout = html.Div(
         # Data stores that store a key value for the cache and a select store for remembering selections/persistence
         dcc.Store(id="select_store"),
         dcc.Store(id="data_store", storage_type='memory'),
+        # Handle returned by the upload endpoint, set by the clientside upload script
+        dcc.Store(id="upload_store", storage_type='memory'),
+        html.Button(id="upload_trigger", n_clicks=0, style={'display': 'none'}),
+        # Grid cell clicked on the grid image, set by the clientside grid image script
+        dcc.Store(id="grid_click_store", storage_type='memory'),
+        html.Button(id="grid_click_trigger", n_clicks=0, style={'display': 'none'}),
+        # Grid cell marker size last set in the browser when the map zooms
+        dcc.Store(id="marker_size_store", storage_type='memory'),
+        # Geometry level last drawn in the browser when the map zooms
+        dcc.Store(id="geometry_level_store", storage_type='memory'),
+        # Number of areas last selected in the browser
+        dcc.Store(id="select_view_store", storage_type='memory'),
+        # Choropleth job being computed, polled by the interval until its figure is ready
+        dcc.Store(id="job_store", storage_type='memory'),
+        dcc.Interval(id="job_interval", interval=1000, disabled=True),
         dcc.ConfirmDialog(
             id='confirm',
             message='Your data has timed out. Please reload.',
@@ -127,10 +192,12 @@ app.layout = html.Div(
                                     children=[
                                         html.H6("Data Upload (File Types: .csv, zipped .csv)"),
                                         dcc.Loading(id='file_loader', children=[
-                                            dcc.Upload(
+                                            # Files dropped or selected here are posted to the upload endpoint by
+                                            # clientside.js so they are written to disk instead of held in memory
+                                            html.Div(
                                                 id='upload-data',
                                                 className="loader",
-                                                children=html.Div([
+                                                children=html.Div(id='upload-text', children=[
                                                     'Drag and Drop or ',
                                                     html.A('Select Files')
                                                 ]),
@@ -141,10 +208,9 @@ app.layout = html.Div(
                                                     'borderWidth': '1px',
                                                     'borderStyle': 'dashed',
                                                     'borderRadius': '5px',
-                                                    'textAlign': 'center'
-                                                },
-                                                # Allow multiple files to be uploaded
-                                                multiple=True
+                                                    'textAlign': 'center',
+                                                    'cursor': 'pointer'
+                                                }
                                             )]),
 
                                     ],
@@ -360,9 +426,9 @@ app.layout = html.Div(
 
                                 dcc.Tab(label='Output', value='output_tab', className='custom-tab',
                                         selected_className='custom-tab--selected', children=[
-                                        html.Div(
-                                            children=[
-                                            ]),
+                                        html.Div(id='job_status',
+                                                 children=[
+                                                 ]),
                                         dcc.Loading(id='choro_loader', children=[
                                             dcc.Graph(
                                                 id='choro_graph', figure={
@@ -393,44 +459,489 @@ app.layout = html.Div(
 
 # ----- End HTML Components
 
+# ----- Server Endpoints
+
+# Make sure the reference data is loaded when the app is served without create_app
+server.before_request(load_reference)
+
+
+@server.route('/upload', methods=['POST'])
+def upload_file():
+    """Write an uploaded data file to disk and return a dataset handle that callbacks carry instead of the contents
+
+       :return:                         JSON dataset handle, or an error message with a 400 status
+
+    """
+    file_storage = request.files.get('file')
+    if file_storage is None or file_storage.filename == '':
+        return jsonify({'error': 'No file was uploaded.'}), 400
+
+    try:
+        handle = xds.save_upload(file_storage, upload_dir)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify(handle)
+
+
+@server.route('/geojson/<name>.json')
+def serve_geojson(name):
+    """Serve basin or country geometry with long lived cache headers, gzip compressed when the browser accepts it
+
+       :param name:                     Name of the geometry and level, e.g. basins-0
+       :type name:                      str
+
+       :return:                         geojson response, or 304 if the browser's copy is current
+
+    """
+    etag = reference_bundle.geojson_etag(name)
+    if etag is None:
+        abort(404)
+
+    # Each encoding is a different representation so it gets its own ETag
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response = Response(reference_bundle.read_geojson(name, compressed=True), mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(etag + '-gzip')
+    else:
+        response = Response(reference_bundle.read_geojson(name), mimetype='application/json')
+        response.set_etag(etag)
+
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.cache_control.public = True
+    response.cache_control.max_age = 31536000
+
+    return response.make_conditional(request)
+
+
+@server.route('/grid-cell')
+def grid_cell():
+    """Look up the grid cell at a map coordinate, for hover and click on the grid image which has no points
+
+       :return:                         JSON customdata and names of the cell, or 404 if there is no cell there
+
+    """
+    try:
+        info = xvu.lookup_cell_info(ref_index, float(request.args['lon']), float(request.args['lat']))
+    except (KeyError, ValueError):
+        abort(400)
+
+    if info is None:
+        abort(404)
+
+    return jsonify(info)
+
+
+@server.route('/tiles/<key>/<int:z>/<int:x>/<int:y>.png')
+def grid_tile(key, z, x, y):
+    """Render a map tile of a dataset's grid cell values, for the grid view's tile layer.  The statistic, years,
+    months, units and color range are query parameters, see xanthosvis.util_functions.build_tile_url.
+
+       :param key:                      Key of the stored dataset
+       :type key:                       str
+
+       :param z:                        Tile zoom
+       :type z:                         int
+
+       :param x:                        Tile column from the west
+       :type x:                         int
+
+       :param y:                        Tile row from the north
+       :type y:                         int
+
+       :return:                         PNG response, 400 on bad parameters, or 404 if there is no such tile or dataset
+
+    """
+    if z > xvr.MAX_TILE_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        abort(404)
+
+    try:
+        dataset = dataset_store.get(key)
+        args = request.args
+        months = [m for m in args.get('months', '').split(',') if m]
+        statistic, start, end = args['statistic'], args['start'], args['end']
+        units, file_units = args['units'], args['file_units']
+        cmin, cmax = float(args['cmin']), float(args['cmax'])
+    except (KeyError, ValueError):
+        abort(400)
+
+    if dataset is None:
+        abort(404)
+
+    grid_key = tile_grid_key(key, statistic, start, end, months, units, file_units)
+    tile_key = grid_key + (cmin, cmax, z, x, y)
+    png = tile_cache.get(tile_key)
+    if png is None:
+        # Tiles of the same view share the grid cell values, they are computed once for all of them.  The job or
+        # request that built the view's figure saved them, otherwise the first tile request computes and saves them
+        # while the view's other tile requests wait for it
+        def compute_grid():
+            grid_file = tile_grid_file(grid_key)
+            grid = xvr.load_value_grid(grid_file)
+            if grid is None:
+                grid = xvu.build_tile_grid(dataset, ref_index, statistic, start, end, months, file_units, units)
+                xvr.save_value_grid(grid_file, grid)
+            return grid, grid.nbytes
+
+        try:
+            grid = tile_grid_cache.get_or_compute(grid_key, compute_grid)
+        except ValueError:
+            abort(400)
+
+        png = xvr.encode_png(xvr.render_tile(grid, z, x, y, cmin, cmax, xvu.GRID_COLOR_LUT))
+        tile_cache.put(tile_key, png, len(png))
+
+    # A dataset key always refers to the same data, so tiles don't change for the same URL
+    response = Response(png, mimetype='image/png')
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
+
+    return response
+
+
+def tile_grid_key(key, statistic, start, end, months, units, file_units):
+    """Build the key of the grid cell values of a grid view drawn by map tiles
+
+       :param key:                      Key of the stored dataset
+       :type key:                       str
+
+       :param statistic:                Chosen statistic to run on data
+       :type statistic:                 str
+
+       :param start:                    Start year value
+       :type start:                     str
+
+       :param end:                      End year value
+       :type end:                       str
+
+       :param months:                   List of selected months if available
+       :type months:                    list
+
+       :param units:                    Units chosen by the user
+       :type units:                     str
+
+       :param file_units:               Unit type of the file
+       :type file_units:                str
+
+       :return:                         tuple; grid key
+
+    """
+    return key, statistic, start, end, tuple(months or []), units, file_units
+
+
+def tile_grid_file(grid_key):
+    """Get the file the grid cell values of a grid view are saved to, next to the choropleth jobs so they're removed
+    with them and any worker can load them
+
+       :param grid_key:                 Key built by tile_grid_key
+       :type grid_key:                  tuple
+
+       :return:                         str; file path
+
+    """
+    return os.path.join(job_queue.root_dir, f"grid-{xjq.JobQueue.job_id(*grid_key)}.npy")
+
+
+# ----- End Server Endpoints
+
 # ----- Dash Callbacks
 
-# @app.callback(Output('choro_graph', 'extendData'),
-#               [Input('choro_graph', "relayoutData")],
-#               [State("grid_toggle", "on"), State("select_store", 'data'),
-#                State("choro_graph", "figure")],
-#               )
-# def update_markers(relay_data, toggle_value, store_state, fig_info):
-#     print("in update markers")
-#     click_value = dash.callback_context.triggered[0]['value']
-#     click_info = dash.callback_context.triggered[0]['prop_id']
-#     if click_info == 'choro_graph.relayoutData':
-#         if type(click_value).__name__ == 'dict' and 'mapbox.zoom' in click_value.keys() and toggle_value is True:
-#             choro_data = copy.deepcopy(fig_info['data'])
-#             choro_data[0]['marker']['size'] = click_value['mapbox.zoom'] * 4
-#             # fig_info['data'][0]['radius'] = math.ceil(click_value['mapbox.zoom'] * 3 + 1) mapbox={'zoom': 0.6}
-#             return choro_data
-#         elif click_value != {'autosize': True}:
-#             print("HERE")
-#             print(click_value)
-#             raise PreventUpdate
+# Pass the handle of a finished upload from the clientside upload script into the Dash upload store
+app.clientside_callback(
+    ClientsideFunction(namespace='clientside', function_name='upload_handle'),
+    Output("upload_store", "data"),
+    [Input("upload_trigger", "n_clicks")],
+    prevent_initial_call=True
+)
+
+# Pass a click on the grid image from the clientside grid image script into the grid click store
+app.clientside_callback(
+    ClientsideFunction(namespace='clientside', function_name='grid_click'),
+    Output("grid_click_store", "data"),
+    [Input("grid_click_trigger", "n_clicks")],
+    prevent_initial_call=True
+)
+
+# Resize the grid cell markers when the map zooms, the figure is restyled in the browser so zooming never reaches the
+# server
+app.clientside_callback(
+    ClientsideFunction(namespace='clientside', function_name='marker_size'),
+    Output("marker_size_store", "data"),
+    [Input("choro_graph", "relayoutData")],
+    [State("grid_toggle", "on")],
+    prevent_initial_call=True
+)
+
+# Draw the area choropleth with the geometry level of the map zoom, the figure is restyled in the browser and the
+# geometry of each level is fetched from its cached URL
+app.clientside_callback(
+    ClientsideFunction(namespace='clientside', function_name='geometry_level'),
+    Output("geometry_level_store", "data"),
+    [Input("choro_graph", "relayoutData")],
+    prevent_initial_call=True
+)
+
+# Filter the area choropleth to a selection in the browser, update_choro only remembers the selection
+app.clientside_callback(
+    ClientsideFunction(namespace='clientside', function_name='select_areas'),
+    Output("select_view_store", "data"),
+    [Input("choro_graph", "selectedData")],
+    [State("grid_toggle", "on")],
+    prevent_initial_call=True
+)
+
+
+def build_choro_figure(dataset, click_info, selected_data, months, toggle_value, start, end, statistic, year_list,
+                       store_state, file_info, filename, area_type, units, tile_url, grid_file, progress=None):
+    """Build the choropleth figure for the type of click event, see update_choro
+
+       :param dataset:                  Stored dataset
+       :type dataset:                   Dataset
+
+       :param click_info:               Property that triggered the callback
+       :type click_info:                str
+
+       :param selected_data             Area select event data for the choropleth graph
+       :type selected_data              dict
+
+       :param months                    List of selected months if available
+       :type months                     list
+
+       :param toggle_value              Value of grid toggle switch
+       :type toggle_value               int
+
+       :param start                     Start year value
+       :type start                      str
+
+       :param end                       End year value
+       :type end                        str
+
+       :param statistic                 Chosen statistic to run on data
+       :type statistic                  str
+
+       :param year_list                 List of years to process
+       :type year_list                  list
+
+       :param store_state               Remembered selection
+       :type store_state                dict
+
+       :param file_info                 Units information of the uploaded file
+       :type file_info                  list
+
+       :param filename                  Name of uploaded file
+       :type filename                   list
+
+       :param area_type                 Type of area (gcam or country)
+       :type area_type                  str
+
+       :param units                     Units chosen by the user
+       :type units                      str
+
+       :param tile_url                  Tile URL template of the grid, to draw the whole grid from map tiles
+       :type tile_url                   str
+
+       :param grid_file                 File the grid cell values drawn by the map tiles are saved to, see
+                                        tile_grid_file
+       :type grid_file                  str
+
+       :param progress                  Optional function called with the fraction of grid cells computed so far
+       :type progress                   function
+
+       :return:                         Grid toggle value, selection data, Choropleth figure
+
+       """
+    # Determine if viewing by country or basin to set up data calls
+    df_per_area = None
+    if area_type == "gcam":
+        if toggle_value is False:
+            df_per_area = xvu.data_per_basin(dataset, statistic, year_list, ref_index, months, filename, units)
+            df_per_area['var'] = round(df_per_area['var'], 2)
+        features = geojson_urls['basins']
+    else:
+        if toggle_value is False:
+            df_per_area = xvu.data_per_country(dataset, statistic, year_list, ref_index, months, filename, units)
+            df_per_area['var'] = round(df_per_area['var'], 2)
+        features = geojson_urls['countries']
+
+    # If the user clicked the reset button then reset graph selection store data to empty
+    if click_info == 'reset_btn.n_clicks':
+        if area_type == "gcam":
+            df_per_area = xvu.data_per_basin(dataset, statistic, year_list, ref_index, months, filename, units)
+        else:
+            df_per_area = xvu.data_per_country(dataset, statistic, year_list, ref_index, months, filename, units)
+        df_per_area['var'] = round(df_per_area['var'], 2)
+        fig = xvu.plot_choropleth(df_per_area, features, mapbox_token, statistic, start, end, file_info, months,
+                                  area_type, units, ref_index=ref_index)
+        store_state = None
+        return False, store_state, fig
+
+    # Generate figure based on type of click data (click, area select, or initial load)
+    if selected_data is not None and click_info == 'choro_graph.selectedData':
+        store_state = selected_data
+        # Selections over the grid image have no points, the grid view selects cells by the selected region
+        if len(selected_data['points']) == 0 and toggle_value is not True:
+            fig = xvu.plot_choropleth(df_per_area, features, mapbox_token, statistic, start, end, file_info,
+                                      months, area_type, units, ref_index=ref_index)
+        else:
+            if toggle_value is True:
+                fig = xvu.update_choro_grid(ref_index, dataset, features, year_list, mapbox_token, selected_data,
+                                            start, end, statistic, file_info, months, area_type, units, filename,
+                                            tile_url, progress, grid_file)
+            else:
+                fig = xvu.update_choro_select(ref_index, df_per_area, features, year_list, mapbox_token,
+                                              selected_data, start, end, statistic, file_info, months, area_type,
+                                              units)
+    elif click_info == "grid_toggle.on":
+        if store_state is None:
+            selected_data = None
+        if toggle_value is True:
+            fig = xvu.update_choro_grid(ref_index, dataset, features, year_list, mapbox_token, selected_data,
+                                        start, end, statistic, file_info, months, area_type, units, filename,
+                                        tile_url, progress, grid_file)
+        else:
+            fig = xvu.update_choro_select(ref_index, df_per_area, features, year_list, mapbox_token,
+                                          selected_data, start, end, statistic, file_info, months, area_type, units)
+    else:
+        if store_state is None:
+            selected_data = None
+        if selected_data is not None and len(selected_data['points']) != 0:
+            if toggle_value is True:
+                fig = xvu.update_choro_grid(ref_index, dataset, features, year_list, mapbox_token, selected_data,
+                                            start, end, statistic, file_info, months, area_type, units, filename,
+                                            tile_url, progress, grid_file)
+            else:
+                fig = xvu.update_choro_select(ref_index, df_per_area, features, year_list, mapbox_token,
+                                              selected_data, start, end, statistic, file_info, months, area_type,
+                                              units)
+        else:
+            if toggle_value is True:
+                fig = xvu.update_choro_grid(ref_index, dataset, features, year_list, mapbox_token, selected_data,
+                                            start, end, statistic, file_info, months, area_type, units, filename,
+                                            tile_url, progress, grid_file)
+            else:
+                fig = xvu.plot_choropleth(df_per_area, features, mapbox_token, statistic, start, end,
+                                          file_info, months, area_type, units, ref_index=ref_index)
+
+    return toggle_value, store_state, fig
+
+
+def run_choro_job(data_id, click_info, selected_data, months, toggle_value, start, end, statistic, year_list,
+                  store_state, file_info, filename, area_type, units, tile_url, grid_file, progress):
+    """Build the choropleth figure in a process of the job pool, see build_choro_figure.  The dataset is opened by its
+    key, the session that submitted the job holds a lease on it.  The grid cell values of a view drawn by map tiles
+    are saved before the job is done, so the tile requests that follow load them instead of computing them again.
+
+       :param data_id:                  Key of the dataset in the dataset store
+       :type data_id:                   str
+
+       :param progress:                 Function called with the fraction of the job done and a message
+       :type progress:                  function
+
+       :return:                         Grid toggle value, selection data, Choropleth figure
+
+       """
+    # Processes not forked from a loaded worker load the reference data themselves
+    load_reference()
+
+    dataset = dataset_store.get(data_id)
+    if dataset is None:
+        raise ValueError("Your data has timed out. Please reload.")
+
+    # Computing the statistic of each grid cell is most of the job, drawing the figure the rest
+    message = f"Computing the {statistic} of each grid cell"
+    progress(0, message)
+
+    return build_choro_figure(dataset, click_info, selected_data, months, toggle_value, start, end, statistic,
+                              year_list, store_state, file_info, filename, area_type, units, tile_url, grid_file,
+                              lambda fraction: progress(0.9 * fraction, message))
+
+
+def job_progress(status):
+    """Build the progress message of a choropleth job
+
+       :param status:                   Job status from the job queue
+       :type status:                    dict
+
+       :return:                         Progress message components
+
+       """
+    if status['state'] == 'error':
+        return [html.Div(className="alert", children=[status['message']])]
+
+    message = status['message'] or "Waiting for the computation to start"
+
+    return [html.Div(children=[f"{message}: {round(100 * status['progress'])}%"])]
+
+
+def poll_choro_job(job_state):
+    """Answer a poll of a choropleth job, swapping its figure in once it is done
+
+       :param job_state:                Job being polled, as stored by update_choro
+       :type job_state:                 dict
+
+       :return:                         update_choro outputs
+
+       """
+    if job_state is None:
+        raise PreventUpdate
+
+    status = job_queue.status(job_state['id'])
+    if status is not None and status['state'] == 'done':
+        result = job_queue.result(job_state['id'])
+        if result is not None:
+            toggle_value, store_state, fig = result
+            return 'output_tab', toggle_value, store_state, False, fig, None, True, []
+
+    # The job's files are removed once it is no longer polled, a job missing here was removed or its result expired
+    if status is None or status['state'] == 'done':
+        status = {'state': 'error', 'progress': 0, 'message': 'The computation stopped, please click "Load Data".'}
+
+    # Stop polling a failed job, keep polling a queued or running one
+    if status['state'] == 'error':
+        return dash.no_update, dash.no_update, dash.no_update, False, dash.no_update, None, True, job_progress(status)
+
+    return (dash.no_update, dash.no_update, dash.no_update, False, dash.no_update, dash.no_update, dash.no_update,
+            job_progress(status))
+
+
+def is_job_poll():
+    """Check if the choropleth callback was triggered by the job poll interval, polls aren't answered from the cache
+
+       :return:                         bool; True for a poll
+
+       """
+    return dash.callback_context.triggered[0]['prop_id'] == 'job_interval.n_intervals'
+
+
+def is_figure_response(outputs):
+    """Check if the choropleth callback answered with its figure rather than a job to poll.  Only figures are cached,
+    so a job whose result has been removed is submitted again.
+
+       :param outputs:                  Outputs of update_choro
+       :type outputs:                   tuple
+
+       :return:                         bool; True if the outputs can be cached
+
+       """
+    return outputs[5] is None
 
 
 # Callback to generate and load the choropleth graph when user clicks load data button, reset button, or selects
-# content in the graph for filterinxg
+# content in the graph for filterinxg.  Long grid views are submitted as jobs and polled by the job interval
 
 @app.callback([Output("tabs", "value"), Output("grid_toggle", "on"),
-               Output("select_store", 'data'), Output('confirm', 'displayed'), Output("choro_graph", "figure")],
-              [Input("submit_btn", 'n_clicks'), Input("reset_btn", 'n_clicks'), Input("choro_graph", "selectedData")],
-              [State("months_select", "value"), State("grid_toggle", "on"), State("upload-data", "contents"),
-               State("upload-data", "filename"), State("upload-data", "last_modified"), State("start_year", "value"),
+               Output("select_store", 'data'), Output('confirm', 'displayed'), Output("choro_graph", "figure"),
+               Output("job_store", "data"), Output("job_interval", "disabled"), Output("job_status", "children")],
+              [Input("submit_btn", 'n_clicks'), Input("reset_btn", 'n_clicks'), Input("choro_graph", "selectedData"),
+               Input("job_interval", "n_intervals")],
+              [State("months_select", "value"), State("grid_toggle", "on"), State("start_year", "value"),
                State("through_year", "value"), State("statistic", "value"), State("choro_graph", "figure"),
                State("through_year", "options"), State("select_store", 'data'), State("data_store", 'data'),
-               State("area_select", "value"), State("units", "value")],
+               State("area_select", "value"), State("units", "value"), State("job_store", "data")],
               prevent_initial_call=True)
-@cache.memoize(timeout=6000)
-def update_choro(load_click, reset_click, selected_data, months, toggle_value, contents, filename,
-                 filedate, start, end, statistic, fig_info, through_options, store_state, data_state, area_type, units):
+@cache.memoize(timeout=6000, unless=is_job_poll, response_filter=is_figure_response)
+def update_choro(load_click, reset_click, selected_data, job_poll, months, toggle_value, start, end, statistic,
+                 fig_info, through_options, store_state, data_state, area_type, units, job_state):
     """Generate choropleth figure based on input values and type of click event
 
        :param load_click:               Click event data for load button
@@ -442,21 +953,15 @@ def update_choro(load_click, reset_click, selected_data, months, toggle_value, c
        :param selected_data             Area select event data for the choropleth graph
        :type selected_data              dict
 
+       :param job_poll                  Number of polls of the job interval
+       :type job_poll                   int
+
        :param months                    List of selected months if available
        :type months                     list
 
        :param toggle_value              Value of grid toggle switch
        :type toggle_value               int
 
-       :param contents:                 Contents of uploaded file
-       :type contents:                  str
-
-       :param filename:                 Name of uploaded file
-       :type filename:                  list
-
-       :param filedate:                 Date of uploaded file
-       :type filedate:                  str
-
        :param start                     Start year value
        :type start                      str
 
@@ -475,7 +980,7 @@ def update_choro(load_click, reset_click, selected_data, months, toggle_value, c
        :param store_state               Current state of figure object
        :type store_state                dict
 
-       :param data_state                Current state of figure object
+       :param data_state                Dataset handle of the uploaded file
        :type data_state                 dict
 
        :param area_type                 Current state of figure object
@@ -484,14 +989,22 @@ def update_choro(load_click, reset_click, selected_data, months, toggle_value, c
        :param units                     Area select event data for the choropleth graph
        :type units                      str
 
-       :return:                         Active tab, grid toggle value, selection data, warning status, Choropleth figure
+       :param job_state                 Choropleth job being computed
+       :type job_state                  dict
+
+       :return:                         Active tab, grid toggle value, selection data, warning status, Choropleth
+                                        figure, job to poll, whether polling is disabled, job progress
 
        """
-    # Don't process anything unless there's contents in the file upload component
-    if contents and dash.callback_context.triggered[0]['prop_id'] in ['submit_btn.n_clicks',
-                                                                      'choro_graph.selectedData',
-                                                                      'choro_graph.relayoutData',
-                                                                      'reset_btn.n_clicks']:
+    # Get what triggered the callback here
+    click_info = dash.callback_context.triggered[0]['prop_id']
+
+    # Poll the job computing the figure
+    if click_info == 'job_interval.n_intervals':
+        return poll_choro_job(job_state)
+
+    # Don't process anything unless a file has been uploaded and ingested
+    if data_state and click_info in ['submit_btn.n_clicks', 'choro_graph.selectedData', 'reset_btn.n_clicks']:
         # Check for valid years inputs
         if start > end:
             error_message = html.Div(
@@ -500,151 +1013,125 @@ def update_choro(load_click, reset_click, selected_data, months, toggle_value, c
             )
             raise PreventUpdate
 
-        # Get the values of what triggered the callback here
-        click_value = dash.callback_context.triggered[0]['value']
-        click_info = dash.callback_context.triggered[0]['prop_id']
-
-        # If the user zooms while viewing by grid cell then dynamically adjust marker size for optimal viewing
-        # Currently disabled due to performance issues of the relayoutData event triggering too often
-        if click_info == 'choro_graph.relayoutData':
-            if type(click_value).__name__ == 'dict' and 'mapbox.zoom' in click_value.keys() and toggle_value is True:
-                fig_info['data'][0]['marker']['size'] = click_value['mapbox.zoom'] * 4
-                # fig_info['data'][0]['radius'] = math.ceil(click_value['mapbox.zoom'] * 3 + 1)
-                return 'output_tab', toggle_value, store_state, False, fig_info
-            elif click_value != {'autosize': True}:
-                print("HERE")
-                raise PreventUpdate
-
-        # Get the cached contents of the data  file here instead of rereading every time
-        data = cache.get(data_state)
-        if data is not None:
-            df = data[0]
-            file_info = data[1]
-        else:
-            return 'info_tab', False, store_state, True, fig_info
-
-        # Process inputs (years, data) and set up variables
+        # Area selections are filtered in the browser from the figure it already holds (see the select_areas
+        # clientside function), only the selection is remembered here
+        if click_info == 'choro_graph.selectedData' and selected_data is not None and toggle_value is not True:
+            if len(selected_data['points']) != 0 and xvu.is_select_figure(fig_info):
+                return 'output_tab', toggle_value, selected_data, False, dash.no_update, None, True, []
+
+        # Open the stored dataset here instead of rereading the file every time
+        dataset = dataset_store.get(data_state['id'])
+        if dataset is None:
+            return 'info_tab', False, store_state, True, fig_info, None, True, []
+        dataset_store.acquire(data_state['id'], data_state['session'])
+        file_info = data_state['file_info']
+        filename = data_state['filename']
+
+        # Process inputs (years, data) and set up variables, only the chosen years are read from the dataset
         year_list = xvu.get_target_years(start, end, through_options)
 
-        # Determine if viewing by country or basin to set up data calls
-        df_per_area = None
-        if area_type == "gcam":
-            if toggle_value is False:
-                df_per_area = xvu.data_per_basin(df, statistic, year_list, df_ref, months, filename, units)
-                df_per_area['var'] = round(df_per_area['var'], 2)
-            features = basin_features
-        else:
-            if toggle_value is False:
-                df_per_area = xvu.data_per_country(df, statistic, year_list, df_ref, months, filename, units)
-                df_per_area['var'] = round(df_per_area['var'], 2)
-            features = country_features
-
-        # If the user clicked the reset button then reset graph selection store data to empty
-        if click_info == 'reset_btn.n_clicks':
-            if area_type == "gcam":
-                df_per_area = xvu.data_per_basin(df, statistic, year_list, df_ref, months, filename, units)
-            else:
-                df_per_area = xvu.data_per_country(df, statistic, year_list, df_ref, months, filename, units)
-            df_per_area['var'] = round(df_per_area['var'], 2)
-            fig = xvu.plot_choropleth(df_per_area, features, mapbox_token, statistic, start, end, file_info, months,
-                                      area_type, units)
-            store_state = None
-            return 'output_tab', False, store_state, False, fig
-
-        # Generate figure based on type of click data (click, area select, or initial load)
-        if selected_data is not None and click_info == 'choro_graph.selectedData':
-            store_state = selected_data
-            if len(selected_data['points']) == 0:
-                fig = xvu.plot_choropleth(df_per_area, features, mapbox_token, statistic, start, end, file_info,
-                                          months, area_type, units)
-            else:
-                if toggle_value is True:
-                    fig = xvu.update_choro_grid(df_ref, df, features, year_list, mapbox_token, selected_data,
-                                                start, end, statistic, file_info, months, area_type, units, filename)
-                else:
-                    fig = xvu.update_choro_select(df_ref, df_per_area, features, year_list, mapbox_token,
-                                                  selected_data, start, end, statistic, file_info, months, area_type,
-                                                  units)
-        elif click_info == "grid_toggle.on":
-            if store_state is None:
-                selected_data = None
-            if toggle_value is True:
-                fig = xvu.update_choro_grid(df_ref, df, features, year_list, mapbox_token, selected_data,
-                                            start, end, statistic, file_info, months, area_type, units, filename)
-            else:
-                fig = xvu.update_choro_select(df_ref, df_per_area, features, year_list, mapbox_token,
-                                              selected_data, start, end, statistic, file_info, months, area_type, units)
-        else:
-            if store_state is None:
-                selected_data = None
-            if selected_data is not None and len(selected_data['points']) != 0:
-                if toggle_value is True:
-                    fig = xvu.update_choro_grid(df_ref, df, features, year_list, mapbox_token, selected_data,
-                                                start, end, statistic, file_info, months, area_type, units, filename)
-                else:
-                    fig = xvu.update_choro_select(df_ref, df_per_area, features, year_list, mapbox_token,
-                                                  selected_data, start, end, statistic, file_info, months, area_type,
-                                                  units)
-            else:
-                if toggle_value is True:
-                    fig = xvu.update_choro_grid(df_ref, df, features, year_list, mapbox_token, selected_data,
-                                                start, end, statistic, file_info, months, area_type, units, filename)
-                else:
-                    fig = xvu.plot_choropleth(df_per_area, features, mapbox_token, statistic, start, end,
-                                              file_info, months, area_type, units)
-
-        return 'output_tab', toggle_value, store_state, False, fig
+        # The whole grid is drawn from map tiles served by the tile endpoint
+        tile_url = xvu.build_tile_url(request.url_root, data_state['id'], statistic, start, end, months, units,
+                                      filename)
+        grid_file = tile_grid_file(tile_grid_key(data_state['id'], statistic, start, end, months, units,
+                                                 xvu.get_units_from_name(filename)))
+
+        # Grid views reading too many values to answer quickly are computed by a job, the browser polls for the figure
+        if toggle_value is True and click_info != 'reset_btn.n_clicks':
+            time_index = dataset.time_index(year_list, months)
+            if dataset.statistic_reads(time_index, statistic) >= job_min_values:
+                job_args = (data_state['id'], click_info, selected_data, months, toggle_value, start, end, statistic,
+                            year_list, store_state, file_info, filename, area_type, units, tile_url, grid_file)
+                job_state = {'id': job_queue.submit(xjq.JobQueue.job_id(*job_args), run_choro_job, *job_args)}
+
+                # The same view computed before is answered from its job's result
+                status = job_queue.status(job_state['id'])
+                if status is None or status['state'] == 'done':
+                    return poll_choro_job(job_state)
+                return ('output_tab', toggle_value, dash.no_update, False, dash.no_update, job_state, False,
+                        job_progress(status))
+
+        toggle_value, store_state, fig = build_choro_figure(dataset, click_info, selected_data, months, toggle_value,
+                                                            start, end, statistic, year_list, store_state, file_info,
+                                                            filename, area_type, units, tile_url, grid_file)
+
+        return 'output_tab', toggle_value, store_state, False, fig, None, True, []
 
     # If no contents, just return the blank map with instruction
     else:
         raise PreventUpdate
 
 
-# Callback to set start year options when file is uploaded and store data in disk cache
+# Callback to set start year options when file is uploaded and write data to the dataset store
 @app.callback(
-    [Output("start_year", "options"), Output("start_year", "value"), Output("upload-data", "children"),
+    [Output("start_year", "options"), Output("start_year", "value"), Output("upload-text", "children"),
      Output("data_store", 'data'), Output("months_select", "options"), Output("units", "options"),
      Output("units", "value")],
-    [Input("upload-data", "contents")], [State('upload-data', 'filename'), State('upload-data', 'last_modified')],
+    [Input("upload_store", "data")], [State("data_store", 'data')],
     prevent_initial_call=True
 )
-def update_options(contents, filename, filedate):
+def update_options(upload_handle, data_state):
     """Set start year options based on uploaded file's data
 
-           :param contents:                 Contents of uploaded file
-           :type contents:                  str
-
-           :param filename:                 Name of uploaded file
-           :type filename:                  str
+           :param upload_handle:            Dataset handle returned by the upload endpoint
+           :type upload_handle:             dict
 
-           :param filedate:                 Date of uploaded file
-           :type filedate:                  str
+           :param data_state:               Dataset handle of the previously uploaded file, if any
+           :type data_state:                dict
 
            :return:                         Options list, initial value, new upload component text
 
     """
-    # Check if there is uploaded content
-    if contents:
+    # Check if there is an uploaded file
+    if upload_handle:
+
+        filename = upload_handle['filename']
+        key = upload_handle['id']
+        file_info = filename[0].split('_')
+
+        # The handle is checked before anything is read or removed, a rejected handle never reaches the upload's file
+        file_path = xds.get_upload_path(upload_dir, upload_handle)
+
+        # Keep the session id across uploads so the session's reference to its previous dataset can be released
+        if data_state is None:
+            session_id = str(uuid.uuid4())
+        else:
+            session_id = data_state['session']
+            if data_state['id'] != key:
+                dataset_store.release(data_state['id'], session_id)
+
+        # Only parse the file if it has not already been ingested, uploads are keyed by the hash of the file.  Sessions
+        # uploading the same file at once wait for the first to ingest it, then use the stored dataset
+        try:
+            with dataset_store.ingest_lock(key):
+                if dataset_store.has(key):
+                    target_years, months_list = xvu.get_year_options(dataset_store.get(key).columns)
+                else:
+                    # Read the available years from the file written by the upload endpoint, then stream its data
+                    # into the store a chunk of rows at a time to bound memory on large files
+                    info, chunks = xvu.ingest_upload(file_path, filename, ref_index)
+                    target_years, months_list = info['years'], info['months']
+                    dataset_store.put_chunks(key, chunks, info['n_rows'], info['columns'], session_id,
+                                             ref_index.aggregations)
+        finally:
+            # The raw upload is no longer needed once it has been ingested, or once ingesting it failed
+            xds.remove_upload(upload_dir, upload_handle)
+        dataset_store.acquire(key, session_id)
+        dataset_store.collect()
+        job_queue.collect()
 
-        # Process contents for available years
-        target_years, months_list = xvu.process_input_years(contents, filename, filedate)
         if months_list is None:
             months = []
         else:
             months = xvu.get_available_months(months_list)
         name = filename[0]
         new_text = html.Div(["Using file " + name[:25] + '...' if (len(name) > 25) else "Using file " + name])
-        data = xvu.process_file(contents, filename, filedate, years=None)
-        xanthos_data = data[0]
 
-        # Create id key for data store and use it as reference
-        file_id = str(uuid.uuid4())
-        df = xvu.prepare_data(xanthos_data, df_ref)
-        data_state = file_id
-        cache.set(file_id, [df, data[1]])
+        # Callbacks only carry the handle from here on
+        data_state = {'id': key, 'filename': filename, 'file_info': file_info, 'session': session_id}
 
         # Evaluate and set unit options
-        unit_options = xvu.get_unit_options(data[1])
+        unit_options = xvu.get_unit_options(file_info)
         if 'km3' in name:
             unit_val = 'km³'
         elif 'mm' in name:
@@ -690,20 +1177,22 @@ def set_through_year_list(value, options, current_value):
 # Callback to load the hydro graph when user clicks on choropleth graph
 @app.callback(
     Output('hydro_graph', 'figure'),
-    [Input('choro_graph', 'clickData'), Input("submit_btn", 'n_clicks')],
-    [State('start_year', 'value'), State('through_year', 'value'), State("upload-data", "contents"),
-     State('upload-data', 'filename'), State('upload-data', 'last_modified'), State("through_year", "options"),
+    [Input('choro_graph', 'clickData'), Input("submit_btn", 'n_clicks'), Input("grid_click_store", "data")],
+    [State('start_year', 'value'), State('through_year', 'value'), State("through_year", "options"),
      State('months_select', 'value'), State('area_select', 'value'), State("hydro_graph", 'figure'),
      State("units", "value"), State("data_store", "data")],
     prevent_initial_call=True
 )
-def update_hydro(click_data, n_click, start, end, contents, filename, filedate, year_options, months, area_type,
-                 hydro_state, units, data_state):
+def update_hydro(click_data, n_click, grid_click, start, end, year_options, months, area_type, hydro_state, units,
+                 data_state):
     """Generate choropleth figure based on input values and type of click event
 
            :param click_data:               Click event data for the choropleth graph
            :type click_data:                dict
 
+           :param grid_click:               Click on the grid image, in the same form as click_data
+           :type grid_click:                dict
+
            :param n_click                   Submit button click event
            :type n_click                    object
 
@@ -713,15 +1202,6 @@ def update_hydro(click_data, n_click, start, end, contents, filename, filedate,
            :param end                       End year value
            :type end                        str
 
-           :param contents:                 Contents of uploaded file
-           :type contents:                  str
-
-           :param filename:                 Name of uploaded file
-           :type filename:                  list
-
-           :param filedate:                 Date of uploaded file
-           :type filedate:                  str
-
            :param year_options:             List of year range
            :type year_options:              dict
 
@@ -737,13 +1217,13 @@ def update_hydro(click_data, n_click, start, end, contents, filename, filedate,
            :param units:                    Chosen units
            :type units:                     str
 
-           :param data_state:               File cache data
+           :param data_state:               Dataset handle of the uploaded file
            :type data_state:                dict
 
            :return:                         Choropleth figure
     """
 
-    if contents is not None:
+    if data_state is not None:
         # If invalid end date then don't do anything and output message
         if start >= end:
             return {
@@ -752,6 +1232,9 @@ def update_hydro(click_data, n_click, start, end, contents, filename, filedate,
                     'title': 'Please choose an end year that is greater than the start year'
                 }
             }
+        # Clicks on the grid image come from the grid click store instead of the graph's click data
+        if dash.callback_context.triggered[0]['prop_id'] == 'grid_click_store.data':
+            click_data = grid_click
         # If there wasn't a click event on choro graph then do not load new hydro graph
         if click_data is None:
             return {
@@ -761,13 +1244,13 @@ def update_hydro(click_data, n_click, start, end, contents, filename, filedate,
                 }
             }
 
-        # Get data from cache
-        data = cache.get(data_state)
-        if data is not None:
-            df = data[0]
-            file_info = data[1]
-        else:
+        # Get data from the dataset store
+        dataset = dataset_store.get(data_state['id'])
+        if dataset is None:
             raise PreventUpdate
+        dataset_store.acquire(data_state['id'], data_state['session'])
+        file_info = data_state['file_info']
+        filename = data_state['filename']
 
         # Evaluate chosen area type (basin or country) and set dynamic parameter values
         if area_type == "gcam":
@@ -790,7 +1273,8 @@ def update_hydro(click_data, n_click, start, end, contents, filename, filedate,
         context = dash.callback_context.triggered[0]['prop_id']
 
         # Evaluate current state and only update if user made a different selection
-        if context != 'choro_graph.clickData' and 'data' in hydro_state.keys() and len(hydro_state['data']) > 0:
+        clicked = context in ('choro_graph.clickData', 'grid_click_store.data')
+        if not clicked and 'data' in hydro_state.keys() and len(hydro_state['data']) > 0:
             hydro_type = hydro_state['data'][0]['customdata'][0][0]
             if hydro_type == "basin_id" and area_type == "country":
                 raise PreventUpdate
@@ -798,26 +1282,26 @@ def update_hydro(click_data, n_click, start, end, contents, filename, filedate,
                 raise PreventUpdate
 
         # Evaluate click event to determine if user clicked on an area or a grid cell
-        if 'cell_id' not in points[0]['customdata'].keys():
-            location = points[0]['customdata'][area_loc]
+        if not xvu.is_cell_point(points[0]):
+            location = xvu.get_custom_value(points[0], area_loc)
             location_type = area_title
         else:
-            location = points[0]['customdata']['cell_id']
+            location = xvu.get_custom_value(points[0], 'cell_id')
             location_type = 'cell'
 
-        # Process years, basin/cell information
+        # Process years, basin/cell information, only the chosen years are read from the dataset
         years = xvu.get_target_years(start, end, year_options)
         if location_type == 'Basin':
-            hydro_data = xvu.data_per_year_area(df, location, years, months, area_loc, filename, units, df_ref)
-            return xvu.plot_hydrograph(hydro_data, location, df_ref, 'basin_id', file_info, units)
+            hydro_data = xvu.data_per_year_area(dataset, location, years, months, area_loc, filename, units, ref_index)
+            return xvu.plot_hydrograph(hydro_data, location, ref_index, 'basin_id', file_info, units)
         elif location_type == 'Country':
-            hydro_data = xvu.data_per_year_area(df, location, years, months, area_loc, filename, units, df_ref)
-            return xvu.plot_hydrograph(hydro_data, location, df_ref, 'country_name', file_info, units)
+            hydro_data = xvu.data_per_year_area(dataset, location, years, months, area_loc, filename, units, ref_index)
+            return xvu.plot_hydrograph(hydro_data, location, ref_index, 'country_name', file_info, units)
         elif location_type == 'cell':
-            hydro_data = xvu.data_per_year_cell(df, location, years, months, area_loc, filename, units, df_ref)
-            return xvu.plot_hydrograph(hydro_data, location, df_ref, 'grid_id', file_info, units, area_name)
+            hydro_data = xvu.data_per_year_cell(dataset, location, years, months, area_loc, filename, units, ref_index)
+            return xvu.plot_hydrograph(hydro_data, location, ref_index, 'grid_id', file_info, units, area_name)
 
-    # Return nothing if there's no uploaded contents
+    # Return nothing if there's no uploaded file
     else:
         data = []
 
@@ -830,6 +1314,27 @@ def update_hydro(click_data, n_click, start, end, contents, filename, filedate,
 
 # ----- End Dash Callbacks
 
+
+def create_app():
+    """Load the reference data and return the Flask server.  With gunicorn --preload ("main:create_app()") this runs
+    once in the master process before the workers are forked, so workers start without loading anything and share the
+    reference data copy-on-write.
+
+       :return:                         Flask server of the Dash app
+
+    """
+    load_reference()
+
+    # Everything loaded so far lives as long as the app, move it out of the garbage collector's generations so
+    # collections in the workers don't write to the shared pages and copy them
+    if hasattr(gc, 'freeze'):
+        gc.collect()
+        gc.freeze()
+
+    return server
+
+
 # Start Dash Server
 if __name__ == '__main__':
+    create_app()
     app.run_server(debug=False, threaded=True)
@@ -0,0 +1,305 @@
+import numpy as np
+
+# Number of time columns summarized together, a range query reads at most this many columns at each end of the range
+RANGE_BLOCK_SIZE = 64
+
+# Number of years summarized together in the index of each calendar month of monthly files
+MONTH_BLOCK_SIZE = 16
+
+# Statistics answered from the range index, others are computed from the values in the range
+RANGE_STATISTICS = ('mean', 'min', 'max', 'standard deviation')
+
+# Arrays making up a range index
+RANGE_ARRAYS = ('shift', 'count', 'sum', 'sum_sq', 'min', 'max')
+
+
+def row_means(values, block_size=RANGE_BLOCK_SIZE):
+    """Get the mean of each row of a (rows x time) matrix, reading a block of columns at a time
+
+    :param values:                  Rows x time values, missing values are nan
+    :type values:                   array
+
+    :param block_size:              Number of time columns read at a time
+    :type block_size:               int
+
+    :return:                        array; mean of each row, 0 for rows with no values
+
+    """
+
+    n_rows, n_columns = values.shape
+    total = np.zeros(n_rows)
+    count = np.zeros(n_rows)
+    for start in range(0, n_columns, block_size):
+        block = np.asarray(values[:, start:start + block_size])
+        total += np.nansum(block, axis=1)
+        count += np.count_nonzero(~np.isnan(block), axis=1)
+
+    return np.divide(total, count, out=np.zeros(n_rows), where=count > 0)
+
+
+def build_range_index(values, block_size=RANGE_BLOCK_SIZE, columns=None, shift=None, max_levels=None):
+    """Summarize each row of a (rows x time) matrix so statistics over any contiguous range of time columns are found
+    without reading the range.  Time columns are split into blocks, each row keeps running totals of the count, sum
+    and sum of squares of its values through each block, and a sparse table of the min and max over each power of two
+    run of blocks.  Sums are taken about each row's mean to keep the variance accurate.
+
+    :param values:                  Rows x time values, missing values are nan
+    :type values:                   array
+
+    :param block_size:              Number of time columns in a block
+    :type block_size:               int
+
+    :param columns:                 Optional positions of the time columns to index, in order, all if None
+    :type columns:                  array
+
+    :param shift:                   Value of each row sums are taken about, the row means if None.  Indexes built
+                                    with the same shift can be combined with combine_totals.
+    :type shift:                    array
+
+    :param max_levels:              Optional number of sparse table levels to keep, all if None.  With fewer levels
+                                    the min and max of long ranges scan more table entries.
+    :type max_levels:               int
+
+    :return:                        dict; arrays of the index, named as RANGE_ARRAYS
+
+    """
+
+    if columns is None:
+        columns = np.arange(values.shape[1])
+    n_rows = values.shape[0]
+    n_blocks = len(columns) // block_size
+    if shift is None:
+        shift = row_means(values, block_size)
+
+    # Count, sums and extremes of each block
+    block_count = np.zeros((n_rows, n_blocks + 1), dtype=np.int32)
+    block_sum = np.zeros((n_rows, n_blocks + 1))
+    block_sum_sq = np.zeros((n_rows, n_blocks + 1))
+    block_min = np.empty((n_rows, n_blocks))
+    block_max = np.empty((n_rows, n_blocks))
+    for i in range(n_blocks):
+        block = _read(values, columns[i * block_size:(i + 1) * block_size])
+        missing = np.isnan(block)
+        shifted = np.where(missing, 0, block - shift[:, None])
+        block_count[:, i + 1] = np.count_nonzero(~missing, axis=1)
+        block_sum[:, i + 1] = shifted.sum(axis=1)
+        block_sum_sq[:, i + 1] = (shifted * shifted).sum(axis=1)
+        block_min[:, i] = np.where(missing, np.inf, block).min(axis=1)
+        block_max[:, i] = np.where(missing, -np.inf, block).max(axis=1)
+
+    # Sparse tables, level k holds the min and max of the 2 ** k blocks starting at each block
+    n_levels = int(np.log2(n_blocks)) + 1 if n_blocks > 0 else 1
+    if max_levels is not None:
+        n_levels = min(n_levels, max_levels)
+    table_min = np.empty((n_levels, n_rows, n_blocks))
+    table_max = np.empty((n_levels, n_rows, n_blocks))
+    table_min[0], table_max[0] = block_min, block_max
+    for k in range(1, n_levels):
+        width = 2 ** (k - 1)
+        table_min[k], table_max[k] = table_min[k - 1], table_max[k - 1]
+        table_min[k, :, :n_blocks - width] = np.minimum(table_min[k - 1, :, :-width], table_min[k - 1, :, width:])
+        table_max[k, :, :n_blocks - width] = np.maximum(table_max[k - 1, :, :-width], table_max[k - 1, :, width:])
+
+    return {'shift': shift, 'count': np.cumsum(block_count, axis=1, dtype=np.int32),
+            'sum': np.cumsum(block_sum, axis=1), 'sum_sq': np.cumsum(block_sum_sq, axis=1), 'min': table_min,
+            'max': table_max}
+
+
+def is_range(positions):
+    """Check if time column positions are a contiguous, increasing range
+
+    :param positions:               Column positions
+    :type positions:                array
+
+    :return:                        bool; True if the positions can be answered by a range query
+
+    """
+
+    return len(positions) > 0 and bool(np.all(np.diff(positions) == 1))
+
+
+def range_totals(range_index, values, start, stop, statistic, rows=None, block_size=RANGE_BLOCK_SIZE, columns=None):
+    """Get the totals a statistic is computed from over a contiguous range of the indexed time columns of each row.
+    Only the columns before the first and after the last whole block in the range are read from the values, at most a
+    block at each end, so the cost doesn't grow with the length of the range.
+
+    :param range_index:             Index built by build_range_index
+    :type range_index:              dict
+
+    :param values:                  Rows x time values the index was built from
+    :type values:                   array
+
+    :param start:                   First indexed time column of the range
+    :type start:                    int
+
+    :param stop:                    Indexed time column after the last of the range
+    :type stop:                     int
+
+    :param statistic:               One of RANGE_STATISTICS, only the totals it needs are computed
+    :type statistic:                str
+
+    :param rows:                    Optional mask or positions of the rows to compute, all if None
+    :type rows:                     array
+
+    :param block_size:              Number of time columns in a block of the index
+    :type block_size:               int
+
+    :param columns:                 Positions of the indexed time columns in the values, if the index was built from
+                                    some of them
+    :type columns:                  array
+
+    :return:                        dict; shift, count and, as the statistic needs, sum and sum of squares about the
+                                    shift, or min or max of each row
+
+    """
+
+    if statistic not in RANGE_STATISTICS:
+        msg = f"The statistic requested '{statistic}' is not answered by a range query."
+        raise ValueError(msg)
+
+    def select(array):
+        return np.asarray(array if rows is None else array[rows])
+
+    if columns is None:
+        columns = np.arange(values.shape[1])
+
+    # Whole blocks in the range, and the columns at either end outside of them
+    first_block, last_block = -(-start // block_size), stop // block_size
+    if first_block < last_block:
+        edges = np.concatenate([columns[start:first_block * block_size], columns[last_block * block_size:stop]])
+    else:
+        first_block = last_block = 0
+        edges = columns[start:stop]
+    edge_values = select(_read(values, edges))
+    edge_missing = np.isnan(edge_values)
+
+    totals = {'shift': select(range_index['shift']),
+              'count': (select(range_index['count'][:, last_block]) - select(range_index['count'][:, first_block])
+                        + np.count_nonzero(~edge_missing, axis=1))}
+
+    if statistic in ('min', 'max'):
+        if statistic == 'min':
+            result = np.where(edge_missing, np.inf, edge_values).min(axis=1, initial=np.inf)
+            combine = np.minimum
+        else:
+            result = np.where(edge_missing, -np.inf, edge_values).max(axis=1, initial=-np.inf)
+            combine = np.maximum
+
+        # Runs of the longest power of two length kept that start across the whole blocks, the last one ending with
+        # them, cover the whole blocks; two runs when every level is kept
+        if first_block < last_block:
+            table = range_index[statistic]
+            k = min(int(np.log2(last_block - first_block)), len(table) - 1)
+            width = 2 ** k
+            starts = np.append(np.arange(first_block, last_block - width, width), last_block - width)
+            result = combine(result, combine.reduce(select(table[k][:, starts]), axis=1))
+
+        totals[statistic] = result
+        return totals
+
+    edge_shifted = np.where(edge_missing, 0, edge_values - totals['shift'][:, None])
+    totals['sum'] = (select(range_index['sum'][:, last_block]) - select(range_index['sum'][:, first_block])
+                     + edge_shifted.sum(axis=1))
+    if statistic == 'standard deviation':
+        totals['sum_sq'] = (select(range_index['sum_sq'][:, last_block]) - select(range_index['sum_sq'][:, first_block])
+                            + (edge_shifted * edge_shifted).sum(axis=1))
+
+    return totals
+
+
+def combine_totals(totals):
+    """Combine the totals of disjoint sets of time columns, from indexes built with the same shift
+
+    :param totals:                  Totals returned by range_totals for the same statistic and rows
+    :type totals:                   list
+
+    :return:                        dict; totals over all the sets of time columns
+
+    """
+
+    combined = dict(totals[0])
+    for other in totals[1:]:
+        for name in combined:
+            if name == 'min':
+                combined[name] = np.minimum(combined[name], other[name])
+            elif name == 'max':
+                combined[name] = np.maximum(combined[name], other[name])
+            elif name != 'shift':
+                combined[name] = combined[name] + other[name]
+
+    return combined
+
+
+def finish_statistic(totals, statistic):
+    """Compute a statistic from totals.  Missing values are skipped the same as
+    xanthosvis.util_functions.compute_statistic.
+
+    :param totals:                  Totals returned by range_totals or combine_totals
+    :type totals:                   dict
+
+    :param statistic:               One of RANGE_STATISTICS
+    :type statistic:                str
+
+    :return:                        array; statistic for each row
+
+    """
+
+    count = totals['count']
+    n = np.maximum(count, 1)
+
+    if statistic in ('min', 'max'):
+        return np.where(count == 0, np.nan, totals[statistic])
+
+    elif statistic == 'mean':
+        return np.where(count == 0, np.nan, totals['shift'] + totals['sum'] / n)
+
+    variance = np.maximum(totals['sum_sq'] - totals['sum'] * totals['sum'] / n, 0) / np.maximum(n - 1, 1)
+
+    return np.where(count < 2, np.nan, np.sqrt(variance))
+
+
+def query_range(range_index, values, start, stop, statistic, rows=None, block_size=RANGE_BLOCK_SIZE, columns=None):
+    """Compute a statistic over a contiguous range of the indexed time columns of each row from a range index, see
+    range_totals
+
+    :param range_index:             Index built by build_range_index
+    :type range_index:              dict
+
+    :param values:                  Rows x time values the index was built from
+    :type values:                   array
+
+    :param start:                   First indexed time column of the range
+    :type start:                    int
+
+    :param stop:                    Indexed time column after the last of the range
+    :type stop:                     int
+
+    :param statistic:               One of RANGE_STATISTICS
+    :type statistic:                str
+
+    :param rows:                    Optional mask or positions of the rows to compute, all if None
+    :type rows:                     array
+
+    :param block_size:              Number of time columns in a block of the index
+    :type block_size:               int
+
+    :param columns:                 Positions of the indexed time columns in the values, if the index was built from
+                                    some of them
+    :type columns:                  array
+
+    :return:                        array; statistic for each row
+
+    """
+
+    totals = range_totals(range_index, values, start, stop, statistic, rows, block_size, columns)
+
+    return finish_statistic(totals, statistic)
+
+
+def _read(values, columns):
+    """Read time columns of a matrix by position, contiguous positions as a slice"""
+
+    if len(columns) > 0 and columns[-1] - columns[0] == len(columns) - 1:
+        return np.asarray(values[:, columns[0]:columns[-1] + 1])
+
+    return np.asarray(values[:, columns])
@@ -0,0 +1,454 @@
+import base64
+import collections
+import os
+import struct
+import threading
+import zlib
+
+import numpy as np
+from plotly import colors as plotly_colors
+
+# Xanthos grid cells are 0.5 degree squares on a regular lat/lon grid
+GRID_RESOLUTION = 0.5
+
+# Web Mercator, which map tiles and image layers are drawn in, is cut off at this latitude
+MAX_MERCATOR_LAT = 85.0511287798
+
+# Number of colors sampled from the colorscale
+LUT_SIZE = 256
+
+# Width and height of map tiles in pixels
+TILE_SIZE = 256
+
+# Deepest zoom tiles are served for
+MAX_TILE_ZOOM = 22
+
+
+def build_cell_grid(lon, lat, resolution=GRID_RESOLUTION):
+    """Build a dense (lat x lon) lookup from a position on the grid to a row of grid cell data, so map coordinates
+    resolve to a grid cell with one array lookup
+
+    :param lon:                     Longitude of each grid cell's center
+    :type lon:                      array
+
+    :param lat:                     Latitude of each grid cell's center
+    :type lat:                      array
+
+    :param resolution:              Size of a grid cell in degrees
+    :type resolution:               float
+
+    :return:                        array; row of the grid cell at each grid position, -1 where there is no cell
+
+    """
+
+    cell_grid = np.full((int(round(180 / resolution)), int(round(360 / resolution))), -1, dtype=np.int64)
+    rows, cols = grid_position(np.asarray(lon), np.asarray(lat), resolution)
+    cell_grid[rows, cols] = np.arange(len(rows))
+
+    return cell_grid
+
+
+def grid_position(lon, lat, resolution=GRID_RESOLUTION):
+    """Get the row (from the north) and column (from the west) of coordinates on the grid
+
+    :param lon:                     Longitudes
+    :type lon:                      array
+
+    :param lat:                     Latitudes
+    :type lat:                      array
+
+    :param resolution:              Size of a grid cell in degrees
+    :type resolution:               float
+
+    :return:                        arrays; grid rows and columns
+
+    """
+
+    n_rows, n_cols = int(round(180 / resolution)), int(round(360 / resolution))
+    rows = np.clip(np.floor((90 - lat) / resolution).astype(np.int64), 0, n_rows - 1)
+    cols = np.clip(np.floor((lon + 180) / resolution).astype(np.int64), 0, n_cols - 1)
+
+    return rows, cols
+
+
+def lookup_cell(cell_grid, lon, lat, resolution=GRID_RESOLUTION):
+    """Get the row of grid cell data at a map coordinate
+
+    :param cell_grid:               Lookup built by build_cell_grid
+    :type cell_grid:                array
+
+    :param lon:                     Longitude
+    :type lon:                      float
+
+    :param lat:                     Latitude
+    :type lat:                      float
+
+    :param resolution:              Size of a grid cell in degrees
+    :type resolution:               float
+
+    :return:                        int; row of the grid cell, or None if there is no cell at the coordinate
+
+    """
+
+    if not (-90 <= lat <= 90):
+        return None
+
+    # Wrap longitudes from maps that are panned past the antimeridian
+    lon = (lon + 180) % 360 - 180
+    rows, cols = grid_position(np.array([lon]), np.array([lat]), resolution)
+    row = cell_grid[rows[0], cols[0]]
+
+    return None if row < 0 else int(row)
+
+
+def build_color_lut(colorscale='Plasma', size=LUT_SIZE):
+    """Sample a named plotly colorscale into a lookup table of RGB colors
+
+    :param colorscale:              Name of a plotly sequential colorscale
+    :type colorscale:               str
+
+    :param size:                    Number of colors
+    :type size:                     int
+
+    :return:                        array; (size x 3) RGB colors
+
+    """
+
+    colors = getattr(plotly_colors.sequential, colorscale)
+    rgb = np.array([_parse_color(c) for c in colors], dtype=np.float64)
+    stops = np.linspace(0, 1, len(colors))
+    samples = np.linspace(0, 1, size)
+
+    return np.stack([np.interp(samples, stops, rgb[:, i]) for i in range(3)], axis=1).round().astype(np.uint8)
+
+
+def _parse_color(color):
+    """Parse a '#rrggbb' or 'rgb(r, g, b)' plotly color"""
+
+    if color.startswith('#'):
+        return [int(color[i:i + 2], 16) for i in (1, 3, 5)]
+
+    return [float(c) for c in color[color.index('(') + 1:color.index(')')].split(',')[:3]]
+
+
+def colorize(values, cmin, cmax, lut):
+    """Color values with a lookup table, missing values are transparent
+
+    :param values:                  Values to color
+    :type values:                   array
+
+    :param cmin:                    Value mapped to the first color
+    :type cmin:                     float
+
+    :param cmax:                    Value mapped to the last color
+    :type cmax:                     float
+
+    :param lut:                     Colors built by build_color_lut
+    :type lut:                      array
+
+    :return:                        array; RGBA colors with a trailing axis of 4
+
+    """
+
+    missing = np.isnan(values)
+    scale = (np.where(missing, cmin, values) - cmin) / (cmax - cmin) if cmax > cmin else np.zeros(values.shape)
+    index = np.clip((scale * (len(lut) - 1)).round(), 0, len(lut) - 1).astype(np.int64)
+
+    rgba = np.empty(values.shape + (4,), dtype=np.uint8)
+    rgba[..., :3] = lut[index]
+    rgba[..., 3] = np.where(missing, 0, 255)
+
+    return rgba
+
+
+def mercator_y(lat):
+    """Project latitudes in degrees to Web Mercator y"""
+
+    return np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+
+
+def mercator_lat(y):
+    """Project Web Mercator y back to latitudes in degrees"""
+
+    return np.degrees(2 * np.arctan(np.exp(y)) - np.pi / 2)
+
+
+def render_grid_image(lon, lat, values, cmin, cmax, lut, resolution=GRID_RESOLUTION):
+    """Color grid cell values into an image covering the cells' bounding box, with rows reprojected to Web Mercator
+    so the image lines up with the map when it is drawn as an image layer
+
+    :param lon:                     Longitude of each grid cell's center
+    :type lon:                      array
+
+    :param lat:                     Latitude of each grid cell's center
+    :type lat:                      array
+
+    :param values:                  Value of each grid cell
+    :type values:                   array
+
+    :param cmin:                    Value mapped to the first color
+    :type cmin:                     float
+
+    :param cmax:                    Value mapped to the last color
+    :type cmax:                     float
+
+    :param lut:                     Colors built by build_color_lut
+    :type lut:                      array
+
+    :param resolution:              Size of a grid cell in degrees
+    :type resolution:               float
+
+    :return:                        array; RGBA image, and list of the image's corner coordinates as
+                                    [[west, north], [east, north], [east, south], [west, south]]
+
+    """
+
+    rows, cols = grid_position(np.asarray(lon), np.asarray(lat), resolution)
+
+    # Only the bounding box of the cells is drawn
+    row_min, row_max = rows.min(), rows.max() + 1
+    col_min, col_max = cols.min(), cols.max() + 1
+    grid = np.full((row_max - row_min, col_max - col_min), np.nan)
+    grid[rows - row_min, cols - col_min] = values
+
+    west, east = float(col_min * resolution - 180), float(col_max * resolution - 180)
+    north = float(min(90 - row_min * resolution, MAX_MERCATOR_LAT))
+    south = float(max(90 - row_max * resolution, -MAX_MERCATOR_LAT))
+
+    # Sample the grid at evenly spaced Mercator rows, about one image row per grid row at the equator
+    y_north, y_south = mercator_y(north), mercator_y(south)
+    height = max(1, int(np.ceil((y_north - y_south) / np.radians(resolution))))
+    y = y_north - (np.arange(height) + 0.5) * (y_north - y_south) / height
+    source_rows = np.clip(np.floor((90 - mercator_lat(y)) / resolution).astype(np.int64) - row_min, 0, len(grid) - 1)
+
+    image = colorize(grid[source_rows], cmin, cmax, lut)
+
+    return image, [[west, north], [east, north], [east, south], [west, south]]
+
+
+def build_value_grid(lon, lat, values, resolution=GRID_RESOLUTION):
+    """Place grid cell values on the full (lat x lon) grid so tiles can sample it by position
+
+    :param lon:                     Longitude of each grid cell's center
+    :type lon:                      array
+
+    :param lat:                     Latitude of each grid cell's center
+    :type lat:                      array
+
+    :param values:                  Value of each grid cell
+    :type values:                   array
+
+    :param resolution:              Size of a grid cell in degrees
+    :type resolution:               float
+
+    :return:                        array; value at each grid position, nan where there is no cell
+
+    """
+
+    grid = np.full((int(round(180 / resolution)), int(round(360 / resolution))), np.nan)
+    rows, cols = grid_position(np.asarray(lon), np.asarray(lat), resolution)
+    grid[rows, cols] = values
+
+    return grid
+
+
+def save_value_grid(file_path, grid):
+    """Write a grid built by build_value_grid to a file, readers see the whole grid or no file
+
+    :param file_path:               File to write
+    :type file_path:                str
+
+    :param grid:                    Values built by build_value_grid
+    :type grid:                     array
+
+    """
+
+    tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as out:
+        np.save(out, grid)
+    os.replace(tmp_path, file_path)
+
+
+def load_value_grid(file_path):
+    """Read a grid written by save_value_grid
+
+    :param file_path:               File to read
+    :type file_path:                str
+
+    :return:                        array; values built by build_value_grid, or None if there is no such file
+
+    """
+
+    try:
+        return np.load(file_path)
+    except FileNotFoundError:
+        return None
+
+
+def render_tile(grid, z, x, y, cmin, cmax, lut, resolution=GRID_RESOLUTION, size=TILE_SIZE):
+    """Color an XYZ (Web Mercator) map tile from a grid of values
+
+    :param grid:                    Values built by build_value_grid
+    :type grid:                     array
+
+    :param z:                       Tile zoom
+    :type z:                        int
+
+    :param x:                       Tile column from the west
+    :type x:                        int
+
+    :param y:                       Tile row from the north
+    :type y:                        int
+
+    :param cmin:                    Value mapped to the first color
+    :type cmin:                     float
+
+    :param cmax:                    Value mapped to the last color
+    :type cmax:                     float
+
+    :param lut:                     Colors built by build_color_lut
+    :type lut:                      array
+
+    :param resolution:              Size of a grid cell in degrees
+    :type resolution:               float
+
+    :param size:                    Width and height of the tile in pixels
+    :type size:                     int
+
+    :return:                        array; RGBA tile image
+
+    """
+
+    # Coordinates of the center of each pixel column and row
+    pixels = (np.arange(size) + 0.5) / size
+    lon = (x + pixels) / 2 ** z * 360 - 180
+    lat = mercator_lat(np.pi * (1 - 2 * (y + pixels) / 2 ** z))
+
+    rows, _ = grid_position(np.zeros(size), lat, resolution)
+    _, cols = grid_position(lon, np.zeros(size), resolution)
+
+    return colorize(grid[rows[:, None], cols[None, :]], cmin, cmax, lut)
+
+
+class ByteLRUCache:
+    """Thread safe least recently used cache bounded by the total size of its values
+
+    :param max_bytes:               Size the cached values are kept under
+    :type max_bytes:                int
+
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        # Locks of the keys being computed by get_or_compute
+        self._computing = dict()
+
+    def get(self, key):
+        """Get a cached value, marking it as recently used
+
+        :param key:                     Cache key
+        :type key:                      hashable
+
+        :return:                        Cached value, or None if it is not cached
+
+        """
+
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def put(self, key, value, n_bytes):
+        """Cache a value, evicting the least recently used values to stay within the size limit
+
+        :param key:                     Cache key
+        :type key:                      hashable
+
+        :param value:                   Value to cache
+        :type value:                    object
+
+        :param n_bytes:                 Size of the value
+        :type n_bytes:                  int
+
+        """
+
+        with self._lock:
+            if key in self._items:
+                self.n_bytes -= self._items.pop(key)[1]
+
+            # Values larger than the whole cache are not kept
+            if n_bytes > self.max_bytes:
+                return
+
+            self._items[key] = (value, n_bytes)
+            self.n_bytes += n_bytes
+            while self.n_bytes > self.max_bytes:
+                self.n_bytes -= self._items.popitem(last=False)[1][1]
+
+    def get_or_compute(self, key, compute):
+        """Get a cached value, computing and caching it if it is not cached.  Only one thread computes a key at a time,
+        threads missing a key that is being computed wait for it instead of computing it again.
+
+        :param key:                     Cache key
+        :type key:                      hashable
+
+        :param compute:                 Function returning the value and its size
+        :type compute:                  function
+
+        :return:                        Cached or computed value
+
+        """
+
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self._lock:
+            key_lock = self._computing.setdefault(key, threading.Lock())
+
+        with key_lock:
+            try:
+                value = self.get(key)
+                if value is None:
+                    value, n_bytes = compute()
+                    self.put(key, value, n_bytes)
+                return value
+            finally:
+                with self._lock:
+                    self._computing.pop(key, None)
+
+
+def encode_png(rgba):
+    """Encode an RGBA image as a PNG with zlib alone
+
+    :param rgba:                    (height x width x 4) image
+    :type rgba:                     array
+
+    :return:                        bytes; PNG file
+
+    """
+
+    height, width = rgba.shape[:2]
+
+    # Each scanline starts with its filter type, 0 for none
+    scanlines = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    scanlines[:, 1:] = rgba.reshape(height, width * 4)
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    return b''.join([b'\x89PNG\r\n\x1a\n',
+                     chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)),
+                     chunk(b'IDAT', zlib.compress(scanlines.tobytes(), 6)),
+                     chunk(b'IEND', b'')])
+
+
+def png_data_uri(png):
+    """Build a data URI for a PNG so it can be used as an image layer source without another request"""
+
+    return 'data:image/png;base64,' + base64.b64encode(png).decode('ascii')
@@ -0,0 +1,246 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import xanthosvis.geometry as xvg
+import xanthosvis.util_functions as xvu
+
+# Source reference files compiled into the bundle
+REFERENCE_FILE = 'xanthos_0p5deg_landcell_reference.csv'
+BASINS_FILE = 'gcam_basins.geojson'
+COUNTRIES_FILE = 'world.geojson'
+
+# Boundary sets served by the app as (name, source file, feature property figures match locations on)
+GEOMETRY_SOURCES = [('basins', BASINS_FILE, 'basin_id'), ('countries', COUNTRIES_FILE, 'name')]
+
+# Files making up a bundle
+META_FILE = 'bundle.json'
+GEOJSON_FILE = '{}.json'
+GEOJSON_GZIP_FILE = '{}.json.gz'
+
+# Bundles written by a different version of this module are rebuilt
+BUNDLE_VERSION = 1
+
+
+def source_stamps(reference_dir):
+    """Get the size and modification time of each source reference file, to tell when a bundle is out of date
+
+    :param reference_dir:           Directory holding the source reference files
+    :type reference_dir:            str
+
+    :return:                        dict; [size, modification time] of each source file
+
+    """
+
+    stamps = dict()
+    for name in [REFERENCE_FILE, BASINS_FILE, COUNTRIES_FILE]:
+        stat = os.stat(os.path.join(reference_dir, name))
+        stamps[name] = [stat.st_size, stat.st_mtime_ns]
+
+    return stamps
+
+
+def build_bundle(reference_dir, bundle_dir):
+    """Compile the reference files into a bundle: a typed array per reference table column and each boundary set's
+    simplified geometry serialized and compressed once
+
+    :param reference_dir:           Directory holding the source reference files
+    :type reference_dir:            str
+
+    :param bundle_dir:              Directory to write the bundle to
+    :type bundle_dir:               str
+
+    """
+
+    stamps = source_stamps(reference_dir)
+
+    # Write to a temporary directory first so a partially written bundle is never read
+    parent_dir = os.path.dirname(os.path.abspath(bundle_dir))
+    os.makedirs(parent_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix='.bundle', dir=parent_dir)
+
+    try:
+        # Reference table columns, text columns are written as codes with their labels in the metadata
+        df_ref = pd.read_csv(os.path.join(reference_dir, REFERENCE_FILE))
+        labels = dict()
+        for name in df_ref.columns:
+            if not pd.api.types.is_numeric_dtype(df_ref[name]):
+                codes, uniques = pd.factorize(df_ref[name])
+                np.save(os.path.join(tmp_dir, name + '.npy'), codes)
+                labels[name] = uniques.tolist()
+            else:
+                np.save(os.path.join(tmp_dir, name + '.npy'), df_ref[name].to_numpy())
+
+        # Simplified geometry levels, written exactly as they are served
+        geometry = dict()
+        for geometry_name, source_file, geometry_key in GEOMETRY_SOURCES:
+            if source_file == BASINS_FILE:
+                features = xvu.process_geojson(os.path.join(reference_dir, source_file))
+            else:
+                with open(os.path.join(reference_dir, source_file), encoding='utf-8-sig', errors='ignore') as get:
+                    features = json.load(get)
+
+            geometry[geometry_name] = []
+            for level, level_features in enumerate(xvg.build_geometry_levels(features, [geometry_key])):
+                resource_name = f"{geometry_name}-{level}"
+                resource = xvu.build_geojson_resource(level_features)
+                with open(os.path.join(tmp_dir, GEOJSON_FILE.format(resource_name)), 'wb') as out:
+                    out.write(resource['body'])
+                with open(os.path.join(tmp_dir, GEOJSON_GZIP_FILE.format(resource_name)), 'wb') as out:
+                    out.write(resource['gzip'])
+                geometry[geometry_name].append({'name': resource_name, 'etag': resource['etag']})
+
+        meta = {'version': BUNDLE_VERSION, 'sources': stamps, 'columns': df_ref.columns.tolist(), 'labels': labels,
+                'geometry': geometry}
+        with open(os.path.join(tmp_dir, META_FILE), 'w') as out:
+            json.dump(meta, out)
+    except BaseException:
+        # Don't leave a partly written bundle behind
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    # If another worker replaced an out of date bundle first keep that one
+    current = _read_meta(bundle_dir)
+    if current is not None and current['version'] == BUNDLE_VERSION and current['sources'] == stamps:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return
+
+    # Move the old bundle aside instead of removing it before the new one is in place, so workers starting meanwhile
+    # find a bundle, and put it back if the new one can't be moved in
+    old_dir = tempfile.mkdtemp(prefix='.bundle-old', dir=parent_dir)
+    try:
+        os.replace(bundle_dir, old_dir)
+    except FileNotFoundError:
+        pass
+    try:
+        os.replace(tmp_dir, bundle_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not os.path.exists(bundle_dir):
+            os.replace(old_dir, bundle_dir)
+            return
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def load_bundle(reference_dir, bundle_dir):
+    """Open the reference bundle, compiling it first if it is missing or older than the source reference files
+
+    :param reference_dir:           Directory holding the source reference files
+    :type reference_dir:            str
+
+    :param bundle_dir:              Directory the bundle is written to
+    :type bundle_dir:               str
+
+    :return:                        ReferenceBundle
+
+    """
+
+    meta = _read_meta(bundle_dir)
+    if meta is None or meta['version'] != BUNDLE_VERSION or meta['sources'] != source_stamps(reference_dir):
+        build_bundle(reference_dir, bundle_dir)
+        meta = _read_meta(bundle_dir)
+
+    return ReferenceBundle(bundle_dir, meta)
+
+
+def _read_meta(bundle_dir):
+    """Read a bundle's metadata, None if there is no bundle"""
+
+    try:
+        with open(os.path.join(bundle_dir, META_FILE)) as get:
+            return json.load(get)
+    except (OSError, ValueError):
+        return None
+
+
+class ReferenceBundle:
+    """Compiled reference data.  The reference table is read from memory mapped typed arrays instead of parsing the
+    csv file, and geometry is read from disk already serialized when it is served, so workers don't hold it.
+
+    :param bundle_dir:              Directory holding the bundle
+    :type bundle_dir:               str
+
+    :param meta:                    Bundle metadata
+    :type meta:                     dict
+
+    """
+
+    def __init__(self, bundle_dir, meta):
+        self.bundle_dir = bundle_dir
+        self.meta = meta
+
+    def read_df_ref(self):
+        """Read the reference data frame from the bundle's arrays.  The frame is built in memory and not kept, callers
+        build what they need from it once, e.g. the ReferenceIndex, and let it go.
+
+        :return:                        dataframe; reference table
+
+        """
+
+        columns = dict()
+        for name in self.meta['columns']:
+            values = np.load(os.path.join(self.bundle_dir, name + '.npy'), mmap_mode='r')
+            if name in self.meta['labels']:
+                labels = np.append(np.array(self.meta['labels'][name], dtype=object), np.nan)
+                values = labels[values]
+            columns[name] = values
+
+        return pd.DataFrame(columns)
+
+    def geojson_urls(self, geometry_name):
+        """Get the URLs of a boundary set's geometry levels, with each level's ETag in the URL so browsers can cache it
+        for as long as the app serves the same geometry
+
+        :param geometry_name:           Name of the boundary set, basins or countries
+        :type geometry_name:            str
+
+        :return:                        list; URL of each simplification level
+
+        """
+
+        return [f"geojson/{level['name']}.json?v={level['etag']}" for level in self.meta['geometry'][geometry_name]]
+
+    def geojson_etag(self, resource_name):
+        """Get the ETag of a geometry level
+
+        :param resource_name:           Name of the geometry and level, e.g. basins-0
+        :type resource_name:            str
+
+        :return:                        str; ETag of the level's content, or None if there is no such level
+
+        """
+
+        for levels in self.meta['geometry'].values():
+            for level in levels:
+                if level['name'] == resource_name:
+                    return level['etag']
+
+        return None
+
+    def read_geojson(self, resource_name, compressed=False):
+        """Read a serialized geometry level from the bundle
+
+        :param resource_name:           Name of the geometry and level, e.g. basins-0
+        :type resource_name:            str
+
+        :param compressed:              True to read the gzip compressed body
+        :type compressed:               bool
+
+        :return:                        bytes; geojson body
+
+        """
+
+        file_name = (GEOJSON_GZIP_FILE if compressed else GEOJSON_FILE).format(resource_name)
+        with open(os.path.join(self.bundle_dir, file_name), 'rb') as get:
+            return get.read()
+
+
+if __name__ == '__main__':
+    # Compile the bundle ahead of deployment: python -m xanthosvis.reference_bundle <reference dir> [<bundle dir>]
+    source_dir = sys.argv[1]
+    build_bundle(source_dir, sys.argv[2] if len(sys.argv) > 2 else os.path.join(source_dir, 'bundle'))
@@ -0,0 +1,158 @@
+import types
+
+import numpy as np
+import pandas as pd
+
+import xanthosvis.raster as xvr
+import xanthosvis.util_functions as xvu
+
+# Areas figures are drawn by, the reference fields holding each grid cell's area
+AREA_KEYS = ['basin_id', 'country_name']
+
+
+class ReferenceIndex:
+    """Lookups from the landcell reference, built once at startup so requests never search or group the reference
+    table.  The index is read only: its arrays can't be written and its mappings can't be changed, so it is safely
+    shared by threads and, under gunicorn --preload, by forked workers.
+
+    :param df_ref:                  Reference data frame from package
+    :type df_ref:                   dataframe
+
+    """
+
+    def __init__(self, df_ref):
+
+        # Reference columns by row, for building the per grid cell frames of grid views
+        self.columns = types.MappingProxyType({name: _read_only(df_ref[name].to_numpy(copy=True))
+                                               for name in df_ref.columns if name != 'grid_id'})
+        self.grid_ids = _read_only(df_ref['grid_id'].to_numpy(dtype=np.int64, copy=True))
+
+        # Dense id to row indexes and a grid position to row lookup
+        self.grid_rows = _read_only(xvu.build_id_index(df_ref['grid_id']))
+        self.basin_rows = _read_only(xvu.build_id_index(df_ref['basin_id']))
+        self.cell_grid = _read_only(xvr.build_cell_grid(df_ref['longitude'].to_numpy(), df_ref['latitude'].to_numpy()))
+
+        # Names of each basin and id of each country
+        self.basin_names = _read_only_dict(df_ref[['basin_id', 'basin_name']].values)
+        self.country_ids = _read_only_dict(df_ref[['country_name', 'country_id']].values)
+
+        # Countries each basin overlaps and basins each country overlaps, in reference row order
+        self.basin_country_ids = _read_only_dict(_members(df_ref, 'basin_id', 'country_id'))
+        self.basin_country_names = _read_only_dict(_members(df_ref, 'basin_id', 'country_name'))
+        self.country_basin_ids = _read_only_dict(_members(df_ref, 'country_name', 'basin_id'))
+
+        # Per area totals and extents: land area in hectares, max grid id and [lon min, lon max, lat min, lat max]
+        self.area_hectares = dict()
+        self.max_grid_id = dict()
+        self.bounds = dict()
+        self.aggregations = dict()
+        for area_key in AREA_KEYS:
+            grp = df_ref.groupby(area_key)
+            self.area_hectares[area_key] = _read_only_dict(grp['area_hectares'].sum().items())
+            self.max_grid_id[area_key] = _read_only_dict(grp['grid_id'].max().items())
+            df_bounds = grp[['longitude', 'latitude']].agg(['min', 'max'])
+            self.bounds[area_key] = _read_only_dict(zip(df_bounds.index, df_bounds.to_numpy(dtype=np.float64).tolist()))
+
+            # Sparse grid cell to area matrices used to build the basin and country cubes of each uploaded dataset
+            aggregation = xvu.build_area_aggregation(df_ref, area_key)
+            _read_only(aggregation['labels'])
+            _read_only(aggregation['area'])
+            self.aggregations[area_key] = types.MappingProxyType(aggregation)
+
+        self.area_hectares = types.MappingProxyType(self.area_hectares)
+        self.max_grid_id = types.MappingProxyType(self.max_grid_id)
+        self.bounds = types.MappingProxyType(self.bounds)
+        self.aggregations = types.MappingProxyType(self.aggregations)
+
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError("ReferenceIndex is read only")
+        super().__setattr__(name, value)
+
+    def rows_of(self, grid_ids):
+        """Get the reference rows of grid cells
+
+        :param grid_ids:                Grid cell ids
+        :type grid_ids:                 array
+
+        :return:                        array; reference row of each grid cell, -1 for cells not in the reference
+
+        """
+
+        grid_ids = np.asarray(grid_ids, dtype=np.int64)
+        found = (grid_ids >= 0) & (grid_ids < len(self.grid_rows))
+        if not found.any():
+            return np.full(len(grid_ids), -1, dtype=np.int64)
+
+        return np.where(found, self.grid_rows[np.where(found, grid_ids, 0)], -1)
+
+    def take(self, name, rows):
+        """Get a reference column at rows, missing (-1) rows are nan
+
+        :param name:                    Reference column
+        :type name:                     str
+
+        :param rows:                    Reference rows, from rows_of
+        :type rows:                     array
+
+        :return:                        array; column values
+
+        """
+
+        return pd.api.extensions.take(self.columns[name], rows, allow_fill=True)
+
+    def cell_frame(self, grid_ids):
+        """Get the reference fields of grid cells, in the order of the ids
+
+        :param grid_ids:                Grid cell ids
+        :type grid_ids:                 array
+
+        :return:                        dataframe; reference fields of each grid cell, nan for cells not in the
+                                        reference
+
+        """
+
+        rows = self.rows_of(grid_ids)
+
+        return pd.DataFrame({name: self.take(name, rows) for name in self.columns})
+
+    def area_extent(self, area_key, area_ids):
+        """Get the bounding box of the grid cells of several areas
+
+        :param area_key:                Type of area (basin_id or country_name)
+        :type area_key:                 str
+
+        :param area_ids:                Areas to cover
+        :type area_ids:                 list
+
+        :return:                        tuple; lon min, lon max, lat min, lat max, nan if none of the areas have cells
+
+        """
+
+        bounds = np.array([self.bounds[area_key][i] for i in set(area_ids) if i in self.bounds[area_key]])
+        if len(bounds) == 0:
+            return np.nan, np.nan, np.nan, np.nan
+
+        return bounds[:, 0].min(), bounds[:, 1].max(), bounds[:, 2].min(), bounds[:, 3].max()
+
+
+def _read_only(values):
+    """Mark an array read only, returning it"""
+
+    values.setflags(write=False)
+
+    return values
+
+
+def _read_only_dict(items):
+    """Build a read only dict from key, value pairs"""
+
+    return types.MappingProxyType(dict(items))
+
+
+def _members(df_ref, area_key, member_key):
+    """Get the unique values of a field for each area, in reference row order"""
+
+    return df_ref.groupby(area_key)[member_key].unique().map(lambda u: u.tolist()).items()
@@ -0,0 +1,77 @@
+"""Measure how long the app takes to start and how much memory it holds, to keep worker boot and scale out fast.
+
+Each measurement runs in a fresh Python process from the app's directory, the same as a gunicorn worker:
+
+    python -m xanthosvis.startup_benchmark [repeats]
+
+License:  BSD 2-Clause, see LICENSE and DISCLAIMER files
+
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+# Run in the child process: import the app, load it as gunicorn --preload does in the master, then fork a worker and
+# time its first request
+CHILD_SCRIPT = '''
+import json, os, resource, sys, time
+
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+server = main.create_app()
+created = time.perf_counter()
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+read_fd, write_fd = os.pipe()
+forked = time.perf_counter()
+pid = os.fork()
+if pid == 0:
+    server.test_client().get('/_dash-layout')
+    os.write(write_fd, str(time.perf_counter() - forked).encode())
+    os._exit(0)
+os.waitpid(pid, 0)
+first_request = float(os.read(read_fd, 64))
+
+print(json.dumps({'import': imported - start, 'create_app': created - imported, 'worker_first_request': first_request,
+                  'max_rss_mb': rss / 1024}))
+'''
+
+
+def measure(app_dir):
+    """Start the app once in a fresh process
+
+    :param app_dir:                 Directory holding main.py
+    :type app_dir:                  str
+
+    :return:                        dict; seconds to import the app, load it with create_app and for a forked worker
+                                    to answer its first request, and the peak memory of the process in MB
+
+    """
+
+    output = subprocess.run([sys.executable, '-c', CHILD_SCRIPT], cwd=app_dir, check=True, stdout=subprocess.PIPE)
+
+    return json.loads(output.stdout.decode().strip().splitlines()[-1])
+
+
+def run(repeats=5):
+    """Start the app several times and report the median of each measurement
+
+    :param repeats:                 Number of times to start the app
+    :type repeats:                  int
+
+    :return:                        dict; median of each measurement
+
+    """
+
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    results = [measure(app_dir) for _ in range(repeats)]
+
+    return {name: sorted(r[name] for r in results)[len(results) // 2] for name in results[0]}
+
+
+if __name__ == '__main__':
+    for measurement, value in run(int(sys.argv[1]) if len(sys.argv) > 1 else 5).items():
+        print(f"{measurement:>22}: {value:.3f}")
@@ -0,0 +1,281 @@
+"""Tests for the dataset store.
+
+License:  BSD 2-Clause, see LICENSE and DISCLAIMER files
+
+"""
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from xanthosvis.dataset_store import DatasetStore, free_bytes, get_upload_path, remove_upload
+from xanthosvis.util_functions import build_area_aggregation, compute_statistic
+
+
+class TestDatasetStore(unittest.TestCase):
+    """Tests for the `DatasetStore` class that writes prepared datasets to disk."""
+
+    COLUMNS = ['198001', '198002', '198003']
+
+    # datasets are keyed by the sha256 digest of the uploaded file
+    KEY = 'a' * 64
+
+    def prepared_data(self):
+        """Build a small prepared data frame like the output of `prepare_data`."""
+
+        return pd.DataFrame({'id': [3, 1, 2],
+                             '198001': [1.0, 2.0, np.nan],
+                             '198002': [4.0, 5.0, 6.0],
+                             '198003': [7.0, 8.0, 9.0],
+                             'basin_id': [1, 1, 2],
+                             'country_name': ['Aruba', np.nan, 'Angola'],
+                             'country_id': [1.0, np.nan, 2.0],
+                             'area': [10.0, 20.0, 30.0]})
+
+    def test_round_trip(self):
+        """Test that a dataset read back from the store matches what was written."""
+
+        df = self.prepared_data()
+
+        with tempfile.TemporaryDirectory() as dirpath:
+            store = DatasetStore(dirpath)
+            store.put(TestDatasetStore.KEY, df, TestDatasetStore.COLUMNS)
+
+            self.assertTrue(store.has(TestDatasetStore.KEY))
+            dataset = store.get(TestDatasetStore.KEY)
+
+            pd.testing.assert_frame_equal(dataset.to_frame(TestDatasetStore.COLUMNS), df, check_dtype=False)
+
+            # only the chosen columns are returned
+            subset = dataset.to_frame(['198001', '198003'])
+            self.assertEqual(list(subset.columns), ['id', '198001', '198003', 'basin_id', 'country_name',
+                                                    'country_id', 'area'])
+            np.testing.assert_array_equal(subset['198003'], df['198003'])
+
+            # grid cells are found by id through the dense row index
+            self.assertEqual(dataset.row_of(1), 1)
+            self.assertRaises(KeyError, dataset.row_of, 4)
+
+            store.remove(TestDatasetStore.KEY)
+            self.assertFalse(store.has(TestDatasetStore.KEY))
+            self.assertIsNone(store.get(TestDatasetStore.KEY))
+
+    def test_put_chunks(self):
+        """Test that a dataset written in chunks matches one written at once, whether the chunks hold fewer rows
+        than expected, e.g. rows skipped by the parser, or more."""
+
+        df = self.prepared_data()
+
+        for n_rows in [len(df) + 1, 1]:
+            with tempfile.TemporaryDirectory() as dirpath:
+                store = DatasetStore(dirpath)
+                store.put_chunks(TestDatasetStore.KEY, [df[:1], df[1:2], df[2:]], n_rows, TestDatasetStore.COLUMNS)
+                dataset = store.get(TestDatasetStore.KEY)
+
+                pd.testing.assert_frame_equal(dataset.to_frame(TestDatasetStore.COLUMNS), df, check_dtype=False)
+                self.assertEqual(dataset.values.shape, (len(df), len(TestDatasetStore.COLUMNS)))
+
+    def test_failed_put(self):
+        """Test that a dataset that fails to ingest partway leaves nothing in the store, and that temporary directories
+        left by a stopped worker are collected."""
+
+        df = self.prepared_data()
+
+        def chunks():
+            yield df[:2]
+            raise ValueError('bad chunk')
+
+        with tempfile.TemporaryDirectory() as dirpath:
+            store = DatasetStore(dirpath)
+            self.assertRaises(ValueError, store.put_chunks, TestDatasetStore.KEY, chunks(), len(df),
+                              TestDatasetStore.COLUMNS)
+            self.assertEqual(os.listdir(dirpath), [])
+
+            stale_dir = os.path.join(dirpath, '.' + TestDatasetStore.KEY + 'tmp')
+            os.makedirs(stale_dir)
+            store.collect()
+            self.assertTrue(os.path.isdir(stale_dir))
+
+            os.utime(stale_dir, (0, 0))
+            store.collect()
+            self.assertEqual(os.listdir(dirpath), [])
+
+    def test_reference_counting(self):
+        """Test that a shared dataset is only removed once no session references it."""
+
+        with tempfile.TemporaryDirectory() as dirpath:
+            store = DatasetStore(dirpath)
+            store.put(TestDatasetStore.KEY, self.prepared_data(), TestDatasetStore.COLUMNS, 'session1')
+            store.acquire(TestDatasetStore.KEY, 'session2')
+            self.assertEqual(store.ref_count(TestDatasetStore.KEY), 2)
+
+            store.release(TestDatasetStore.KEY, 'session1')
+            store.collect()
+            self.assertTrue(store.has(TestDatasetStore.KEY))
+
+            store.release(TestDatasetStore.KEY, 'session2')
+            self.assertFalse(store.has(TestDatasetStore.KEY))
+
+    def test_concurrent_put(self):
+        """Test that a session storing a dataset another worker already stored references the stored copy."""
+
+        with tempfile.TemporaryDirectory() as dirpath:
+            store = DatasetStore(dirpath)
+            store.put(TestDatasetStore.KEY, self.prepared_data(), TestDatasetStore.COLUMNS, 'session1')
+            store.put(TestDatasetStore.KEY, self.prepared_data(), TestDatasetStore.COLUMNS, 'session2')
+
+            self.assertEqual(store.ref_count(TestDatasetStore.KEY), 2)
+            self.assertEqual([e for e in os.listdir(dirpath) if e != TestDatasetStore.KEY], [])
+
+    def test_eviction(self):
+        """Test that unreferenced datasets are kept until the budget is exceeded, and referenced ones are pinned."""
+
+        with tempfile.TemporaryDirectory() as dirpath:
+            store = DatasetStore(dirpath)
+            store.put('a' * 64, self.prepared_data(), TestDatasetStore.COLUMNS, 'session1')
+            store.max_bytes = store.size('a' * 64) * 3 // 2
+
+            # released datasets stay in the store while it is within budget
+            store.release('a' * 64, 'session1')
+            self.assertTrue(store.has('a' * 64))
+
+            # the unreferenced dataset is evicted to make room
+            store.put('b' * 64, self.prepared_data(), TestDatasetStore.COLUMNS, 'session2')
+            self.assertFalse(store.has('a' * 64))
+
+            # referenced datasets are never evicted, even over budget
+            store.put('c' * 64, self.prepared_data(), TestDatasetStore.COLUMNS, 'session3')
+            self.assertTrue(store.has('b' * 64) and store.has('c' * 64))
+
+            store.release('b' * 64, 'session2')
+            store.collect()
+            self.assertFalse(store.has('b' * 64))
+            self.assertTrue(store.has('c' * 64))
+
+    def test_overflow(self):
+        """Test that a dataset the store's filesystem hasn't the free space for is written to the overflow directory
+        and found there."""
+
+        df = self.prepared_data()
+
+        with tempfile.TemporaryDirectory() as dirpath:
+            root_dir, overflow_dir = os.path.join(dirpath, 'shm'), os.path.join(dirpath, 'disk')
+            store = DatasetStore(root_dir, overflow_dir=overflow_dir)
+            self.assertGreater(free_bytes(os.path.join(root_dir, 'missing')), 0)
+
+            with mock.patch('xanthosvis.dataset_store.free_bytes', return_value=0):
+                store.put_chunks('a' * 64, [df], len(df), TestDatasetStore.COLUMNS, 'session1')
+            store.put_chunks('b' * 64, [df], len(df), TestDatasetStore.COLUMNS, 'session1')
+
+            self.assertEqual(os.listdir(overflow_dir), ['a' * 64])
+            self.assertEqual(os.listdir(root_dir), ['b' * 64])
+            pd.testing.assert_frame_equal(store.get('a' * 64).to_frame(TestDatasetStore.COLUMNS), df,
+                                          check_dtype=False)
+
+            store.release('a' * 64, 'session1')
+            self.assertFalse(store.has('a' * 64))
+            self.assertEqual(os.listdir(overflow_dir), [])
+
+    def test_area_cubes(self):
+        """Test that area cubes materialized when storing a dataset hold the area sums."""
+
+        df_ref = pd.DataFrame({'grid_id': [1, 2, 3, 4],
+                               'basin_id': [1, 2, 1, 3],
+                               'area_hectares': [20.0, 30.0, 10.0, 40.0]})
+        aggregations = {'basin_id': build_area_aggregation(df_ref, 'basin_id')}
+
+        with tempfile.TemporaryDirectory() as dirpath:
+            store = DatasetStore(dirpath)
+            store.put(TestDatasetStore.KEY, self.prepared_data(), TestDatasetStore.COLUMNS,
+                      aggregations=aggregations)
+            dataset = store.get(TestDatasetStore.KEY)
+
+            # basin 3 has no grid cells in the data so it is left out
+            labels, sums, area = dataset.read_cube('basin_id', [0, 2])
+            np.testing.assert_array_equal(labels, [1, 2])
+            np.testing.assert_array_equal(sums, [[3.0, 15.0], [0.0, 9.0]])
+            np.testing.assert_array_equal(area, [30.0, 30.0])
+
+            labels, sums, area = dataset.read_cube('basin_id', [1], area_ids=[2])
+            np.testing.assert_array_equal(labels, [2])
+            np.testing.assert_array_equal(sums, [[6.0]])
+
+    def test_range_statistics(self):
+        """Test that year range statistics answered from the range index match those computed from the values."""
+
+        df = self.prepared_data()
+
+        with tempfile.TemporaryDirectory() as dirpath:
+            store = DatasetStore(dirpath)
+            store.put(TestDatasetStore.KEY, df, TestDatasetStore.COLUMNS)
+            dataset = store.get(TestDatasetStore.KEY)
+
+            for statistic in ['mean', 'median', 'min', 'max', 'standard deviation']:
+                np.testing.assert_allclose(dataset.read_statistic(np.array([0, 1]), statistic, rows=[0, 1]),
+                                           compute_statistic(df[['198001', '198002']].to_numpy()[:2], statistic))
+
+                # month filtered ranges are answered from the index of each month
+                np.testing.assert_allclose(dataset.read_statistic(np.array([0, 2]), statistic),
+                                           compute_statistic(df[['198001', '198003']].to_numpy(), statistic))
+
+    def test_ingest_lock(self):
+        """Test that sessions ingesting the same dataset at once take turns, the later finding the stored dataset."""
+
+        ingested = []
+
+        def ingest(store):
+            with store.ingest_lock(TestDatasetStore.KEY):
+                if not store.has(TestDatasetStore.KEY):
+                    time.sleep(0.05)
+                    store.put(TestDatasetStore.KEY, self.prepared_data(), TestDatasetStore.COLUMNS)
+                    ingested.append(1)
+
+        with tempfile.TemporaryDirectory() as dirpath:
+            threads = [threading.Thread(target=ingest, args=(DatasetStore(dirpath),)) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(len(ingested), 1)
+            self.assertEqual(os.listdir(dirpath), [TestDatasetStore.KEY])
+            self.assertRaises(ValueError, DatasetStore(dirpath).ingest_lock('../key').__enter__)
+
+    def test_invalid_key(self):
+        """Test that keys that are not content hashes are rejected."""
+
+        with tempfile.TemporaryDirectory() as dirpath:
+            store = DatasetStore(dirpath)
+            self.assertRaises(ValueError, store.get, '../key')
+
+
+class TestUploads(unittest.TestCase):
+    """Tests for the files written by the upload endpoint."""
+
+    def test_invalid_handle(self):
+        """Test that handles that don't name an upload are rejected before any file is touched."""
+
+        with tempfile.TemporaryDirectory() as dirpath:
+            upload_dir = os.path.join(dirpath, 'uploads')
+            victim = os.path.join(dirpath, 'victim.py')
+            open(victim, 'w').close()
+
+            self.assertEqual(get_upload_path(upload_dir, {'id': 'a' * 64, 'upload': 'b' * 32, 'filename': ['run.CSV']}),
+                             os.path.join(upload_dir, 'a' * 64 + '.' + 'b' * 32 + '.csv'))
+
+            for handle in [{'id': '../victim', 'upload': 'b' * 32, 'filename': ['a.py']},
+                           {'id': 'a' * 64, 'upload': 'b' * 32, 'filename': ['a.py']},
+                           {'id': 'a' * 64, 'upload': '../../victim', 'filename': ['a.csv']},
+                           {'id': 'a' * 64, 'filename': ['a.csv']}]:
+                self.assertRaises(ValueError, remove_upload, upload_dir, handle)
+            self.assertTrue(os.path.exists(victim))
+
+
+if __name__ == '__main__':
+    unittest.main()
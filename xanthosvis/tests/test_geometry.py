@@ -0,0 +1,75 @@
+"""Tests for the geometry simplification.
+
+License:  BSD 2-Clause, see LICENSE and DISCLAIMER files
+
+"""
+
+import unittest
+
+import numpy as np
+
+import xanthosvis.geometry as xvg
+
+
+class TestGeometry(unittest.TestCase):
+    """Tests for simplifying basin and country boundaries."""
+
+    # Wiggly border from (0, 0) to (0, 4) shared by a west and an east area
+    BORDER = [[0, 0], [0.01, 1], [-0.01, 2], [0.01, 3], [0, 4]]
+
+    def features(self):
+        """Build two polygons sharing the wiggly border, traversed in opposite directions."""
+
+        west = [[-2, 0]] + TestGeometry.BORDER + [[-2, 4], [-2, 0]]
+        east = [[2, 4]] + TestGeometry.BORDER[::-1] + [[2, 0], [2, 4]]
+
+        return {'type': 'FeatureCollection',
+                'features': [{'type': 'Feature', 'properties': {'name': 'west', 'pop': 1},
+                              'geometry': {'type': 'Polygon', 'coordinates': [west]}},
+                             {'type': 'Feature', 'properties': {'name': 'east', 'pop': 2},
+                              'geometry': {'type': 'MultiPolygon', 'coordinates': [[east]]}}]}
+
+    def test_douglas_peucker(self):
+        """Test that vertices within the tolerance of the simplified line are dropped."""
+
+        points = np.array([[0, 0], [1, 0.55], [2, 1], [3, 0.45], [4, 0]], dtype=np.float64)
+
+        np.testing.assert_array_equal(xvg.douglas_peucker(points, 0.1), [True, False, True, False, True])
+        np.testing.assert_array_equal(xvg.douglas_peucker(points, 2), [True, False, False, False, True])
+
+    def test_shared_border(self):
+        """Test that a shared border is simplified the same way in both polygons."""
+
+        levels = xvg.build_geometry_levels(self.features(), ['name'], [(0, 0.1), (5, 0)])
+        west, east = levels[0]['features']
+
+        west_ring = west['geometry']['coordinates'][0]
+        east_ring = east['geometry']['coordinates'][0][0]
+
+        # the wiggles are gone and both sides keep the same border vertices
+        self.assertNotIn([0.01, 1], west_ring)
+        self.assertEqual({tuple(p) for p in west_ring if p[0] == 0}, {tuple(p) for p in east_ring if p[0] == 0})
+        self.assertEqual(west_ring[0], west_ring[-1])
+
+        # only the requested properties are kept, and the full resolution level keeps every vertex
+        self.assertEqual(west['properties'], {'name': 'west'})
+        self.assertIn([0.01, 1], levels[1]['features'][0]['geometry']['coordinates'][0])
+
+    def test_points_in_polygon(self):
+        """Test that points inside a lasso polygon are selected."""
+
+        triangle = [[0, 0], [4, 0], [0, 4]]
+
+        np.testing.assert_array_equal(xvg.points_in_polygon([1, 3, -1, 1.5], [1, 3, 1, 0.5], triangle),
+                                      [True, False, False, True])
+
+    def test_level_for_zoom(self):
+        """Test that the level with the highest minimum zoom below the map zoom is chosen."""
+
+        levels = [(0, 0.2), (2, 0.05), (5, 0)]
+
+        self.assertEqual([xvg.level_for_zoom(z, levels) for z in [0, 0.6, 2, 4.9, 5, 10]], [0, 0, 1, 1, 2, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+"""Tests for the job queue.
+
+License:  BSD 2-Clause, see LICENSE and DISCLAIMER files
+
+"""
+
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from xanthosvis.job_queue import JobQueue
+
+
+def square(x, progress):
+    """Job reporting its progress before returning."""
+
+    progress(0.5, 'halfway')
+
+    return x * x
+
+
+def fail(progress):
+    """Job raising an error."""
+
+    raise ValueError('no data')
+
+
+class TestJobQueue(unittest.TestCase):
+    """Tests for the `JobQueue` class that runs jobs in a pool of processes."""
+
+    def wait(self, queue, job_id):
+        """Wait for a job to finish, returning its status."""
+
+        for _ in range(200):
+            status = queue.status(job_id)
+            if status['state'] in ('done', 'error'):
+                return status
+            time.sleep(0.05)
+
+        self.fail('job did not finish')
+
+    def test_result(self):
+        """Test that a job's result is read back once it is done."""
+
+        with tempfile.TemporaryDirectory() as dirpath:
+            queue = JobQueue(dirpath, max_workers=1)
+            try:
+                job_id = queue.submit(JobQueue.job_id('square', 3), square, 3)
+
+                # ids are built from the inputs
+                self.assertEqual(job_id, JobQueue.job_id('square', 3))
+                self.assertNotEqual(job_id, JobQueue.job_id('square', 4))
+
+                self.assertEqual(self.wait(queue, job_id)['state'], 'done')
+                self.assertEqual(queue.status(job_id)['progress'], 1)
+                self.assertEqual(queue.result(job_id), 9)
+
+                # a job already done isn't run again
+                mtime = os.path.getmtime(os.path.join(dirpath, f"{job_id}.result"))
+                self.assertEqual(queue.submit(job_id, square, 3), job_id)
+                self.assertEqual(os.path.getmtime(os.path.join(dirpath, f"{job_id}.result")), mtime)
+
+                # unknown jobs have no status or result
+                self.assertIsNone(queue.status('missing'))
+                self.assertIsNone(queue.result('missing'))
+            finally:
+                queue.shutdown()
+
+    def test_error(self):
+        """Test that a failed job reports its error and is run again when resubmitted."""
+
+        with tempfile.TemporaryDirectory() as dirpath:
+            queue = JobQueue(dirpath, max_workers=1)
+            try:
+                job_id = queue.submit('failing', fail)
+                status = self.wait(queue, job_id)
+
+                self.assertEqual(status['state'], 'error')
+                self.assertEqual(status['message'], 'no data')
+                self.assertIsNone(queue.result(job_id))
+
+                queue.submit(job_id, square, 2)
+                self.assertEqual(self.wait(queue, job_id)['state'], 'done')
+                self.assertEqual(queue.result(job_id), 4)
+            finally:
+                queue.shutdown()
+
+    def test_stale(self):
+        """Test that jobs without status updates are reported as failed, and old jobs are collected."""
+
+        with tempfile.TemporaryDirectory() as dirpath:
+            queue = JobQueue(dirpath, job_timeout=60, stale_timeout=10)
+
+            # a job left running by a worker that was restarted
+            status_path = os.path.join(dirpath, 'stopped.json')
+            with open(status_path, 'w') as f:
+                json.dump({'state': 'running', 'progress': 0.25, 'message': '', 'updated': time.time() - 30}, f)
+
+            status = queue.status('stopped')
+            self.assertEqual(status['state'], 'error')
+            self.assertEqual(status['progress'], 0.25)
+
+            self.assertEqual(queue.collect(), 0)
+            os.utime(status_path, (time.time() - 120, time.time() - 120))
+            self.assertEqual(queue.collect(), 1)
+            self.assertIsNone(queue.status('stopped'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+"""Tests for the time range statistics index.
+
+License:  BSD 2-Clause, see LICENSE and DISCLAIMER files
+
+"""
+
+import unittest
+
+import numpy as np
+
+import xanthosvis.range_query as xrq
+import xanthosvis.util_functions as xvu
+
+
+class TestRangeQuery(unittest.TestCase):
+    """Tests for answering year range statistics from the range index."""
+
+    def values(self):
+        """Build rows of values with missing values, including a row with none."""
+
+        values = np.random.default_rng(1).normal(500, 20, (4, 23))
+        values[values < 490] = np.nan
+        values[3] = np.nan
+
+        return values
+
+    def test_matches_compute_statistic(self):
+        """Test that every range gives the same statistics as computing them from the values in the range."""
+
+        values = self.values()
+        range_index = xrq.build_range_index(values, block_size=4)
+
+        for start in range(values.shape[1]):
+            for stop in range(start + 1, values.shape[1] + 1):
+                for statistic in xrq.RANGE_STATISTICS:
+                    np.testing.assert_allclose(xrq.query_range(range_index, values, start, stop, statistic,
+                                                               block_size=4),
+                                               xvu.compute_statistic(values[:, start:stop], statistic),
+                                               rtol=1e-10, err_msg=f"{statistic} {start}:{stop}")
+
+    def test_rows(self):
+        """Test that only the chosen rows are computed."""
+
+        values = self.values()
+        range_index = xrq.build_range_index(values, block_size=4)
+
+        np.testing.assert_allclose(xrq.query_range(range_index, values, 2, 21, 'max', rows=[2, 0], block_size=4),
+                                   np.nanmax(values[[2, 0], 2:21], axis=1))
+        self.assertRaises(ValueError, xrq.query_range, range_index, values, 2, 21, 'median', block_size=4)
+
+    def test_months(self):
+        """Test that indexes of each month's columns combine to the statistics of a month filtered range."""
+
+        values = np.random.default_rng(2).normal(500, 20, (3, 12 * 9))
+        values[values < 490] = np.nan
+        months = np.tile(np.arange(1, 13), 9)
+        shift = xrq.row_means(values)
+
+        # the chosen months of the third through eighth years
+        chosen = [1, 6, 7]
+        positions = np.flatnonzero(np.isin(months, chosen))
+        positions = positions[(positions >= 24) & (positions < 96)]
+
+        for statistic in xrq.RANGE_STATISTICS:
+            totals = []
+            for month in chosen:
+                columns = np.flatnonzero(months == month)
+                range_index = xrq.build_range_index(values, 2, columns, shift, max_levels=1)
+                totals.append(xrq.range_totals(range_index, values, 2, 8, statistic, block_size=2, columns=columns))
+
+            np.testing.assert_allclose(xrq.finish_statistic(xrq.combine_totals(totals), statistic),
+                                       xvu.compute_statistic(values[:, positions], statistic), rtol=1e-10)
+
+    def test_is_range(self):
+        """Test that only contiguous increasing positions are ranges."""
+
+        self.assertTrue(xrq.is_range(np.array([3, 4, 5])))
+        self.assertFalse(xrq.is_range(np.array([3, 5])))
+        self.assertFalse(xrq.is_range(np.array([], dtype=np.intp)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+"""Tests for the grid image and tile rendering.
+
+License:  BSD 2-Clause, see LICENSE and DISCLAIMER files
+
+"""
+
+import os
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+
+import numpy as np
+
+import xanthosvis.raster as xvr
+
+
+class TestRaster(unittest.TestCase):
+    """Tests for drawing grid cells as an image."""
+
+    LON = np.array([-19.75, -19.25, 19.75])
+    LAT = np.array([9.75, 9.75, -9.75])
+
+    def test_encode_png(self):
+        """Test that the PNG header and pixel data decode to the image."""
+
+        rgba = np.arange(2 * 3 * 4, dtype=np.uint8).reshape(2, 3, 4)
+        png = xvr.encode_png(rgba)
+
+        self.assertEqual(png[:8], b'\x89PNG\r\n\x1a\n')
+        self.assertEqual(struct.unpack('>II', png[16:24]), (3, 2))
+
+        idat = png[png.index(b'IDAT') + 4:png.index(b'IEND') - 8]
+        scanlines = np.frombuffer(zlib.decompress(idat), dtype=np.uint8).reshape(2, 13)
+        np.testing.assert_array_equal(scanlines[:, 0], [0, 0])
+        np.testing.assert_array_equal(scanlines[:, 1:].reshape(2, 3, 4), rgba)
+
+    def test_lookup_cell(self):
+        """Test that a coordinate anywhere in a grid cell resolves to its row."""
+
+        cell_grid = xvr.build_cell_grid(TestRaster.LON, TestRaster.LAT)
+
+        self.assertEqual(xvr.lookup_cell(cell_grid, -19.9, 9.6), 0)
+        self.assertEqual(xvr.lookup_cell(cell_grid, -19.1, 9.9), 1)
+        self.assertEqual(xvr.lookup_cell(cell_grid, 19.75 - 360, -9.75), 2)
+        self.assertIsNone(xvr.lookup_cell(cell_grid, 0, 0))
+        self.assertIsNone(xvr.lookup_cell(cell_grid, 0, 95))
+
+    def test_render_grid_image(self):
+        """Test that the image covers the cells' bounding box and missing cells are transparent."""
+
+        lut = xvr.build_color_lut('Plasma')
+        image, coordinates = xvr.render_grid_image(TestRaster.LON, TestRaster.LAT, np.array([0.0, 1.0, np.nan]),
+                                                   0, 1, lut)
+
+        self.assertEqual(coordinates, [[-20, 10], [20, 10], [20, -10], [-20, -10]])
+        self.assertEqual(image.shape[1], 80)
+
+        # cells in the top row are opaque with the first and last colors, the missing cell is transparent
+        np.testing.assert_array_equal(image[0, 0], list(lut[0]) + [255])
+        np.testing.assert_array_equal(image[0, 1], list(lut[-1]) + [255])
+        self.assertEqual(image[-1, -1, 3], 0)
+
+    def test_render_tile(self):
+        """Test that tiles only color the cells within their bounds."""
+
+        lut = xvr.build_color_lut('Plasma')
+        grid = xvr.build_value_grid(TestRaster.LON, TestRaster.LAT, np.array([0.0, 1.0, 0.5]))
+
+        # of the zoom 3 tiles around (0, 0), the northwest tile holds the first two cells, the southeast tile the last
+        # and the northeast tile none
+        northwest = xvr.render_tile(grid, 3, 3, 3, 0, 1, lut)
+        self.assertEqual(northwest.shape, (xvr.TILE_SIZE, xvr.TILE_SIZE, 4))
+        self.assertEqual({tuple(p[:3]) for p in northwest[northwest[..., 3] > 0].tolist()},
+                         {tuple(lut[0].tolist()), tuple(lut[-1].tolist())})
+        self.assertTrue((xvr.render_tile(grid, 3, 4, 4, 0, 1, lut)[..., 3] > 0).any())
+        self.assertFalse((xvr.render_tile(grid, 3, 4, 3, 0, 1, lut)[..., 3] > 0).any())
+
+    def test_byte_lru_cache(self):
+        """Test that the least recently used values are evicted to stay within the size limit."""
+
+        cache = xvr.ByteLRUCache(7)
+        cache.put('a', 1, 3)
+        cache.put('b', 2, 3)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3, 3)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c'), cache.n_bytes), (1, 3, 6))
+
+        # values larger than the cache are not kept
+        cache.put('d', 4, 8)
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(cache.n_bytes, 6)
+
+    def test_get_or_compute(self):
+        """Test that threads missing the same key compute its value once."""
+
+        cache = xvr.ByteLRUCache(100)
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.05)
+            return 'value', 5
+
+        threads = [threading.Thread(target=cache.get_or_compute, args=('a', compute)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.get_or_compute('a', compute), 'value')
+        self.assertEqual(len(calls), 1)
+
+    def test_save_value_grid(self):
+        """Test that a saved grid is read back, and that a missing one reads as None."""
+
+        grid = xvr.build_value_grid(TestRaster.LON, TestRaster.LAT, np.array([1.0, 2.0, 3.0]))
+
+        with tempfile.TemporaryDirectory() as dirpath:
+            file_path = os.path.join(dirpath, 'grid.npy')
+            self.assertIsNone(xvr.load_value_grid(file_path))
+
+            xvr.save_value_grid(file_path, grid)
+            np.testing.assert_array_equal(xvr.load_value_grid(file_path), grid)
+            self.assertEqual(os.listdir(dirpath), ['grid.npy'])
+
+
+if __name__ == '__main__':
+    unittest.main()
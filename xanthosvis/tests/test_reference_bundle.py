@@ -0,0 +1,89 @@
+"""Tests for the compiled reference bundle.
+
+License:  BSD 2-Clause, see LICENSE and DISCLAIMER files
+
+"""
+
+import gzip
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import xanthosvis.reference_bundle as xrb
+
+
+class TestReferenceBundle(unittest.TestCase):
+    """Tests for compiling and loading the reference bundle."""
+
+    def write_sources(self, reference_dir):
+        """Write a small reference table and basin and country boundaries."""
+
+        df_ref = pd.DataFrame({'grid_id': [1, 2, 3], 'longitude': [-0.25, 0.25, 0.75],
+                               'latitude': [0.25, 0.25, 0.25], 'basin_id': [1, 1, 2],
+                               'country_name': ['Aruba', np.nan, 'Angola']})
+        df_ref.to_csv(os.path.join(reference_dir, xrb.REFERENCE_FILE), index=False)
+
+        square = [[[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]]
+        for file_name, properties in [(xrb.BASINS_FILE, {'basin_id': 1, 'basin_name': 'Basin1'}),
+                                      (xrb.COUNTRIES_FILE, {'name': 'Aruba', 'pop': 1})]:
+            with open(os.path.join(reference_dir, file_name), 'w') as out:
+                json.dump({'type': 'FeatureCollection',
+                           'features': [{'type': 'Feature', 'properties': properties,
+                                         'geometry': {'type': 'Polygon', 'coordinates': square}}]}, out)
+
+        return df_ref
+
+    def test_round_trip(self):
+        """Test that the bundle holds the reference table and the served geometry."""
+
+        with tempfile.TemporaryDirectory() as reference_dir:
+            df_ref = self.write_sources(reference_dir)
+            bundle = xrb.load_bundle(reference_dir, os.path.join(reference_dir, 'bundle'))
+
+            df_bundle = bundle.read_df_ref()
+            pd.testing.assert_frame_equal(df_bundle, pd.read_csv(os.path.join(reference_dir, xrb.REFERENCE_FILE)))
+            self.assertEqual(df_bundle['country_name'].isna().tolist(), df_ref['country_name'].isna().tolist())
+
+            # only the property figures match locations on is kept, and the compressed body matches
+            urls = bundle.geojson_urls('countries')
+            self.assertEqual(len(urls), 3)
+            body = bundle.read_geojson('countries-0')
+            self.assertEqual(json.loads(body)['features'][0]['properties'], {'name': 'Aruba'})
+            self.assertEqual(gzip.decompress(bundle.read_geojson('countries-0', compressed=True)), body)
+            self.assertIn(bundle.geojson_etag('countries-0'), urls[0])
+            self.assertIsNone(bundle.geojson_etag('rivers-0'))
+
+    def test_rebuild(self):
+        """Test that the bundle is rebuilt when a source file changes."""
+
+        with tempfile.TemporaryDirectory() as reference_dir:
+            self.write_sources(reference_dir)
+            bundle_dir = os.path.join(reference_dir, 'bundle')
+            xrb.load_bundle(reference_dir, bundle_dir)
+
+            df_ref = pd.DataFrame({'grid_id': [7], 'longitude': [10.25], 'latitude': [10.25], 'basin_id': [3],
+                                   'country_name': ['Aruba']})
+            df_ref.to_csv(os.path.join(reference_dir, xrb.REFERENCE_FILE), index=False)
+
+            self.assertEqual(xrb.load_bundle(reference_dir, bundle_dir).read_df_ref()['grid_id'].tolist(), [7])
+
+            # the old bundle and the temporary directories are removed once the new bundle is in place
+            self.assertEqual([name for name in os.listdir(reference_dir) if name.startswith('.')], [])
+
+    def test_failed_build(self):
+        """Test that a bundle that fails to build leaves no temporary directory behind."""
+
+        with tempfile.TemporaryDirectory() as reference_dir:
+            self.write_sources(reference_dir)
+            os.remove(os.path.join(reference_dir, xrb.COUNTRIES_FILE))
+
+            self.assertRaises(FileNotFoundError, xrb.build_bundle, reference_dir, os.path.join(reference_dir, 'bundle'))
+            self.assertEqual([name for name in os.listdir(reference_dir) if name.startswith('.')], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+"""Tests for the reference index.
+
+License:  BSD 2-Clause, see LICENSE and DISCLAIMER files
+
+"""
+
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import xanthosvis.reference_index as xri
+import xanthosvis.util_functions as xvu
+
+
+class TestReferenceIndex(unittest.TestCase):
+    """Tests for looking up reference data from the index built at startup."""
+
+    def reference(self):
+        """Build a small reference table with a basin spanning two countries and a cell with no country."""
+
+        return pd.DataFrame({'grid_id': [1, 2, 3, 4], 'longitude': [-0.25, 0.25, 10.25, 20.25],
+                             'latitude': [0.25, 1.25, -0.25, 5.25], 'area_hectares': [1.0, 2.0, 4.0, 8.0],
+                             'basin_id': [1, 1, 2, 2], 'basin_name': ['Basin1', 'Basin1', 'Basin2', 'Basin2'],
+                             'country_id': [1, 2, 2, np.nan], 'country_name': ['Aruba', 'Angola', 'Angola', np.nan]})
+
+    def test_membership(self):
+        """Test that names, memberships and area totals match the reference table."""
+
+        ref_index = xri.ReferenceIndex(self.reference())
+
+        self.assertEqual(ref_index.basin_names[2], 'Basin2')
+        self.assertEqual(ref_index.basin_country_names[1], ['Aruba', 'Angola'])
+        self.assertEqual(ref_index.basin_country_ids[1], [1, 2])
+        self.assertEqual(ref_index.country_basin_ids['Angola'], [1, 2])
+        self.assertEqual(ref_index.area_hectares['basin_id'][2], 12.0)
+        self.assertEqual(ref_index.area_hectares['country_name']['Angola'], 6.0)
+        self.assertEqual(ref_index.max_grid_id['country_name']['Angola'], 3)
+        self.assertEqual(ref_index.area_extent('country_name', ['Aruba', 'Angola']), (-0.25, 10.25, -0.25, 1.25))
+
+    def test_prepare_data(self):
+        """Test that uploaded grid cells get their reference fields, and cells missing from the reference get nan."""
+
+        ref_index = xri.ReferenceIndex(self.reference())
+        df = xvu.prepare_data(pd.DataFrame({'id': [3, 1, 9], '1980': [1.0, 2.0, 3.0]}), ref_index)
+
+        self.assertEqual(df['basin_id'].tolist()[:2], [2, 1])
+        self.assertTrue(np.isnan(df['basin_id'].iat[2]))
+        self.assertEqual(df['country_name'].tolist()[:2], ['Angola', 'Aruba'])
+        self.assertEqual(df['area'].tolist()[:2], [4.0, 1.0])
+
+        cells = ref_index.cell_frame(np.array([4, 2]))
+        self.assertEqual(cells['basin_name'].tolist(), ['Basin2', 'Basin1'])
+        self.assertTrue(pd.isna(cells['country_name'].iat[0]))
+
+    def test_read_only(self):
+        """Test that the index can't be changed once it is built."""
+
+        ref_index = xri.ReferenceIndex(self.reference())
+
+        with self.assertRaises(ValueError):
+            ref_index.grid_rows[0] = 5
+        with self.assertRaises(TypeError):
+            ref_index.basin_names[3] = 'Basin3'
+        with self.assertRaises(AttributeError):
+            ref_index.cell_grid = None
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+"""Tests for the data processing functions.
+
+License:  BSD 2-Clause, see LICENSE and DISCLAIMER files
+
+"""
+
+import os
+import tempfile
+import unittest
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import xanthosvis.reference_index as xri
+import xanthosvis.util_functions as xvu
+
+
+class TestStatistics(unittest.TestCase):
+    """Tests for the statistics computed over the time axis of grid cell or area data."""
+
+    VALUES = np.array([[1.0, 2.0, 4.0, 8.0],
+                       [3.0, np.nan, 5.0, 1.0],
+                       [np.nan, np.nan, np.nan, np.nan],
+                       [2.0, np.nan, np.nan, np.nan]])
+
+    def test_matches_pandas(self):
+        """Test that each statistic matches the pandas row-wise reductions it replaces."""
+
+        df = pd.DataFrame(TestStatistics.VALUES)
+        expected = {'mean': df.mean(axis=1), 'median': df.median(axis=1), 'min': df.min(axis=1),
+                    'max': df.max(axis=1), 'standard deviation': df.std(axis=1)}
+
+        for statistic, result in expected.items():
+            np.testing.assert_allclose(xvu.compute_statistic(TestStatistics.VALUES, statistic), result)
+
+    def test_invalid_statistic(self):
+        """Test that an unknown statistic raises an error."""
+
+        self.assertRaises(ValueError, xvu.compute_statistic, TestStatistics.VALUES, 'mode')
+
+    def test_no_columns(self):
+        """Test that a selection of no time columns gives a missing value for each row, as pandas did."""
+
+        values = TestStatistics.VALUES[:, :0]
+
+        for statistic in ['mean', 'median', 'min', 'max', 'standard deviation']:
+            result = xvu.compute_statistic(values, statistic)
+            self.assertEqual(result.shape, (4,))
+            self.assertTrue(np.isnan(result).all())
+
+
+class TestIdIndex(unittest.TestCase):
+    """Tests for the dense id to row indexes used for grid cell and area lookups."""
+
+    def test_lookup(self):
+        """Test that each id maps to the first row it appears in."""
+
+        id_index = xvu.build_id_index([5, 2, 3, 2])
+
+        self.assertEqual(xvu.lookup_id(id_index, 5), 0)
+        self.assertEqual(xvu.lookup_id(id_index, 2), 1)
+        self.assertEqual(xvu.lookup_id(id_index, 3), 2)
+
+    def test_missing_id(self):
+        """Test that ids that are not present raise a KeyError."""
+
+        id_index = xvu.build_id_index([5, 2, 3])
+
+        for id_value in [1, 4, 6, -1]:
+            self.assertRaises(KeyError, xvu.lookup_id, id_index, id_value)
+
+
+class TestUploadColumns(unittest.TestCase):
+    """Tests for reading the time columns of an uploaded file before it is parsed."""
+
+    def test_columns(self):
+        """Test that the time columns are read from the header without the id column."""
+
+        with tempfile.TemporaryDirectory() as dirpath:
+            file_path = os.path.join(dirpath, 'upload.csv')
+            with open(file_path, 'w') as out:
+                out.write('id,198001,198002\n1,0.5,0.25\n2,1.5,1.25')
+
+            columns = xvu.read_upload_columns(file_path, ['q_km3peryear_1980_1980.csv'])
+
+            self.assertEqual(columns, ['198001', '198002'])
+
+
+class TestReadUploadChunks(unittest.TestCase):
+    """Tests for parsing an uploaded file a chunk of rows at a time."""
+
+    def test_csv_chunks(self):
+        """Test that csv files are parsed in chunks with the options skipping malformed rows, which differ between
+        pandas versions, and that rows with extra fields keep the fields of the columns read."""
+
+        with tempfile.TemporaryDirectory() as dirpath:
+            file_path = os.path.join(dirpath, 'upload.csv')
+            with open(file_path, 'w') as out:
+                out.write('id,198001,198002\n1,0.5,0.25\n2,1.5,1.25,9.0\n3,2.5,2.25\n')
+
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                chunks = list(xvu.read_upload_chunks(file_path, ['q_km3peryear_1980_1980.csv'],
+                                                     ['198001', '198002'], chunk_values=4))
+
+            self.assertEqual(len(chunks), 2)
+            df = pd.concat(chunks, ignore_index=True)
+            self.assertEqual(df['id'].tolist(), [1, 2, 3])
+            self.assertEqual(df['198002'].tolist(), [0.25, 1.25, 2.25])
+
+
+class TestMapPayload(unittest.TestCase):
+    """Tests for the customdata and hover text of map figures."""
+
+    def test_cell_payload(self):
+        """Test that grid cell customdata is ordered as the customdata fields and can be read back."""
+
+        df = pd.DataFrame({'id': [7, 8], 'basin_id': [1, 2], 'country_id': [3, 4],
+                           'country_name': ['Aruba', 'Angola'], 'basin_name': ['Basin1', 'Basin2']})
+
+        payload = xvu.build_map_payload(df, 'basin_name', 'basin_id', 'Runoff', 'km³', 'mean', 'marker.color',
+                                        cells=True)
+        point = {'customdata': list(payload['customdata'][1])}
+
+        self.assertTrue(xvu.is_cell_point(point))
+        self.assertEqual(xvu.get_custom_value(point, 'cell_id'), 8)
+        self.assertEqual(xvu.get_custom_value(point, 'country_name'), 'Angola')
+        self.assertIn('%{customdata[0]}', payload['hovertemplate'])
+        self.assertEqual(list(payload['text']), ['Basin1', 'Basin2'])
+
+        payload = xvu.build_map_payload(df, 'country_name', 'country_id', 'Runoff', 'km³', 'mean', 'z')
+        self.assertFalse(xvu.is_cell_point({'customdata': list(payload['customdata'][0])}))
+
+    def test_select_meta(self):
+        """Test that choropleths carry the bounds of each location so the browser can filter selections."""
+
+        df_ref = pd.DataFrame({'grid_id': [1, 2, 3], 'longitude': [-0.25, 0.25, 10.25], 'latitude': [0.25, 1.25, -0.25],
+                               'area_hectares': [1.0, 2.0, 3.0], 'basin_id': [1, 1, 2],
+                               'basin_name': ['Basin1', 'Basin1', 'Basin2'], 'country_id': [1, 1, 2],
+                               'country_name': ['Aruba', 'Aruba', 'Angola']})
+        df_per_area = pd.DataFrame({'basin_id': [2, 1]})
+
+        meta = xvu.build_select_meta(df_per_area, 'basin_id', ['level-0', 'level-1', 'level-2'],
+                                     xri.ReferenceIndex(df_ref))
+
+        self.assertEqual(meta['bounds'], [[10.25, 10.25, -0.25, -0.25], [-0.25, 0.25, 0.25, 1.25]])
+        self.assertEqual(meta['select_geojson'], 'level-1')
+        self.assertTrue(xvu.is_select_figure({'data': [{'type': 'choroplethmapbox', 'meta': meta}]}))
+        self.assertFalse(xvu.is_select_figure({'data': [{'type': 'scattermapbox'}]}))
+        self.assertFalse(xvu.is_select_figure({}))
+
+    def test_geometry_meta(self):
+        """Test that choropleths carry the minimum zoom of each geometry level so the browser can swap them."""
+
+        meta = xvu.build_geometry_meta(['level-0', 'level-1', 'level-2'])
+
+        self.assertEqual(meta['geometry_levels'], [[0, 'level-0'], [2, 'level-1'], [5, 'level-2']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,42 @@
-import base64
 import collections
+import contextlib
 import datetime
+import gzip
+import hashlib
+import inspect
 import io
 import json
+import urllib.parse
+import warnings
 from zipfile import ZipFile
 
 import numpy as np
 import pandas as pd
-import plotly.express as px
 import plotly.graph_objs as go
+from scipy import sparse
+
+import xanthosvis.geometry as xvg
+import xanthosvis.raster as xvr
+
+# Fields carried in the customdata of each map point, in column order.  Grid cell points carry all of them, area points
+# all but the cell id.
+CUSTOM_DATA_FIELDS = ['basin_id', 'country_id', 'country_name', 'cell_id']
+
+# Keywords skipping malformed rows of uploaded csv files with a warning, pandas 1.3 replaced error_bad_lines and
+# warn_bad_lines with on_bad_lines
+if 'on_bad_lines' in inspect.signature(pd.read_csv).parameters:
+    SKIP_BAD_LINES = {'on_bad_lines': 'warn'}
+else:
+    SKIP_BAD_LINES = {'error_bad_lines': False, 'warn_bad_lines': True}
+
+# Grid views of at least this many cells are drawn as one image on the server instead of a marker per cell
+GRID_IMAGE_MIN_CELLS = 5000
+
+# Colors of the grid image, the same colorscale plotly uses for the grid cell markers
+GRID_COLOR_LUT = xvr.build_color_lut('Plasma')
+
+# Map zoom selected areas are drawn at
+SELECT_ZOOM = 3
 
 
 def get_available_years(in_file, non_year_fields=None):
@@ -29,13 +57,24 @@ def get_available_years(in_file, non_year_fields=None):
         non_year_fields = ['id']
     in_file.drop(columns=non_year_fields, inplace=True)
 
+    return get_year_options(in_file.columns)
+
+
+def get_year_options(columns):
+    """Build year options and the list of months from the time columns of a file
+
+    :param columns:                list of time columns, e.g. '1980' or '198001'
+    :type columns:                 list
+
+    :return:                       list of years and list of months
+
+    """
+
     # Build years and months list
-    year_list = list()
-    year_list = [{'label': i if len(i) == 4 else i[0:4] + '-' + i[4:6], 'value': i} for i in in_file.columns]
-    month_list = list()
+    year_list = [{'label': i if len(i) == 4 else i[0:4] + '-' + i[4:6], 'value': i} for i in columns]
 
-    if len(in_file.columns[0]) == 6:
-        month_list = np.unique([i[4:6] for i in in_file.columns])
+    if len(columns[0]) == 6:
+        month_list = np.unique([i[4:6] for i in columns])
     else:
         month_list = None
     return year_list, month_list
@@ -102,78 +141,145 @@ def available_through_years(available_year_list, start_year):
     return options
 
 
-def basin_to_gridcell_dict(df_reference):
-    """Generate a dictionary of gridcell id to basin id {grid_id: basin_id}
+def prepare_data(df, ref_index):
+    """Process dataframe to add the basin id from reference file.
+
+    :param df:                      Processed dataframe
+    :type df:                       dataframe
 
-    :param df_reference:            Input data reference dataframe containing grid to basin info
-    :type df_reference:             dataframe
+    :param ref_index:               Reference index built at startup
+    :type ref_index:                ReferenceIndex
 
-    :return:                        dict. {grid_id: basin_id}
+    :return:                        dataframe; data with basin id
 
     """
 
-    # select target fields
-    df_reference = df_reference[['grid_id', 'basin_id']]
+    # reference row of each grid cell
+    rows = ref_index.rows_of(df['id'].to_numpy())
 
-    # set index that will become dictionary key
-    df_reference.set_index('grid_id', inplace=True)
+    # add basin id, country_name, country_id, and area from the reference rows
+    df['basin_id'] = ref_index.take('basin_id', rows)
+    df['country_name'] = ref_index.take('country_name', rows)
+    df['country_id'] = ref_index.take('country_id', rows)
+    df['area'] = ref_index.take('area_hectares', rows)
 
-    return df_reference.to_dict()['basin_id']
+    return df
 
 
-def country_to_gridcell_dict(df_reference):
-    """Generate a dictionary of gridcell id to basin id {grid_id: basin_id}
+def build_id_index(ids):
+    """Build a dense positional index from integer ids (grid cell or basin ids) to the row they first appear in.
+    Xanthos ids are a dense range so a row is found by indexing the array with the id instead of scanning.
 
-    :param df_reference:            Input data reference dataframe containing grid to country info
-    :type df_reference:             dataframe
+    :param ids:                     Integer ids in row order
+    :type ids:                      array
 
-    :return:                        dict. {grid_id: basin_id}
+    :return:                        array; row of each id, -1 for ids that are not present
 
     """
 
-    # select target fields
-    df_reference = df_reference[['grid_id', 'country_id', 'country_name', 'area_hectares']]
+    ids = np.asarray(ids, dtype=np.int64)
+    id_index = np.full(ids.max() + 1 if len(ids) > 0 else 0, -1, dtype=np.int64)
 
-    # set index that will become dictionary key
-    df_reference.set_index('grid_id', inplace=True)
+    # np.unique returns the first row of each id
+    unique_ids, first_rows = np.unique(ids, return_index=True)
+    id_index[unique_ids] = first_rows
 
-    return df_reference.to_dict()
+    return id_index
 
 
-def prepare_data(df, df_ref):
-    """Process dataframe to add the basin id from reference file.
+def lookup_id(id_index, id_value):
+    """Get the row of an id from an index built by build_id_index
+
+    :param id_index:                Dense id to row index
+    :type id_index:                 array
+
+    :param id_value:                Id to find
+    :type id_value:                 int
+
+    :return:                        int; row of the id
+
+    """
+
+    row = id_index[id_value] if 0 <= id_value < len(id_index) else -1
+    if row < 0:
+        raise KeyError(id_value)
+
+    return int(row)
 
-    :param df:                      Processed dataframe
-    :type df:                       dataframe
+
+def build_area_aggregation(df_ref, area_key):
+    """Build a sparse (areas x grid cells) matrix from the reference file that sums grid cell values to areas.  The
+    matrix is built once so area totals are a single sparse matrix multiplication instead of a groupby.
 
     :param df_ref:                  Reference data frame from package
     :type df_ref:                   dataframe
 
-    :return:                        dataframe; data with basin id
+    :param area_key:                Reference field to aggregate by (basin_id or country_name)
+    :type area_key:                 str
+
+    :return:                        dict; area labels, aggregation matrix, grid id index and grid cell area
 
     """
 
-    # get dictionary of grid id to basin id
-    grid_basin_dict = basin_to_gridcell_dict(df_ref)
+    # Areas are sorted to match the order a groupby would return
+    codes, labels = pd.factorize(df_ref[area_key], sort=True)
+    cells = np.flatnonzero(codes >= 0)
 
-    # get country mapping
-    grid_country_dict = country_to_gridcell_dict(df_ref)
+    matrix = sparse.csc_matrix((np.ones(len(cells)), (codes[cells], cells)), shape=(len(labels), len(df_ref)))
 
-    # add basin id, country_name, country_id, and area via mappings
-    df['basin_id'] = df['id'].map(grid_basin_dict)
-    df['country_name'] = df['id'].map(grid_country_dict['country_name'])
-    df['country_id'] = df['id'].map(grid_country_dict['country_id'])
-    df['area'] = df['id'].map(grid_country_dict['area_hectares'])
+    return {'labels': np.asarray(labels), 'matrix': matrix, 'grid_index': pd.Index(df_ref['grid_id']),
+            'area': df_ref['area_hectares'].to_numpy(dtype=np.float64)}
 
-    return df
 
+def aggregate_by_area(values, ids, area_aggregation, area_ids=None):
+    """Sum grid cell values to areas.  Missing values are summed as zero, the same as a groupby sum.
+
+    :param values:                  Grid cell x time values
+    :type values:                   array
+
+    :param ids:                     Grid cell id of each row in values
+    :type ids:                      array
+
+    :param area_aggregation:        Aggregation built by build_area_aggregation
+    :type area_aggregation:         dict
+
+    :param area_ids:                Optional list of areas to aggregate, all areas if None
+    :type area_ids:                 list
 
-def data_per_basin(df, statistic, yr_list, df_ref, months, filename, units):
+    :return:                        Labels of areas having grid cells, area x time sums, and total area of each area
+
+    """
+
+    # Select the matrix columns of the grid cells in the data, in the order of the data
+    rows = area_aggregation['grid_index'].get_indexer(ids)
+    found = rows >= 0
+    if not found.all():
+        values = values[found]
+        rows = rows[found]
+    matrix = area_aggregation['matrix'][:, rows].tocsr()
+    labels = area_aggregation['labels']
+
+    # Only aggregate the chosen areas
+    if area_ids is not None:
+        positions = np.flatnonzero(np.isin(labels, area_ids))
+        matrix = matrix[positions]
+        labels = labels[positions]
+
+    sums = matrix @ np.nan_to_num(values)
+    area = matrix @ area_aggregation['area'][rows]
+
+    # Only keep areas that have grid cells in the data
+    keep = np.diff(matrix.indptr) > 0
+
+    return labels[keep], sums[keep], area[keep]
+
+
+def data_per_basin(dataset, statistic, yr_list, ref_index, months, filename, units):
     """Generate a data frame representing data per basin for all years
     represented by an input statistic.
 
-    :param df:                      Data with basin id
-    :type df:                       dataframe
+    :param dataset:                 Stored dataset
+    :type dataset:                  Dataset
 
     :param statistic:               statistic name from user input
     :type statistic:                str
@@ -181,8 +287,8 @@ def data_per_basin(df, statistic, yr_list, df_ref, months, filename, units):
     :param yr_list:                 List of years to process
     :type yr_list:                  list
 
-    :param df_ref                   Reference dataframe
-    :type df_ref                    dataframe
+    :param ref_index                Reference index built at startup
+    :type ref_index                 ReferenceIndex
 
     :param months                   parameter for filtering by months
     :type months                    list
@@ -197,33 +303,13 @@ def data_per_basin(df, statistic, yr_list, df_ref, months, filename, units):
 
     """
 
-    if months is not None and len(months) > 0:
-        yr_list = [c for c in yr_list if c[4:6] in months]
+    # Positions of the chosen years and months in the dataset
+    time_index = dataset.time_index(yr_list, months)
 
-    # sum data by basin by year
-    grp = df.groupby('basin_id').sum()
-
-    grp.drop(columns=['id'], inplace=True)
-
-    # calculate chosen statistic
-    if statistic == 'mean':
-        grp['var'] = grp[yr_list].mean(axis=1)
-
-    elif statistic == 'median':
-        grp['var'] = grp[yr_list].median(axis=1)
-
-    elif statistic == 'min':
-        grp['var'] = grp[yr_list].min(axis=1)
-
-    elif statistic == 'max':
-        grp['var'] = grp[yr_list].max(axis=1)
-
-    elif statistic == 'standard deviation':
-        grp['var'] = grp[yr_list].std(axis=1)
-
-    else:
-        msg = f"The statistic requested '{statistic}' is not a valid option."
-        raise ValueError(msg)
+    # Chosen statistic of the basin sums by year from the cube built at ingest, only for the chosen years
+    basin_ids, var, area = dataset.read_cube_statistic('basin_id', time_index, statistic)
+    grp = pd.DataFrame({'area': area}, index=pd.Index(basin_ids, name='basin_id'))
+    grp['var'] = var
 
     # Parse out and convert units if necessary
     unit_type = get_units_from_name(filename)
@@ -233,26 +319,21 @@ def data_per_basin(df, statistic, yr_list, df_ref, months, filename, units):
     if unit_type == 'mm':
         grp['var'] = (grp['var'] / 1000000) * (grp['area'] / 100)
 
-    #  Drop unneeded columns
-    grp.drop(columns=yr_list, inplace=True)
-
-    # Map basin and country fields using df_ref
+    # Map basin and country fields from the reference index
     grp.reset_index(inplace=True)
-    mapping = dict(df_ref[['basin_id', 'basin_name']].values)
-    mapping2 = df_ref.groupby('basin_id')[['country_id']].apply(lambda g: g.country_id.unique().tolist()).to_dict()
-    mapping3 = df_ref.groupby('basin_id')[['country_name']].apply(lambda g: g.country_name.unique().tolist()).to_dict()
-    grp['basin_name'] = grp.basin_id.map(mapping)
-    grp['country_id'] = grp.basin_id.map(mapping2)
-    grp['country_name'] = grp.basin_id.map(mapping3)
+    grp['basin_name'] = grp.basin_id.map(ref_index.basin_names)
+    grp['country_id'] = grp.basin_id.map(ref_index.basin_country_ids)
+    grp['country_name'] = grp.basin_id.map(ref_index.basin_country_names)
 
     return grp
 
 
-def data_per_cell(df, statistic, yr_list, df_ref, months, area_type, unit_type, units):
+def data_per_cell(dataset, statistic, yr_list, ref_index, months, area_type, unit_type, units, rows=None,
+                  progress=None):
     """Generate a data frame representing data per grid cell for years/months chosen
 
-    :param df:                      Data with basin id
-    :type df:                       dataframe
+    :param dataset:                 Stored dataset
+    :type dataset:                  Dataset
 
     :param statistic:               statistic name from user input
     :type statistic:                str
@@ -260,8 +341,8 @@ def data_per_cell(df, statistic, yr_list, df_ref, months, area_type, unit_type,
     :param yr_list:                 List of years to process
     :type yr_list:                  list
 
-    :param df_ref                   Reference dataframe
-    :type df_ref                    dataframe
+    :param ref_index                Reference index built at startup
+    :type ref_index                 ReferenceIndex
 
     :param months                   months from dropdown
     :type months                    list
@@ -275,40 +356,27 @@ def data_per_cell(df, statistic, yr_list, df_ref, months, area_type, unit_type,
     :param units                    Base unit parsed from file
     :type units                     str
 
+    :param rows                     Optional mask or positions of the grid cell rows to include, all if None
+    :type rows                      array
+
+    :param progress                 Optional function called with the fraction of grid cells computed so far
+    :type progress                  function
+
     :return:                        dataframe; grouped by area for statistic
 
     """
-    if months is not None and len(months) > 0:
-        yr_list = [c for c in yr_list if c[4:6] in months]
 
-    # Set up column list for joins
-    column_list = list(df)
-    column_list.remove('id')
-    column_list.remove('basin_id')
+    # Positions of the chosen years and months in the dataset
+    time_index = dataset.time_index(yr_list, months)
 
-    # Sum data by basin by year
-    df_ref = df_ref.set_index('grid_id')
-    df = df.join(df_ref, 'id', 'left', 'a1')
+    # Grid cell id and area of the chosen rows, joined with reference info
+    df = pd.DataFrame({'id': dataset.ids, 'area': dataset.read_attribute('area')})
+    if rows is not None:
+        df = df[rows].reset_index(drop=True)
+    df = pd.concat([df, ref_index.cell_frame(df['id'].to_numpy())], axis=1)
 
     # Calculate stat
-    if statistic == 'mean':
-        df['var'] = df[yr_list].mean(axis=1)
-
-    elif statistic == 'median':
-        df['var'] = df[yr_list].median(axis=1)
-
-    elif statistic == 'min':
-        df['var'] = df[yr_list].min(axis=1)
-
-    elif statistic == 'max':
-        df['var'] = df[yr_list].max(axis=1)
-
-    elif statistic == 'standard deviation':
-        df['var'] = df[yr_list].std(axis=1)
-
-    else:
-        msg = f"The statistic requested '{statistic}' is not a valid option."
-        raise ValueError(msg)
+    df['var'] = dataset.read_statistic(time_index, statistic, rows, progress)
 
     # Convert units if user has chosen different from file default
     if unit_type != units:
@@ -320,12 +388,12 @@ def data_per_cell(df, statistic, yr_list, df_ref, months, area_type, unit_type,
     return df
 
 
-def data_per_country(df, statistic, yr_list, df_ref, months, filename, units):
+def data_per_country(dataset, statistic, yr_list, ref_index, months, filename, units):
     """Generate a data frame representing data per country for all years/months
     represented by an input statistic.
 
-    :param df:                      Data with basin id
-    :type df:                       dataframe
+    :param dataset:                 Stored dataset
+    :type dataset:                  Dataset
 
     :param statistic:               statistic name from user input
     :type statistic:                str
@@ -333,8 +401,8 @@ def data_per_country(df, statistic, yr_list, df_ref, months, filename, units):
     :param yr_list:                 List of years to process
     :type yr_list:                  list
 
-    :param df_ref                   Reference dataframe
-    :type df_ref                    dataframe
+    :param ref_index                Reference index built at startup
+    :type ref_index                 ReferenceIndex
 
     :param months                   months from dropdown
     :type months                    list
@@ -349,36 +417,13 @@ def data_per_country(df, statistic, yr_list, df_ref, months, filename, units):
 
     """
 
-    if months is not None and len(months) > 0:
-        yr_list = [c for c in yr_list if c[4:6] in months]
-
-    # sum data by basin by year
-    grp = df.groupby('country_name').sum()
-
-    grp.drop(columns=['id'], inplace=True)
-
-    # calculate statistic
-    if statistic == 'mean':
-        grp['var'] = grp[yr_list].mean(axis=1)
-
-    elif statistic == 'median':
-        grp['var'] = grp[yr_list].median(axis=1)
-
-    elif statistic == 'min':
-        grp['var'] = grp[yr_list].min(axis=1)
-
-    elif statistic == 'max':
-        grp['var'] = grp[yr_list].max(axis=1)
+    # Positions of the chosen years and months in the dataset
+    time_index = dataset.time_index(yr_list, months)
 
-    elif statistic == 'standard deviation':
-        grp['var'] = grp[yr_list].std(axis=1)
-
-    else:
-        msg = f"The statistic requested '{statistic}' is not a valid option."
-        raise ValueError(msg)
-
-    #  Drop unneeded columns
-    grp.drop(columns=yr_list, inplace=True)
+    # Chosen statistic of the country sums by year from the cube built at ingest, only for the chosen years
+    country_names, var, area = dataset.read_cube_statistic('country_name', time_index, statistic)
+    grp = pd.DataFrame({'area': area}, index=pd.Index(country_names, name='country_name'))
+    grp['var'] = var
 
     # Convert units if necessary
     unit_type = get_units_from_name(filename)
@@ -388,20 +433,18 @@ def data_per_country(df, statistic, yr_list, df_ref, months, filename, units):
     if unit_type == 'mm':
         grp['var'] = (grp['var'] / 1000000) * (grp['area'] / 100)
 
-    # Map country values using df_ref
+    # Map country values from the reference index
     grp.reset_index(inplace=True)
-    mapping = dict(df_ref[['country_name', 'country_id']].values)
-    grp['country_id'] = grp.country_name.map(mapping)
-    mapping2 = df_ref.groupby('country_name')[['basin_id']].apply(lambda g: g.basin_id.unique().tolist()).to_dict()
-    grp['basin_id'] = grp.country_name.map(mapping2)
+    grp['country_id'] = grp.country_name.map(ref_index.country_ids)
+    grp['basin_id'] = grp.country_name.map(ref_index.country_basin_ids)
     return grp
 
 
-def data_per_year_area(df, area_id, yr_list, months, area_type, filename, units, df_ref):
+def data_per_year_area(dataset, area_id, yr_list, months, area_type, filename, units, ref_index):
     """Generate a data frame representing the sum of the data per year for an area
 
-    :param df:                     input data having data per year
-    :type df:                      dataframe
+    :param dataset:                Stored dataset
+    :type dataset:                 Dataset
 
     :param area_id:                id of area to filter and aggregate data for
     :type area_id:                 int
@@ -421,39 +464,29 @@ def data_per_year_area(df, area_id, yr_list, months, area_type, filename, units,
     :param units                   Chosen unit type
     :type units                    str
 
-    :param df_ref                  Reference file dataframe
-    :type df_ref                   dataframe
+    :param ref_index               Reference index built at startup
+    :type ref_index                ReferenceIndex
 
     :return:                       dataframe; sum values per year for a target basin
 
     """
 
-    if months is not None and len(months) > 0:
-        yr_list = [c for c in yr_list if c[4:6] in months]
+    # Positions of the chosen years and months in the dataset
+    time_index = dataset.time_index(yr_list, months)
 
-    # Sum data by basin by year
-    grp = df.groupby(area_type).sum()
+    # Sums for only the target area by year from the cube built at ingest, only for the chosen years.  Units are
+    # converted with the area's reference land area below, not the area of the cube's grid cells
+    _, sums, _ = dataset.read_cube(area_type, time_index, area_ids=[area_id])
 
-    # Adjust columns and reset index
-    grp.drop(columns=['id'], inplace=True)
-    grp = grp[yr_list]
-    grp.reset_index(inplace=True)
-
-    # Get only target basin_id
-    dfx = grp.loc[grp[area_type] == area_id].copy()
-
-    # Adjust return DF columns and reset index
-    dfx.drop(columns=[area_type], inplace=True)
-    df = dfx.T.copy()
-    df.reset_index(inplace=True)
-    df.columns = ['Year', 'var']
+    # Adjust return DF columns
+    df = pd.DataFrame({'Year': np.array(dataset.columns)[time_index], 'var': sums.sum(axis=0)})
 
     unit_type = get_units_from_name(filename)
     area = 0
 
     # Convert units if necessary
     if unit_type != units:
-        area = df_ref[df_ref[area_type] == area_id]['area_hectares'].sum()
+        area = ref_index.area_hectares[area_type].get(area_id, 0)
         if unit_type == 'km³':
             df['var'] = (df['var'] * 1000000) / (area / 100)
     if unit_type == 'mm':
@@ -462,11 +495,11 @@ def data_per_year_area(df, area_id, yr_list, months, area_type, filename, units,
     return df
 
 
-def data_per_year_cell(df, cell_id, yr_list, months, area_type, filename, units, df_ref):
+def data_per_year_cell(dataset, cell_id, yr_list, months, area_type, filename, units, ref_index):
     """Generate a data frame representing the sum of the data per year for a target grid cell.
 
-    :param df:                      input data having data per year
-    :type df:                       dataframe
+    :param dataset:                 Stored dataset
+    :type dataset:                  Dataset
 
     :param cell_id:                 id of grid cell to filter and aggregate data for
     :type cell_id:                  int
@@ -486,36 +519,28 @@ def data_per_year_cell(df, cell_id, yr_list, months, area_type, filename, units,
     :param units                    Units chosen by user
     :type units                     str
 
-    :param df_ref                   Reference dataframe
-    :type df_ref                    dataframe
+    :param ref_index                Reference index built at startup
+    :type ref_index                 ReferenceIndex
 
     :return:                        dataframe; sum values per year for a target basin
 
     """
 
-    if months is not None and len(months) > 0:
-        yr_list = [c for c in yr_list if c[4:6] in months]
-
-    keep_cols = yr_list
+    # Positions of the chosen years and months in the dataset
+    time_index = dataset.time_index(yr_list, months)
 
     # Get only target grid cell
-    df = df[df['id'] == cell_id].copy()
+    row = dataset.row_of(cell_id)
 
-    # Adjust columns and reset index
-    df.drop(columns=['basin_id', 'id'], inplace=True)
-    df = df[keep_cols]
-    df = df.T.copy()
-
-    # Adjust return DF columns and reset index
-    df.reset_index(inplace=True)
-    df.columns = ['Year', 'var']
+    # Adjust return DF columns
+    df = pd.DataFrame({'Year': np.array(dataset.columns)[time_index], 'var': dataset.values[row, time_index]})
 
     unit_type = get_units_from_name(filename)
     area = 0
 
     # Convert units if necessary
     if unit_type != units:
-        area = df_ref[df_ref['grid_id'] == cell_id]['area_hectares'].values[0]
+        area = ref_index.columns['area_hectares'][lookup_id(ref_index.grid_rows, cell_id)]
         if unit_type == 'km³':
             df['var'] = (df['var'] * 1000000) / (area / 100)
     if unit_type == 'mm':
@@ -545,6 +570,62 @@ def process_geojson(in_file):
     return basin_features
 
 
+def build_geojson_resource(features):
+    """Serialize geojson spatial data once so it can be served from a cacheable URL instead of embedded in figures
+
+    :param features:                geojson spatial data
+    :type features:                 dict
+
+    :return:                        dict; serialized body, gzip compressed body and an ETag of the content
+
+    """
+
+    body = json.dumps(features, separators=(',', ':')).encode('utf-8')
+
+    return {'body': body, 'gzip': gzip.compress(body), 'etag': hashlib.sha256(body).hexdigest()[:32]}
+
+
+def compute_statistic(values, statistic):
+    """Compute a statistic over the time axis of a grid cell or area by time array.  Missing values are skipped the
+    same as pandas row-wise reductions.
+
+    :param values:                  Grid cell or area x time values
+    :type values:                   array
+
+    :param statistic:               statistic name from user input
+    :type statistic:                str
+
+    :return:                        array; statistic for each grid cell or area
+
+    """
+
+    if statistic not in ('mean', 'median', 'min', 'max', 'standard deviation'):
+        msg = f"The statistic requested '{statistic}' is not a valid option."
+        raise ValueError(msg)
+
+    # No time columns chosen, e.g. months that aren't in the year range, every statistic is missing
+    if values.shape[1] == 0:
+        return np.full(values.shape[0], np.nan)
+
+    # All missing rows return nan, don't warn about them
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+
+        if statistic == 'mean':
+            return np.nanmean(values, axis=1)
+
+        elif statistic == 'median':
+            return np.nanmedian(values, axis=1)
+
+        elif statistic == 'min':
+            return np.nanmin(values, axis=1)
+
+        elif statistic == 'max':
+            return np.nanmax(values, axis=1)
+
+        return np.nanstd(values, axis=1, ddof=1)
+
+
 def get_unit_info(units):
     """Read in split file name and return data variable type (runoff, AET, etc)
 
@@ -608,14 +689,143 @@ def get_units_from_name(filename):
     return unit_val
 
 
-def plot_choropleth(df_per_area, features, mapbox_token, statistic, start, end, file_info, months, area_type, units):
+def build_map_payload(df, area_name, area_id, unit_type, units, statistic, value, cells=False):
+    """Build the customdata, hover text and hovertemplate of a map figure.  Customdata is a (points x fields) array
+    ordered as CUSTOM_DATA_FIELDS and hover text is filled in by plotly, so nothing is built point by point.
+
+    :param df:                      Per area or per grid cell data with basin and country fields
+    :type df:                       dataframe
+
+    :param area_name:               Field holding the area name shown in bold (basin_name or country_name)
+    :type area_name:                str
+
+    :param area_id:                 Field holding the area id shown in the hover text (basin_id or country_id)
+    :type area_id:                  str
+
+    :param unit_type:               Unit type parsed from the file name
+    :type unit_type:                str
+
+    :param units:                   Unit of measurement
+    :type units:                    str
+
+    :param statistic:               Chosen statistic
+    :type statistic:                str
+
+    :param value:                   Plotly attribute holding the mapped value, 'z' or 'marker.color'
+    :type value:                    str
+
+    :param cells:                   True if the points are grid cells, with the cell id in the 'id' field
+    :type cells:                    bool
+
+    :return:                        dict; customdata, text and hovertemplate figure properties
+
+    """
+
+    fields = CUSTOM_DATA_FIELDS if cells else CUSTOM_DATA_FIELDS[:-1]
+    custom_data = df[['id' if f == 'cell_id' else f for f in fields]].to_numpy(dtype=object)
+
+    # Hover text is filled in from the customdata columns, the value is formatted by plotly from the numeric array
+    cell_text = f"Grid Cell: %{{customdata[{CUSTOM_DATA_FIELDS.index('cell_id')}]}}<br>" if cells else ""
+    hover_template = (f"<b>%{{text}}</b><br>ID: %{{customdata[{CUSTOM_DATA_FIELDS.index(area_id)}]}}<br>{cell_text}"
+                      f"<br>{unit_type} ({units}): %{{{value}:,}} ({statistic})<extra></extra>")
+
+    return {'customdata': custom_data, 'text': df[area_name], 'hovertemplate': hover_template}
+
+
+def build_geometry_meta(features):
+    """Build the trace meta that lets the browser draw a choropleth's areas with the simplification level of the map
+    zoom as the user zooms, without asking the server for a new figure (see the geometry_level clientside function)
+
+    :param features:                URLs of the geojson spatial data served by the app, one per simplification level
+    :type features:                 list
+
+    :return:                        dict; minimum map zoom and geojson URL of each simplification level
+
+    """
+
+    return {'geometry_levels': [[min_zoom, url] for (min_zoom, tolerance), url in zip(xvg.GEOMETRY_LEVELS, features)]}
+
+
+def build_select_meta(df_per_area, area_loc, features, ref_index):
+    """Build the trace meta that lets the browser filter a choropleth to a selection without asking the server for a
+    new figure (see the select_areas clientside function)
+
+    :param df_per_area:             Per area data in the order of the figure's locations
+    :type df_per_area:              dataframe
+
+    :param area_loc:                Field the figure's locations are taken from (basin_id or country_name)
+    :type area_loc:                 str
+
+    :param features:                URLs of the geojson spatial data served by the app, one per simplification level
+    :type features:                 list
+
+    :param ref_index:               Reference index built at startup
+    :type ref_index:                ReferenceIndex
+
+    :return:                        dict; bounds of each location and the geojson URL selections are drawn with
+
+    """
+
+    bounds = ref_index.bounds[area_loc]
+
+    return {'bounds': [bounds.get(i) for i in df_per_area[area_loc]], 'select_zoom': SELECT_ZOOM,
+            'select_geojson': features[xvg.level_for_zoom(SELECT_ZOOM)]}
+
+
+def is_select_figure(fig):
+    """Check if a figure is an area choropleth carrying the meta built by build_select_meta, so the browser can
+    filter selections of it
+
+    :param fig:                     Figure dict of the choropleth graph
+    :type fig:                      dict
+
+    :return:                        bool; True if the browser filters selections of the figure
+
+    """
+
+    data = (fig or {}).get('data') or []
+
+    return len(data) > 0 and data[0].get('type') == 'choroplethmapbox' and 'bounds' in (data[0].get('meta') or {})
+
+
+def get_custom_value(point, field):
+    """Get a field from the customdata of a clicked or selected map point
+
+    :param point:                   Point from the click or select event data of a map figure
+    :type point:                    dict
+
+    :param field:                   One of CUSTOM_DATA_FIELDS
+    :type field:                    str
+
+    :return:                        Value of the field
+
+    """
+
+    return point['customdata'][CUSTOM_DATA_FIELDS.index(field)]
+
+
+def is_cell_point(point):
+    """Check if a clicked or selected map point is a grid cell rather than an area
+
+    :param point:                   Point from the click or select event data of a map figure
+    :type point:                    dict
+
+    :return:                        bool; True for grid cell points
+
+    """
+
+    return len(point['customdata']) == len(CUSTOM_DATA_FIELDS)
+
+
+def plot_choropleth(df_per_area, features, mapbox_token, statistic, start, end, file_info, months, area_type, units,
+                    ref_index=None):
     """Plot interactive choropleth map grouped by country or basin
 
     :param df_per_area:             dataframe with area level stats
     :type df_per_area:              dataframe
 
-    :param features:                geojson spatial data and area id field
-    :type features:                 dataframe
+    :param features:                URLs of the geojson spatial data served by the app, one per simplification level
+    :type features:                 list
 
     :param mapbox_token             Access token for mapbox
     :type mapbox_token              str
@@ -641,6 +851,9 @@ def plot_choropleth(df_per_area, features, mapbox_token, statistic, start, end,
     :param units:                   Unit of measurement
     :type units:                    str
 
+    :param ref_index:               Reference index built at startup, to let the browser filter selections
+    :type ref_index:                ReferenceIndex
+
     """
 
     # Get base units from filename
@@ -662,24 +875,25 @@ def plot_choropleth(df_per_area, features, mapbox_token, statistic, start, end,
         area_title = "Country"
         area_custom_index = 1
 
-    # Set up list to hold per item custom data for easy access
-    custom_data = [{'basin_id': x, 'country_id': y, 'country_name': z} for x, y, z in
-                   zip(df_per_area['basin_id'], df_per_area['country_id'], df_per_area['country_name'])]
-    custom_data[1] = area_type
+    # Per item custom data for easy access, and hover text
+    payload = build_map_payload(df_per_area, area_name, area_id, unit_type, units, statistic, 'z')
+
+    # Draw the world view with the simplest geometry
+    zoom = 0.6
 
     # Main output figure - generates a choroplethmapbox figure
-    fig = go.Figure(go.Choroplethmapbox(geojson=features, locations=df_per_area[area_loc],
-                                        z=df_per_area['var'].astype(str), marker=dict(opacity=0.7),
-                                        text=df_per_area.apply(lambda row: f"<b>{row[area_name]}</b><br>"
-                                                                           f"ID: {row[area_id]}<br><br>"
-                                                                           f"{unit_type} ({units}): {row['var']} "
-                                                                           f"({statistic})",
-                                                               axis=1), colorscale="Plasma",
-                                        featureidkey=feature_id, legendgroup="Runoff",
-                                        hoverinfo="text",
+    fig = go.Figure(go.Choroplethmapbox(geojson=features[xvg.level_for_zoom(zoom)], locations=df_per_area[area_loc],
+                                        z=df_per_area['var'].to_numpy(dtype=np.float64), marker=dict(opacity=0.7),
+                                        colorscale="Plasma", featureidkey=feature_id, legendgroup="Runoff",
                                         colorbar={'separatethousands': True, 'tickformat': ",",
                                                   'title': unit_type + ' ' + '(' + units + ')'},
-                                        customdata=custom_data))
+                                        **payload))
+
+    # Let the browser swap the geometry as the map zooms, and filter selections of this figure
+    meta = build_geometry_meta(features)
+    if ref_index is not None:
+        meta.update(build_select_meta(df_per_area, area_loc, features, ref_index))
+    fig.update_traces(meta=meta)
 
     # Add in additional layout options to figure
     fig.update_layout(
@@ -702,13 +916,13 @@ def plot_choropleth(df_per_area, features, mapbox_token, statistic, start, end,
             t=60  # top margin
         ),
         mapbox_style="mapbox://styles/jevanoff/ckckto2j900k01iomsh1f8i20",
-        mapbox_accesstoken=mapbox_token, mapbox={'zoom': 0.6}
+        mapbox_accesstoken=mapbox_token, mapbox={'zoom': zoom}
     )
 
     return fig
 
 
-def plot_hydrograph(df, selection_id, df_ref, id_type, file_info, units, area_label=""):
+def plot_hydrograph(df, selection_id, ref_index, id_type, file_info, units, area_label=""):
     """Plot a hydrograph of a specific basin, country or grid cell.
 
     :param df:                      Input dataframe with data and area id for a target area
@@ -717,8 +931,8 @@ def plot_hydrograph(df, selection_id, df_ref, id_type, file_info, units, area_la
     :param selection_id:            ID of selected area
     :type selection_id:             int
 
-    :param df_ref:                  Reference dataframe with gis data
-    :type df_ref                    dataframe
+    :param ref_index:               Reference index built at startup
+    :type ref_index                 ReferenceIndex
 
     :param id_type:                 Type of ID passed, area or cell
     :type id_type                   str
@@ -751,9 +965,7 @@ def plot_hydrograph(df, selection_id, df_ref, id_type, file_info, units, area_la
 
     # Process data and set up graphing fields based on type of id (cell, basin, country)
     if id_type == 'basin_id':
-        df_area = df_ref[df_ref['basin_id'] == selection_id][0:1]
-        df_area = df_area['basin_name']
-        area_label = df_area.iat[0]
+        area_label = ref_index.columns['basin_name'][lookup_id(ref_index.basin_rows, selection_id)]
         title_text = {
             'text': f"<b>Basin {selection_id}: {area_label} - {units} per {time_type}</b>",
             'y': 0.92,
@@ -767,9 +979,7 @@ def plot_hydrograph(df, selection_id, df_ref, id_type, file_info, units, area_la
         }
         tick_format = ','
     elif id_type == 'country_name':
-        df_area = df_ref[df_ref['country_name'] == selection_id][0:1]
-        df_area = df_area['country_name']
-        area_label = df_area.iat[0]
+        area_label = selection_id
         title_text = {
             'text': f"<b>Country: {selection_id} - {units} per {time_type}</b>",
             'y': 0.92,
@@ -783,7 +993,7 @@ def plot_hydrograph(df, selection_id, df_ref, id_type, file_info, units, area_la
         }
         tick_format = ','
     elif id_type == 'grid_id':
-        area_label = df_ref[df_ref['grid_id'] == selection_id][area_label].iat[0]
+        area_label = ref_index.columns[area_label][lookup_id(ref_index.grid_rows, selection_id)]
         title_text = {
             'text': f"<b>Grid Cell {selection_id}: {area_label} - {units} per {time_type}</b>",
             'y': 0.92,
@@ -799,7 +1009,8 @@ def plot_hydrograph(df, selection_id, df_ref, id_type, file_info, units, area_la
 
     df['area_type'] = id_type
 
-    # Construct figure object
+    # Construct figure object, plotly express is slow to import so it is only loaded once a hydrograph is drawn
+    import plotly.express as px
     fig = px.line(df, x='Year', y='var', custom_data=['area_type'])
     fig.update_layout(
         title=title_text,
@@ -837,117 +1048,116 @@ def get_target_years(start, end, options_list):
     return [i['value'] for i in options_list if i['value'] <= end]
 
 
-def process_file(contents, filename, filedate, years, row_count="max"):
-    """Process and decode uploaded file and the calculated units
+@contextlib.contextmanager
+def open_upload(file_path, filename):
+    """Open the csv data of a file written to disk by the upload endpoint, the first file in the archive for zips
 
-    :param contents:             Raw contents of uploaded file
-    :type contents:              str
+    :param file_path:            Full path to the uploaded file on disk
+    :type file_path:             str
 
     :param filename:             Name of uploaded file
-    :type filename:              str
+    :type filename:              list
 
-    :param filedate:             Date of uploaded file
-    :type filedate:              str
+    :return:                     Binary file object holding csv data
 
-    :param years:                List of years to process
-    :type years:                 list
+    """
+
+    if 'zip' in filename[0]:
+        with ZipFile(file_path, 'r') as zip_file:
+            with zip_file.open(zip_file.namelist()[0]) as csvfile:
+                yield csvfile
+    else:
+        with open(file_path, 'rb') as csvfile:
+            yield csvfile
 
-    :param row_count:            Row number to read from to reduce number of rows read in certain situations
-    :type row_count:             int
 
-    :return:                     Processed contents object and calculated unit type
+def read_upload_columns(file_path, filename):
+    """Read the time columns from the header of a file on disk without reading its data
+
+    :param file_path:            Full path to the uploaded file on disk
+    :type file_path:             str
+
+    :param filename:             Name of uploaded file
+    :type filename:              list
+
+    :return:                     list of time columns
 
     """
 
-    # Pre-processing of years, columns, units, set up variables
-    if years:
-        read_cols = years + ['id']
-    else:
-        read_cols = "all"
-    f = filename[0]
-    split = f.split('_')
-
-    # Process file contents based on extension
-    try:
-        if 'zip' in filename[0]:
-            zip_file = None
-            for content, name, date in zip(contents, filename, filedate):
-                # the content needs to be split. It contains the type and the real content
-                content_type, content_string = content.split(',')
-                # Decode the base64 string
-                content_decoded = base64.b64decode(content_string)
-                # Use BytesIO to handle the decoded content
-                zip_str = io.BytesIO(content_decoded)
-                # Use ZipFile to take the BytesIO output
-                zip_file = ZipFile(zip_str, 'r')
-                filename = zip_file.namelist()[0]
-            # Read file based on input parameters for number of rows/columns to help performance
-            with zip_file.open(filename) as csvfile:
-                if row_count == "max":
-                    if read_cols == "all":
-                        xanthos_data = pd.read_csv(csvfile, encoding='utf8', sep=",")
-                    else:
-                        xanthos_data = pd.read_csv(csvfile, encoding='utf8', sep=",", usecols=read_cols)
-                else:
-                    if read_cols == "all":
-                        xanthos_data = pd.read_csv(csvfile, encoding='utf8', sep=",", nrows=row_count)
-                    else:
-                        xanthos_data = pd.read_csv(csvfile, encoding='utf8', sep=",", usecols=read_cols,
-                                                   nrows=row_count)
-        elif 'csv' in filename[0]:
-            # Assume that the user uploaded a CSV file and decode
-            content_type, content_string = contents[0].split(',')
-            decoded = base64.b64decode(content_string)
-            # Read file based on input parameters for number of rows/columns to help performance
-            if row_count == "max":
-                if read_cols == "all":
-                    xanthos_data = pd.read_csv(io.StringIO(decoded.decode('utf-8')), error_bad_lines=False,
-                                               warn_bad_lines=True)
-                else:
-                    xanthos_data = pd.read_csv(io.StringIO(decoded.decode('utf-8')), usecols=read_cols,
-                                               error_bad_lines=False, warn_bad_lines=True)
-            else:
-                if read_cols == "all":
-                    xanthos_data = pd.read_csv(io.StringIO(decoded.decode('utf-8')), nrows=row_count,
-                                               error_bad_lines=False, warn_bad_lines=True)
-                else:
-                    xanthos_data = pd.read_csv(io.StringIO(decoded.decode('utf-8')), nrows=row_count, usecols=read_cols,
-                                               error_bad_lines=False, warn_bad_lines=True)
-    except Exception as e:
-        print(e)
-        return None
-    return [xanthos_data, split]
+    with open_upload(file_path, filename) as csvfile:
+        header = csvfile.readline()
+
+    # Parse the header the same way the data is parsed
+    columns = pd.read_csv(io.BytesIO(header), nrows=0).columns
+    return [c for c in columns if c != 'id']
+
+
+def ingest_upload(file_path, filename, ref_index):
+    """Get the available years, months and unit info of a file on disk along with its prepared data.  The data is
+    parsed once, a chunk of rows at a time, as the returned generator is consumed.
+
+    :param file_path:            Full path to the uploaded file on disk
+    :type file_path:             str
 
+    :param filename:             Name of uploaded file
+    :type filename:              list
+
+    :param ref_index:            Reference index built at startup
+    :type ref_index:             ReferenceIndex
+
+    :return:                     dict; years, months, time columns, expected row count and unit info from the file
+                                 name, and generator of dataframes; the prepared data a chunk of rows at a time
+
+    """
 
-def process_input_years(contents, filename, filedate):
-    """Process just the first row of input file to get list of available years
+    columns = read_upload_columns(file_path, filename)
+    target_years, months_list = get_year_options(columns)
 
-    :param contents:             Raw contents of uploaded file
-    :type contents:              str
+    # Files have a row per land grid cell of the reference, the rows parsed are counted as the data is stored
+    info = {'years': target_years, 'months': months_list, 'columns': columns, 'n_rows': len(ref_index.grid_ids),
+            'file_info': filename[0].split('_'), 'units': get_units_from_name(filename)}
+    chunks = (prepare_data(chunk, ref_index) for chunk in read_upload_chunks(file_path, filename, columns))
+
+    return info, chunks
+
+
+def read_upload_chunks(file_path, filename, columns, chunk_values=8000000):
+    """Read the data of a file on disk in chunks of rows, bounding the memory used while parsing
+
+    :param file_path:            Full path to the uploaded file on disk
+    :type file_path:             str
 
     :param filename:             Name of uploaded file
-    :type filename:              str
+    :type filename:              list
+
+    :param columns:              List of time columns to read along with the grid cell id
+    :type columns:               list
 
-    :param filedate:             Date of uploaded file
-    :type filedate:              str
+    :param chunk_values:         Approximate number of values parsed per chunk
+    :type chunk_values:          int
 
-    :return:                     Processed list of years available in file data
+    :return:                     Generator of dataframes; the data a chunk of rows at a time
 
     """
 
-    file_data = process_file(contents, filename, filedate, years=[], row_count=0)[0]
-    target_years = get_available_years(file_data)
-    return target_years
+    kwargs = {'usecols': ['id'] + columns, 'dtype': {c: np.float64 for c in columns},
+              'chunksize': max(1, chunk_values // max(len(columns), 1))}
+    if 'zip' not in filename[0]:
+        kwargs.update(SKIP_BAD_LINES)
 
+    with open_upload(file_path, filename) as csvfile:
+        for chunk in pd.read_csv(csvfile, **kwargs):
+            yield chunk
 
-def hydro_area_lookup(area_id, df_ref, area_key):
+
+def hydro_area_lookup(area_id, ref_index, area_key):
     """Get max row in data file of a particular area's grid cells to reduce row count for performance
 
     :param area_id:                 ID of area to find it's grid cells
     :type area_id:              int
 
-    :param df_ref:                  Reference dataframe
-    :type df_ref:                   dataframe
+    :param ref_index:               Reference index built at startup
+    :type ref_index:                ReferenceIndex
 
     :area_key:                      Type of area (country or basin)
     :type area_key:                 str
@@ -956,41 +1166,40 @@ def hydro_area_lookup(area_id, df_ref, area_key):
 
     """
 
-    # get which grid cells are associated with the target basin
-    target_idx_list = df_ref[df_ref[area_key] == area_id].copy()
-    return max(target_idx_list['grid_id'])
+    # max grid id of each area is computed once when the reference index is built
+    return ref_index.max_grid_id[area_key][area_id]
 
 
-def hydro_cell_lookup(cell_id, df_ref):
+def hydro_cell_lookup(cell_id, ref_index):
     """Get max row of a particular grid cell to reduce row count for performance
 
     :param cell_id:                 ID of cell
     :type cell_id:                  int
 
-    :param df_ref:                  Reference dataframe
-    :type df_ref:                   dataframe
+    :param ref_index:               Reference index built at startup
+    :type ref_index:                ReferenceIndex
 
     :return:                        int; Max row of cell in file data
 
     """
 
-    # get which grid cells are associated with the target basin
-    target_idx_list = df_ref[df_ref['grid_id'] == cell_id].copy()
-    return max(target_idx_list['grid_id'])
+    # a grid cell is its own max, only check that it is in the reference file
+    lookup_id(ref_index.grid_rows, cell_id)
+    return cell_id
 
 
-def update_choro_select(df_ref, df_per_area, features, year_list, mapbox_token, selected_data, start, end,
+def update_choro_select(ref_index, df_per_area, features, year_list, mapbox_token, selected_data, start, end,
                         statistic, file_info, months, area_type, units):
     """Return a choropleth figured object based off the area's within the selected region
 
-    :param df_ref:                  Reference xanthos dataframe
-    :type df_ref:                   dataframe
+    :param ref_index:               Reference index built at startup
+    :type ref_index:                ReferenceIndex
 
     :param df_per_area:             Processed data dataframe
     :type df_per_area:              dataframe
 
-    :param features:                Reference geo dataframe
-    :type features:                 dataframe
+    :param features:                URLs of the geojson spatial data served by the app, one per simplification level
+    :type features:                 list
 
     :param year_list:               List of years to process
     :type year_list:                list
@@ -1042,40 +1251,34 @@ def update_choro_select(df_ref, df_per_area, features, year_list, mapbox_token,
         area_loc = "country_name"
         area_title = "Country"
 
-    # Get selected area list based on area or grid cell, depending on selection data
-    if 'cell_id' not in selected_data['points'][0]['customdata'].keys():
-        area_id_list = [i['customdata'][area_loc] for i in selected_data['points']]
-    else:
-        area_id_list = [i['customdata'][0] for i in selected_data['points']]
+    # Get selected area list, grid cell points carry the same area fields as area points
+    area_id_list = [get_custom_value(i, area_loc) for i in selected_data['points']]
 
-    # Subset dataframes
+    # Subset dataframe
     df_per_area = df_per_area[df_per_area[area_loc].isin(flatten(area_id_list))]
-    subset = df_ref[df_ref[area_loc].isin(flatten(area_id_list))].copy()
 
-    # Do some lat/lon calculations to try to find a midpoint of selection data
-    lon_min = subset['longitude'].min()
-    lon_max = subset['longitude'].max()
-    lat_min = subset['latitude'].min()
-    lat_max = subset['latitude'].max()
+    # Find a midpoint of the selected areas' grid cells
+    lon_min, lon_max, lat_min, lat_max = ref_index.area_extent(area_loc, flatten(area_id_list))
     lon = (lon_min + lon_max) / 2
     lat = (lat_min + lat_max) / 2
 
-    # Build custom data list objects for each item
-    custom_data = [{'basin_id': x, 'country_id': y, 'country_name': z} for x, y, z in
-                   zip(df_per_area['basin_id'], df_per_area['country_id'], df_per_area['country_name'])]
+    # Build custom data and hover text for each item
+    payload = build_map_payload(df_per_area, area_name, area_id, unit_type, units, statistic, 'z')
+
+    # Selections are drawn zoomed in, with more detailed geometry
+    zoom = SELECT_ZOOM
+
     # Plot figure
-    fig = go.Figure(go.Choroplethmapbox(geojson=features, locations=df_per_area[area_loc],
-                                        z=df_per_area['var'].astype(str), marker=dict(opacity=0.7),
-                                        text=df_per_area.apply(lambda row: f"<b>{row[area_name]}</b><br>"
-                                                                           f"ID: {row[area_id]}<br><br>"
-                                                                           f"{unit_type} ({units}): {row['var']}"
-                                                                           f" ({statistic})",
-                                                               axis=1), colorscale="Plasma",
-                                        featureidkey=feature_id, legendgroup=unit_type,
-                                        hoverinfo="text",
+    fig = go.Figure(go.Choroplethmapbox(geojson=features[xvg.level_for_zoom(zoom)], locations=df_per_area[area_loc],
+                                        z=df_per_area['var'].to_numpy(dtype=np.float64), marker=dict(opacity=0.7),
+                                        colorscale="Plasma", featureidkey=feature_id, legendgroup=unit_type,
                                         colorbar={'separatethousands': True, 'tickformat': ",",
                                                   'title': unit_type + ' (' + units + ')'},
-                                        customdata=custom_data))
+                                        **payload))
+
+    # Let the browser swap the geometry as the map zooms, and filter further selections of this figure
+    fig.update_traces(meta=dict(build_geometry_meta(features),
+                                **build_select_meta(df_per_area, area_loc, features, ref_index)))
 
     # Update figure layout options
     fig.update_layout(
@@ -1098,25 +1301,25 @@ def update_choro_select(df_ref, df_per_area, features, year_list, mapbox_token,
             t=60  # top margin
         ),
         mapbox_style="mapbox://styles/jevanoff/ckckto2j900k01iomsh1f8i20",
-        mapbox_accesstoken=mapbox_token, mapbox={'center': {'lat': lat, 'lon': lon}, 'zoom': 3}
+        mapbox_accesstoken=mapbox_token, mapbox={'center': {'lat': lat, 'lon': lon}, 'zoom': zoom}
     )
 
     return fig
 
 
-def update_choro_grid(df_ref, df, basin_features, year_list, mapbox_token, selected_data, start, end, statistic,
+def update_choro_grid(ref_index, dataset, basin_features, year_list, mapbox_token, selected_data, start, end, statistic,
                       file_info,
-                      months, area_type, units, filename):
+                      months, area_type, units, filename, tile_url=None, progress=None, tile_grid_file=None):
     """Return a scattermapbox figure object for viewing by grid cell
 
-    :param df_ref:                      Xanthos reference dataframe
-    :type df_ref:                       dataframe
+    :param ref_index:                   Reference index built at startup
+    :type ref_index:                    ReferenceIndex
 
-    :param df:                          Processed data dataframe
-    :type df:                           dataframe
+    :param dataset:                     Stored dataset
+    :type dataset:                      Dataset
 
-    :param basin_features:              geo reference dataframe
-    :type basin_features:               dataframe
+    :param basin_features:              URLs of the geojson spatial data served by the app, one per level
+    :type basin_features:               list
 
     :param year_list:                   List of years to process
     :type year_list:                    list
@@ -1151,6 +1354,17 @@ def update_choro_grid(df_ref, df, basin_features, year_list, mapbox_token, selec
     :param filename                     Name of uploaded file
     :type filename                      list
 
+    :param tile_url                     Tile URL template of the grid built by build_tile_url, to draw the whole
+                                        grid from map tiles
+    :type tile_url                      str
+
+    :param progress                     Optional function called with the fraction of grid cells computed so far
+    :type progress                      function
+
+    :param tile_grid_file               Optional file to save the grid cell values drawn by map tiles to, so the tile
+                                        endpoint loads them instead of computing them again
+    :type tile_grid_file                str
+
     :return:                            Scattermapbox figure object
 
     """
@@ -1175,13 +1389,27 @@ def update_choro_grid(df_ref, df, basin_features, year_list, mapbox_token, selec
 
     # Load all data if the user selects nothing
     if selected_data is None:
-        df_selected = data_per_cell(df, statistic, year_list, df_ref, months, area_type, unit_from_file, units)
+        df_selected = data_per_cell(dataset, statistic, year_list, ref_index, months, area_type, unit_from_file, units,
+                                    progress=progress)
     else:
+        # Selections over the grid image have no points, select the cells within the selected region instead
+        if len(selected_data['points']) == 0:
+            df_selected = data_per_cell(dataset, statistic, year_list, ref_index, months, area_type, unit_from_file,
+                                        units, progress=progress)
+            if 'range' in selected_data.keys():
+                selected_range = selected_data['range']['mapbox']
+                in_lon = df_selected['longitude'].between(*sorted((selected_range[0][0], selected_range[1][0])))
+                in_lat = df_selected['latitude'].between(*sorted((selected_range[0][1], selected_range[1][1])))
+                df_selected = df_selected[in_lon & in_lat]
+            else:
+                df_selected = df_selected[xvg.points_in_polygon(df_selected['longitude'], df_selected['latitude'],
+                                                                selected_data['lassoPoints']['mapbox'])]
         # Set up variables for selection by box tool if 'range' is in the selected data
-        if 'range' in selected_data.keys():
-            area_id_list = [i['customdata'][area_loc] for i in selected_data['points']]
-            df = df[df[area_loc].isin(flatten(area_id_list))]
-            df_selected = data_per_cell(df, statistic, year_list, df_ref, months, area_type, unit_from_file, units)
+        elif 'range' in selected_data.keys():
+            area_id_list = [get_custom_value(i, area_loc) for i in selected_data['points']]
+            rows = np.isin(dataset.read_attribute(area_loc), flatten(area_id_list))
+            df_selected = data_per_cell(dataset, statistic, year_list, ref_index, months, area_type, unit_from_file,
+                                        units, rows, progress)
             selected_range = selected_data['range']['mapbox']
             min_lon = min((selected_range[0][0], selected_range[1][0]))
             max_lon = max((selected_range[0][0], selected_range[1][0]))
@@ -1195,14 +1423,14 @@ def update_choro_grid(df_ref, df, basin_features, year_list, mapbox_token, selec
             min_lat = min(x[1] for x in selected_range)
             max_lat = max(x[1] for x in selected_range)
             # Build selected items list depending on view options
-            if 'cell_id' not in selected_data['points'][0]['customdata'].keys():
-                area_id_list = [i['customdata'][area_loc] for i in selected_data['points']]
-                df = df[df[area_loc].isin(flatten(area_id_list))]
-                df_selected = data_per_cell(df, statistic, year_list, df_ref, months, area_type, unit_from_file, units)
+            if not is_cell_point(selected_data['points'][0]):
+                area_id_list = [get_custom_value(i, area_loc) for i in selected_data['points']]
+                rows = np.isin(dataset.read_attribute(area_loc), flatten(area_id_list))
             else:
-                df_selected = data_per_cell(df, statistic, year_list, df_ref, months, area_type, unit_from_file, units)
-                selected_points = [i['customdata']['cell_id'] for i in selected_data['points']]
-                df_selected = df_selected[df_selected['id'].isin(flatten(selected_points))]
+                selected_points = [get_custom_value(i, 'cell_id') for i in selected_data['points']]
+                rows = np.isin(dataset.ids, flatten(selected_points))
+            df_selected = data_per_cell(dataset, statistic, year_list, ref_index, months, area_type, unit_from_file,
+                                        units, rows, progress)
 
     df_selected['var'] = round(df_selected['var'], 2)
     lon_min = df_selected['longitude'].min()
@@ -1212,28 +1440,30 @@ def update_choro_grid(df_ref, df, basin_features, year_list, mapbox_token, selec
     lon = (lon_min + lon_max) / 2
     lat = (lat_min + lat_max) / 2
 
-    # Build custom data list for storing at each point/item in graph
-    custom_data = [{'basin_id': x, 'country_id': y, 'country_name': z, 'cell_id': c} for x, y, z, c in
-                   zip(df_selected['basin_id'], df_selected['country_id'], df_selected['country_name'],
-                       df_selected['id'])]
-
-    fig = go.Figure(go.Scattermapbox(lat=df_selected['latitude'], lon=df_selected['longitude'],
-                                     mode='markers', customdata=custom_data,
-                                     text=df_selected.apply(lambda row: f"<b>{row[area_name]}</b><br>"
-                                                                        f"ID: {row[area_id]}<br>"
-                                                                        f"Grid Cell: {row['id']}<br><br>"
-                                                                        f"{unit_type} ({units}): {row['var']} "
-                                                                        f"({statistic})",
-                                                            axis=1), hoverinfo="text",
-
-                                     marker=go.scattermapbox.Marker(
-                                         size=11,
-                                         color=df_selected['var'],
-                                         opacity=0.4,
-                                         showscale=True,
-                                         colorbar={'title': unit_type + '(' + units + ')'}
-                                     )
-                                     ))
+    # Large grids are drawn as map tiles or a single image, so the figure doesn't grow with the number of cells
+    if len(df_selected) >= GRID_IMAGE_MIN_CELLS and selected_data is None and tile_url is not None:
+        fig = plot_grid_tiles(df_selected, unit_type + '(' + units + ')', tile_url)
+        if tile_grid_file is not None:
+            xvr.save_value_grid(tile_grid_file, xvr.build_value_grid(df_selected['longitude'].to_numpy(),
+                                                                     df_selected['latitude'].to_numpy(),
+                                                                     df_selected['var'].to_numpy(dtype=np.float64)))
+    elif len(df_selected) >= GRID_IMAGE_MIN_CELLS:
+        fig = plot_grid_image(df_selected, unit_type + '(' + units + ')')
+    else:
+        # Build custom data and hover text for each point in graph
+        payload = build_map_payload(df_selected, area_name, area_id, unit_type, units, statistic, 'marker.color',
+                                    cells=True)
+
+        fig = go.Figure(go.Scattermapbox(lat=df_selected['latitude'], lon=df_selected['longitude'], mode='markers',
+                                         **payload,
+                                         marker=go.scattermapbox.Marker(
+                                             size=11,
+                                             color=df_selected['var'],
+                                             opacity=0.4,
+                                             showscale=True,
+                                             colorbar={'title': unit_type + '(' + units + ')'}
+                                         )
+                                         ))
     # update layout options
     fig.update_layout(
         title={
@@ -1261,6 +1491,191 @@ def update_choro_grid(df_ref, df, basin_features, year_list, mapbox_token, selec
     return fig
 
 
+def build_tile_url(url_root, key, statistic, start, end, months, units, filename):
+    """Build the URL template of the grid's map tiles, holding everything needed to compute the grid cell values
+
+    :param url_root:                Root URL of the app
+    :type url_root:                 str
+
+    :param key:                     Key of the stored dataset
+    :type key:                      str
+
+    :param statistic:               Statistic to be computed
+    :type statistic:                str
+
+    :param start:                   Start year
+    :type start:                    str
+
+    :param end:                     End year
+    :type end:                      str
+
+    :param months:                  months from dropdown
+    :type months:                   list
+
+    :param units:                   Unit of measurement
+    :type units:                    str
+
+    :param filename:                Name of uploaded file
+    :type filename:                 list
+
+    :return:                        str; tile URL with {z}/{x}/{y} placeholders
+
+    """
+
+    query = urllib.parse.urlencode({'statistic': statistic, 'start': start, 'end': end,
+                                    'months': ','.join(months or []), 'units': units,
+                                    'file_units': get_units_from_name(filename)})
+
+    return f"{url_root}tiles/{key}/{{z}}/{{x}}/{{y}}.png?{query}"
+
+
+def build_tile_grid(dataset, ref_index, statistic, start, end, months, file_units, units):
+    """Compute the grid cell values drawn by map tiles, placed on the full grid
+
+    :param dataset:                 Stored dataset
+    :type dataset:                  Dataset
+
+    :param ref_index:               Reference index built at startup
+    :type ref_index:                ReferenceIndex
+
+    :param statistic:               Statistic to be computed
+    :type statistic:                str
+
+    :param start:                   Start year
+    :type start:                    str
+
+    :param end:                     End year
+    :type end:                      str
+
+    :param months:                  months from dropdown
+    :type months:                   list
+
+    :param file_units:              Unit type of the file
+    :type file_units:               str
+
+    :param units:                   Unit of measurement
+    :type units:                    str
+
+    :return:                        array; grid cell values built by xanthosvis.raster.build_value_grid
+
+    """
+
+    year_list = [i for i in dataset.columns if start <= i <= end]
+    if len(year_list) == 0:
+        raise ValueError("No years between {} and {}.".format(start, end))
+
+    df = data_per_cell(dataset, statistic, year_list, ref_index, months, None, file_units, units)
+
+    return xvr.build_value_grid(df['longitude'].to_numpy(), df['latitude'].to_numpy(),
+                                round(df['var'], 2).to_numpy(dtype=np.float64))
+
+
+def plot_grid_tiles(df_selected, colorbar_title, tile_url):
+    """Plot grid cell values as a layer of map tiles colored on the server, so panning and zooming only loads the
+    tiles in view.  Hover and click are looked up by map coordinate as for the grid image.
+
+    :param df_selected:             Per grid cell data with longitude, latitude and var fields
+    :type df_selected:              dataframe
+
+    :param colorbar_title:          Title of the colorbar
+    :type colorbar_title:           str
+
+    :param tile_url:                Tile URL template built by build_tile_url
+    :type tile_url:                 str
+
+    :return:                        Figure with the tiles as a mapbox layer
+
+    """
+
+    values = df_selected['var'].to_numpy(dtype=np.float64)
+    finite = values[np.isfinite(values)]
+    cmin, cmax = (float(finite.min()), float(finite.max())) if len(finite) > 0 else (0.0, 1.0)
+
+    # The color range is part of the URL so every tile is colored on the same scale as the colorbar
+    source = tile_url + '&' + urllib.parse.urlencode({'cmin': cmin, 'cmax': cmax})
+
+    fig = go.Figure(go.Scattermapbox(lat=[None], lon=[None], mode='markers', hoverinfo='skip',
+                                     marker=go.scattermapbox.Marker(
+                                         color=[cmin, cmax],
+                                         colorscale='Plasma',
+                                         showscale=True,
+                                         colorbar={'title': colorbar_title}
+                                     )))
+    fig.update_layout(mapbox_layers=[{'name': 'grid_image', 'sourcetype': 'raster', 'opacity': 0.7,
+                                      'source': [source]}])
+
+    return fig
+
+
+def plot_grid_image(df_selected, colorbar_title):
+    """Plot grid cell values as one image layer colored on the server.  Hover and click on the image are looked up by
+    map coordinate (see lookup_cell_info), since the image has no points.
+
+    :param df_selected:             Per grid cell data with longitude, latitude and var fields
+    :type df_selected:              dataframe
+
+    :param colorbar_title:          Title of the colorbar
+    :type colorbar_title:           str
+
+    :return:                        Figure with the image as a mapbox layer
+
+    """
+
+    values = df_selected['var'].to_numpy(dtype=np.float64)
+    finite = values[np.isfinite(values)]
+    cmin, cmax = (finite.min(), finite.max()) if len(finite) > 0 else (0, 1)
+
+    image, coordinates = xvr.render_grid_image(df_selected['longitude'].to_numpy(), df_selected['latitude'].to_numpy(),
+                                               values, cmin, cmax, GRID_COLOR_LUT)
+
+    # The image has no colorbar of its own, draw one with a trace that has no points
+    fig = go.Figure(go.Scattermapbox(lat=[None], lon=[None], mode='markers', hoverinfo='skip',
+                                     marker=go.scattermapbox.Marker(
+                                         color=[cmin, cmax],
+                                         colorscale='Plasma',
+                                         showscale=True,
+                                         colorbar={'title': colorbar_title}
+                                     )))
+    fig.update_layout(mapbox_layers=[{'name': 'grid_image', 'sourcetype': 'image', 'opacity': 0.7,
+                                      'source': xvr.png_data_uri(xvr.encode_png(image)),
+                                      'coordinates': coordinates}])
+
+    return fig
+
+
+def lookup_cell_info(ref_index, lon, lat):
+    """Get the reference info of the grid cell at a map coordinate, for hover and click on the grid image
+
+    :param ref_index:               Reference index built at startup
+    :type ref_index:                ReferenceIndex
+
+    :param lon:                     Longitude
+    :type lon:                      float
+
+    :param lat:                     Latitude
+    :type lat:                      float
+
+    :return:                        dict; customdata of the cell ordered as CUSTOM_DATA_FIELDS and basin and country
+                                    names, or None if there is no grid cell at the coordinate
+
+    """
+
+    row = xvr.lookup_cell(ref_index.cell_grid, lon, lat)
+    if row is None:
+        return None
+
+    cell = {name: values[row] for name, values in ref_index.columns.items()}
+    cell['grid_id'] = ref_index.grid_ids[row]
+
+    # Missing values are sent as null
+    def value(v):
+        return None if pd.isna(v) else v.item() if hasattr(v, 'item') else v
+
+    return {'customdata': [value(cell['basin_id']), value(cell['country_id']), value(cell['country_name']),
+                           value(cell['grid_id'])],
+            'basin_name': value(cell['basin_name']), 'country_name': value(cell['country_name'])}
+
+
 def flatten(x):
     """Flatten an iterable
 